@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Render animation files to PNG sequences without the GUI.
+
+Run from the source tree, for instance:
+
+    ./dopey-render.py -j 4 -m 1 -o frames/ scene1.ora scene2.ora
+
+See ``--help`` for the options.
+
+"""
+
+import sys
+import os.path
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lib import batchrender
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(batchrender.main(sys.argv[1:]))
@@ -18,9 +18,13 @@ from layerswindow import stock_button
 
 from lib.framelist import DEFAULT_ACTIVE_CELS
 
-COLUMNS_NAME = ('frame_index', 'frame_data')
+# the frame index is the row number, so inserting rows renumbers nothing
+COLUMNS_NAME = ('frame_data',)
 COLUMNS_ID = dict((name, i) for i, name in enumerate(COLUMNS_NAME))
 
+THUMBNAIL_SIZE = 48
+THUMBNAIL_SIZE_SMALL = 24
+
 class AnimationTool (gtk.VBox):
 
     stock_id = 'mypaint-tool-animation'
@@ -40,9 +44,18 @@ class AnimationTool (gtk.VBox):
         self.app = app
         self.ani = app.doc.ani.model
         self.is_playing = False
+        self._prefetching = False
+        self._thumbnailing = False
+        self._scrub_show_pending = False
+        self._scrub_timer = None
+
+        cache_mb = self.app.preferences.get("xsheet.frame_cache_mb", 256)
+        self.ani.frame_cache.budget = cache_mb * 1024 * 1024
 
         self.set_size_request(200, 150)
         self.app.doc.model.doc_observers.append(self.doc_structure_modified_cb)
+        self.app.doc.model.stroke_observers.append(self.stroke_cb)
+        self.ani.thumbnails.observers.append(self.thumbnail_rendered_cb)
         
         # create list:
         self.listmodel = self.create_list()
@@ -212,6 +225,11 @@ class AnimationTool (gtk.VBox):
         icons_cb.connect('toggled', self.on_smallicons_toggled)
         icons_cb.set_tooltip_text(_("Use smaller icons, better to see more rows."))
 
+        thumbnails_cb = gtk.CheckButton(_("Show thumbnails"))
+        thumbnails_cb.set_active(self.app.preferences.get("xsheet.thumbnails", True))
+        thumbnails_cb.connect('toggled', self.on_thumbnails_toggled)
+        thumbnails_cb.set_tooltip_text(_("Show a thumbnail of the cel of each frame."))
+
         play_lightbox_cb = gtk.CheckButton(_("Play with lightbox on"))
         play_lightbox_cb.set_active(self.app.preferences.get("xsheet.play_lightbox", False))
         play_lightbox_cb.connect('toggled', self.on_playlightbox_toggled)
@@ -227,6 +245,12 @@ class AnimationTool (gtk.VBox):
         shownext_cb.connect('toggled', self.on_shownextprev_toggled, 'next')
         shownext_cb.set_tooltip_text(_("Show next cels in the lightbox."))
 
+        tint_cb = gtk.CheckButton(_("Tint lightbox"))
+        tint_cb.set_active(self.app.preferences.get("xsheet.lightbox_tint", True))
+        tint_cb.connect('toggled', self.on_lightboxtint_toggled)
+        tint_cb.set_tooltip_text(_("Show previous cels in red and next cels in blue."))
+        self.ani.set_lightbox_tint(tint_cb.get_active())
+
         controls_vbox = gtk.VBox()
         controls_vbox.pack_start(buttons_hbox, expand=False)
         controls_vbox.pack_start(anibuttons_hbox, expand=False)
@@ -235,9 +259,11 @@ class AnimationTool (gtk.VBox):
         preferences_vbox = gtk.VBox()
         preferences_vbox.pack_start(framerate_hbox, expand=False)
         preferences_vbox.pack_start(icons_cb, expand=False)
+        preferences_vbox.pack_start(thumbnails_cb, expand=False)
         preferences_vbox.pack_start(play_lightbox_cb, expand=False)
         preferences_vbox.pack_start(showprev_cb, expand=False)
         preferences_vbox.pack_start(shownext_cb, expand=False)
+        preferences_vbox.pack_start(tint_cb, expand=False)
         preferences_vbox.pack_start(opacity_hbox, expand=False)
         preferences_vbox.pack_start(opacityopts_vbox, expand=False)
 
@@ -258,6 +284,7 @@ class AnimationTool (gtk.VBox):
         self.show_all()
         self._change_player_buttons()
         self.app.doc.model.doc_observers.append(self.update)
+        self.ani.xsheet_observers.append(self.xsheet_changed_cb)
 
     def _get_path_from_frame(self, frame):
         return (self.ani.frames.idx, )
@@ -278,9 +305,8 @@ class AnimationTool (gtk.VBox):
         self.treeview.set_model(None)
 
         self.listmodel.clear()
-        xsheet_list = list(enumerate(self.ani.frames))
-        for i, frame in xsheet_list:
-            self.listmodel.append((i, frame))
+        for frame in self.ani.frames:
+            self.listmodel.append((frame,))
 
         column = self.treeview.get_column(0)
         cell = column.get_cells()[0]
@@ -290,8 +316,17 @@ class AnimationTool (gtk.VBox):
         column.set_cell_data_func(cell, self.set_icon)
         column = self.treeview.get_column(2)
         cell = column.get_cells()[0]
+        column.set_cell_data_func(cell, self.set_thumbnail)
+        column.set_visible(self.app.preferences.get("xsheet.thumbnails", True))
+        column = self.treeview.get_column(3)
+        cell = column.get_cells()[0]
         column.set_cell_data_func(cell, self.set_description)
 
+        small_icons = self.app.preferences.get("xsheet.small_icons", False)
+        size = THUMBNAIL_SIZE_SMALL if small_icons else THUMBNAIL_SIZE
+        self.ani.thumbnails.set_size(size)
+        self.treeview.get_column(2).set_fixed_width(size + 4)
+
         # reconnect treeview:
         self.treeview.set_model(self.listmodel)
 
@@ -320,11 +355,33 @@ class AnimationTool (gtk.VBox):
     def update(self, doc):
         return self._update()
 
+    def xsheet_changed_cb(self, change, idx, count):
+        """Apply an edit of the frame list to the rows"""
+        if self.ani.cleared:
+            return # the whole list is rebuilt by _update()
+        treesel = self.treeview.get_selection()
+        treesel.handler_block(self.changed_handler)
+        try:
+            frames = self.ani.frames
+            model = self.listmodel
+            if change == 'inserted':
+                for i in xrange(idx, idx+count):
+                    model.insert(i, (frames[i],))
+            elif change == 'removed':
+                it = model.iter_nth_child(None, idx)
+                for i in xrange(count):
+                    if it is None or not model.remove(it):
+                        break
+            elif change == 'changed':
+                for i in xrange(idx, idx+count):
+                    model[i] = (frames[i],)
+        finally:
+            treesel.handler_unblock(self.changed_handler)
+
     def create_list(self):
-        xsheet_list = list(enumerate(self.ani.frames))
-        listmodel = gtk.ListStore(int, object)
-        for i, frame in xsheet_list:
-            listmodel.append((i, frame))
+        listmodel = gtk.ListStore(object)
+        for frame in self.ani.frames:
+            listmodel.append((frame,))
         return listmodel
     
     def add_columns(self):
@@ -346,11 +403,19 @@ class AnimationTool (gtk.VBox):
         icon_cell = gtk.CellRendererPixbuf()
         icon_col = gtk.TreeViewColumn(_("Status"))
         icon_col.pack_start(icon_cell, expand=False)
-        icon_col.add_attribute(icon_cell, 'pixbuf', 0)
         icon_col.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
         icon_col.set_fixed_width(50)
         icon_col.set_cell_data_func(icon_cell, self.set_icon)
 
+        # thumbnail column
+
+        thumbnail_cell = gtk.CellRendererPixbuf()
+        thumbnail_col = gtk.TreeViewColumn(_("Thumbnail"))
+        thumbnail_col.pack_start(thumbnail_cell, expand=False)
+        thumbnail_col.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        thumbnail_col.set_fixed_width(THUMBNAIL_SIZE + 4)
+        thumbnail_col.set_cell_data_func(thumbnail_cell, self.set_thumbnail)
+
         # description column
 
         desc_cell = gtk.CellRendererText()
@@ -361,6 +426,7 @@ class AnimationTool (gtk.VBox):
 
         self.treeview.append_column(framenumber_col)
         self.treeview.append_column(icon_col)
+        self.treeview.append_column(thumbnail_col)
         self.treeview.append_column(description_col)
         
     def _change_player_buttons(self):
@@ -393,9 +459,32 @@ class AnimationTool (gtk.VBox):
     def on_row_changed(self, treesel):
         model, it = treesel.get_selected()
         path = model.get_path(it)
-        frame_idx = path[COLUMNS_ID['frame_index']]
+        frame_idx = path[0]
+        if not self.is_playing and self.ani.scrubber.move(frame_idx):
+            # dragged quickly: show the latest frame, coarsely, when idle
+            if not self._scrub_show_pending:
+                self._scrub_show_pending = True
+                gobject.idle_add(self._show_scrubbed_frame)
+            if self._scrub_timer is None:
+                ms = int(1000 * self.ani.scrubber.interval)
+                self._scrub_timer = gobject.timeout_add(ms, self._end_scrub)
+            return
         self.ani.select_frame(frame_idx)
         self._update_buttons_sensitive()
+
+    def _show_scrubbed_frame(self):
+        self._scrub_show_pending = False
+        if self.ani.scrubber.active:
+            self.ani.scrubber.show()
+        return False
+
+    def _end_scrub(self):
+        if not self.ani.scrubber.resting():
+            return True
+        self._scrub_timer = None
+        self.ani.select_frame(self.ani.scrubber.finish())
+        self._update_buttons_sensitive()
+        return False
         
     def on_toggle_key(self, button):
         self.ani.toggle_key()
@@ -431,7 +520,7 @@ class AnimationTool (gtk.VBox):
         return path % 2
 
     def set_number(self, column, cell, model, it, data):
-        idx = model.get_value(it, COLUMNS_ID['frame_index'])
+        idx = model.get_path(it)[0]
         cell.set_property('text', str(idx+1))
         
     def set_description(self, column, cell, model, it, data):
@@ -453,10 +542,40 @@ class AnimationTool (gtk.VBox):
         pixbuf = getattr(self.app.pixmaps, pixname)
         cell.set_property('pixbuf', pixbuf)
 
-    def _call_player(self, use_lightbox=False):
-        self.ani.player_next(use_lightbox)
+    def set_thumbnail(self, column, cell, model, it, data):
+        idx = model.get_path(it)[0]
+        cel = self.ani.frames.cel_at(idx)
+        pixbuf = None
+        if cel is not None:
+            pixbuf = self.ani.thumbnails.get(cel)
+            if self.ani.thumbnails.pending:
+                self._schedule_thumbnails()
+        cell.set_property('pixbuf', pixbuf)
+
+    def _schedule_thumbnails(self):
+        if self._thumbnailing or self.is_playing:
+            return
+        self._thumbnailing = True
+        gobject.idle_add(self._render_thumbnails)
+
+    def _render_thumbnails(self):
+        more = not self.is_playing and self.ani.thumbnails.render_pending()
+        if not more:
+            self._thumbnailing = False
+        return more
+
+    def thumbnail_rendered_cb(self, cel):
+        self.treeview.queue_draw()
+
+    def stroke_cb(self, stroke, brush):
+        # redrawn rows request thumbnails of the painted cels again
+        self.treeview.queue_draw()
+
+    def _call_player(self):
+        player = self.ani.player
         keep_playing = True
         if self.ani.player_state == "stop":
+            player.stop()
             self.ani.select_without_undo(self.beforeplay_frame)
             keep_playing = False
             self.is_playing = False
@@ -464,12 +583,30 @@ class AnimationTool (gtk.VBox):
             self.ani.player_state = None
             self._update()
         elif self.ani.player_state == "pause":
+            player.stop()
             keep_playing = False
             self.is_playing = False
             self._change_player_buttons()
             self.ani.player_state = None
             self._update()
-        return keep_playing
+        else:
+            player.tick()
+            self._schedule_player()
+        # each timeout is one-shot, rescheduled from the playback clock
+        return False
+
+    def _schedule_player(self):
+        ms = int(round(1000 * self.ani.player.next_delay()))
+        gobject.timeout_add(max(ms, 1), self._call_player)
+        if not self._prefetching:
+            self._prefetching = True
+            gobject.idle_add(self._prefetch_frames)
+
+    def _prefetch_frames(self):
+        more = self.ani.player.prefetch()
+        if not more:
+            self._prefetching = False
+        return more
 
     def _play_animation(self, from_first_frame=True, use_lightbox=False):
         self.is_playing = True
@@ -478,14 +615,11 @@ class AnimationTool (gtk.VBox):
             self.ani.frames.select(0)
         self._change_player_buttons()
         self.ani.hide_all_frames()
-        # animation timer
-        ms_per_frame = int(round(1000.0/self.framerate_entry.get_value()))
 
-        # show first frame immediately, otherwise there's a single frame delay
-        # @TODO: it seems to wait one frame before stopping too
-        self._call_player(use_lightbox)
-
-        gobject.timeout_add(ms_per_frame, self._call_player, use_lightbox)
+        # The first frame is shown immediately, the next ones are
+        # scheduled from the elapsed time so slow frames don't drift
+        self.ani.player.start(self.framerate_entry.get_value(), use_lightbox)
+        self._schedule_player()
 
     def on_animation_play(self, button):
         self.ani.play_animation()
@@ -510,6 +644,7 @@ class AnimationTool (gtk.VBox):
 
     def on_framerate_changed(self, adj):
         self.ani.framerate = adj.get_value()
+        self.ani.player.set_framerate(self.ani.framerate)
 
     def on_smallicons_toggled(self, checkbox):
         self.app.preferences["xsheet.small_icons"] = checkbox.get_active()
@@ -517,9 +652,17 @@ class AnimationTool (gtk.VBox):
         # height
         self.setup()
         
+    def on_thumbnails_toggled(self, checkbox):
+        self.app.preferences["xsheet.thumbnails"] = checkbox.get_active()
+        self.treeview.get_column(2).set_visible(checkbox.get_active())
+
     def on_playlightbox_toggled(self, checkbox):
         self.app.preferences["xsheet.play_lightbox"] = checkbox.get_active()
 
+    def on_lightboxtint_toggled(self, checkbox):
+        self.app.preferences["xsheet.lightbox_tint"] = checkbox.get_active()
+        self.ani.set_lightbox_tint(checkbox.get_active())
+
     def on_shownextprev_toggled(self, checkbox, nextprev):
         self.app.preferences["xsheet.lightbox_show_" + nextprev] = checkbox.get_active()
         self.ani.toggle_nextprev(nextprev, checkbox.get_active())
@@ -19,6 +19,8 @@ import gtk
 from gtk import gdk
 
 import lib.document
+import lib.tilestore
+import lib.tiledsurface
 from lib import brush
 from lib import helpers
 from lib import mypaintlib
@@ -206,6 +208,22 @@ class Application (object):
 
         # Working document: model and controller
         model = lib.document.Document(self.brush)
+        model.lazy_cels = self.preferences.get("xsheet.lazy_cels", True)
+        cel_mb = self.preferences.get("xsheet.cel_memory_mb", 512)
+        model.cel_store.budget = cel_mb * 1024 * 1024
+        model.ani.compact_xsheet = self.preferences.get("xsheet.compact_format",
+                                                         False)
+        if self.preferences.get("xsheet.share_tiles", True):
+            model.tile_store = lib.tilestore.TileStore()
+        # 0: never compress the tiles not used recently
+        tile_mb = self.preferences.get("tiles.memory_mb", 2048)
+        lib.tiledsurface.tile_compressor.budget = (tile_mb * 1024 * 1024
+                                                   or None)
+        # 0: keep all tiles in memory, else page out the cold ones to disk
+        resident = self.preferences.get("tiles.swap_resident_tiles", 0)
+        if resident:
+            swap = lib.tiledsurface.TileSwap(resident)
+            lib.tiledsurface.tile_compressor.swap = swap
         self.doc = document.Document(self, app_canvas, model)
         app_canvas.set_model(model)
 
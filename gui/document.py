@@ -175,6 +175,9 @@ class Document (CanvasController):
     PAN_UP = 3   #: Stepwise panning direction: up
     PAN_DOWN = 4   #: Stepwise panning direction: down
 
+    # Delay of the mipmap rebuild after canvas changes outside of strokes
+    MIPMAP_UPDATE_DELAY = 250 #: milliseconds
+
 
     def __init__(self, app, tdw, model, leader=None):
         self.app = app
@@ -234,6 +237,17 @@ class Document (CanvasController):
         # Device-specific brushes: save at end of stroke
         self.input_stroke_ended_observers.append(self.input_stroke_ended_cb)
 
+        # Zooming out should not wait for the mipmaps of what was painted.
+        # They are rebuilt between strokes, not between motion events.
+        self._mipmaps_srcid = None
+        self._mipmaps_timeout_srcid = None
+        self._input_stroke_active = False
+        self.model.canvas_observers.append(self._canvas_modified_mipmaps_cb)
+        self.input_stroke_started_observers.append(
+            self._input_stroke_started_mipmaps_cb)
+        self.input_stroke_ended_observers.append(
+            self._input_stroke_ended_mipmaps_cb)
+
         self.init_stategroups()
         if leader is not None:
             # This is a side controller (e.g. the scratchpad) which plays
@@ -987,6 +1001,53 @@ class Document (CanvasController):
         self._view_changed_notification_srcid = srcid
 
 
+    def _canvas_modified_mipmaps_cb(self, *rect):
+        # Changes outside of strokes (fills, undo, frame changes) are
+        # followed by a rebuild once they settle
+        if self._input_stroke_active:
+            return
+        if self._mipmaps_timeout_srcid is None:
+            cb = self._mipmaps_timeout_cb
+            srcid = gobject.timeout_add(self.MIPMAP_UPDATE_DELAY, cb)
+            self._mipmaps_timeout_srcid = srcid
+
+
+    def _input_stroke_started_mipmaps_cb(self, event):
+        self._input_stroke_active = True
+        for srcid in (self._mipmaps_srcid, self._mipmaps_timeout_srcid):
+            if srcid is not None:
+                gobject.source_remove(srcid)
+        self._mipmaps_srcid = None
+        self._mipmaps_timeout_srcid = None
+
+
+    def _input_stroke_ended_mipmaps_cb(self, event):
+        self._input_stroke_active = False
+        self._schedule_mipmaps()
+
+
+    def _mipmaps_timeout_cb(self):
+        self._mipmaps_timeout_srcid = None
+        if not self._input_stroke_active:
+            self._schedule_mipmaps()
+        return False
+
+
+    def _schedule_mipmaps(self):
+        if self._mipmaps_srcid is None:
+            cb = self._update_mipmaps_idle_cb
+            srcid = gobject.idle_add(cb, priority=gobject.PRIORITY_LOW)
+            self._mipmaps_srcid = srcid
+
+
+    def _update_mipmaps_idle_cb(self):
+        """Rebuilds the mipmaps in small batches when idle"""
+        more = self.model.update_mipmaps(max_time=0.005)
+        if not more:
+            self._mipmaps_srcid = None
+        return more
+
+
     def _view_changed_notification_idle_cb(self):
         """Background notifier callback used by `notify_view_changed()`.
         """
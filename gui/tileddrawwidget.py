@@ -860,6 +860,10 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
             layers = [self.doc.layer]
             # this is for hiding instead
             #layers.pop(self.doc.layer_idx)
+        ani = self.doc.ani
+        if background is None:
+            # Lightbox cels around the current one, composited once
+            layers = ani.onion_skin.substitute(layers, keep=self.doc.layer)
         if self.overlay_layer:
             idx = layers.index(self.doc.layer)
             layers.insert(idx+1, self.overlay_layer)
@@ -869,7 +873,22 @@ class CanvasRenderer(gtk.DrawingArea, DrawCursorMixin):
         for tx, ty in surface.get_tiles():
             if self.tile_is_visible(tx, ty, transformation, clip_region, sparse, translation_only):
                 tiles.append((tx, ty))
-        self.doc.render_into(surface, tiles, mipmap_level, layers, background)
+        if ani.player_state == "play" and background is None \
+                and not self.overlay_layer:
+            # Playback: blit the flattened frame instead of compositing
+            ani.frame_cache.render_into(surface, tiles, mipmap_level,
+                                        ani.frames.idx, ani.play_lightbox)
+            ani.player.frame_rendered(ani.frames.idx)
+        elif ani.scrubber.active and background is None \
+                and not self.overlay_layer:
+            # Scrubbing: a coarse frame now, full quality when it rests
+            ani.frame_cache.render_into(surface, tiles, mipmap_level,
+                                        ani.frames.idx, coarse_levels=
+                                        ani.scrubber.coarse_levels)
+            ani.scrubber.frame_rendered(ani.frames.idx)
+        else:
+            self.doc.render_into(surface, tiles, mipmap_level, layers,
+                                 background)
 
         # The speedup below worked for GTK2, is there is an equivalent for GTK3?
         #if translation_only:
@@ -17,6 +17,16 @@ def layername_from_description(description):
 
 
 class SelectFrame(Action):
+    """Frame navigation, coalesced into one entry by update()
+
+    It is an undo step of its own, so undoing after navigating only
+    returns to the frame where the navigation started.  It does not count
+    toward the undo steps kept, so navigating never pushes edits out of
+    the history.
+
+    """
+    undo_step_counted = False
+
     def __init__(self, doc, idx):
         self.doc = doc
         self.frames = doc.ani.frames
@@ -24,22 +34,26 @@ class SelectFrame(Action):
         self.prev_layer_idx = None
 
     def redo(self):
-        cel = self.frames.cel_at(self.idx)
+        self.prev_layer_idx = self.doc.layer_idx
+        self.prev_frame_idx = self.frames.idx
+        self._select(self.idx)
+
+    def update(self, idx):
+        """Go on to another frame; undo still returns to the first one"""
+        self.idx = idx
+        self._select(idx)
+
+    def _select(self, idx):
+        cel = self.frames.cel_at(idx)
         if cel is not None:
             # Select the corresponding layer:
-            layer_idx = self.doc.layers.index(cel)
-            self.prev_layer_idx = self.doc.layer_idx
-            self.doc.layer_idx = layer_idx
-        
-        self.prev_frame_idx = self.frames.idx
-        self.frames.select(self.idx)
+            self.doc.layer_idx = self.doc.layers.index(cel)
+        self.frames.select(idx)
         self.doc.ani.update_opacities()
         self._notify_document_observers()
     
     def undo(self):
-        if self.prev_layer_idx is not None:
-            self.doc.layer_idx = self.prev_layer_idx
-        
+        self.doc.layer_idx = self.prev_layer_idx
         self.frames.select(self.prev_frame_idx)
         self.doc.ani.update_opacities()
         self._notify_document_observers()
@@ -54,11 +68,13 @@ class ToggleKey(Action):
         self.prev_value = self.frame.is_key
         self.frame.toggle_key()
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
     def undo(self):
         self.frame.is_key = self.prev_value
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
 
@@ -71,11 +87,13 @@ class ToggleSkipVisible(Action):
         self.prev_value = self.frame.skip_visible
         self.frame.toggle_skip_visible()
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
     def undo(self):
         self.frame.skip_visible = self.prev_value
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
 
@@ -90,6 +108,7 @@ class ChangeDescription(Action):
     def redo(self):
         self.prev_value = self.frame.description
         self.frame.description = self.new_description
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
         if self.frame.cel != None:
             layername = layername_from_description(self.frame.description)
@@ -97,6 +116,7 @@ class ChangeDescription(Action):
 
     def undo(self):
         self.frame.description = self.prev_value
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
         if self.frame.cel != None:
             self.frame.cel.name = self.old_layername
@@ -120,6 +140,7 @@ class AddCel(Action):
         self.frame.add_cel(self.layer)
         self._notify_canvas_observers([self.layer])
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
     
     def undo(self):
@@ -128,6 +149,7 @@ class AddCel(Action):
         self.frame.remove_cel()
         self._notify_canvas_observers([self.layer])
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
 
@@ -149,6 +171,7 @@ class RemoveCel(Action):
         self.frame.remove_cel()
 
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
     
     def undo(self):
@@ -160,6 +183,7 @@ class RemoveCel(Action):
         self.frame.add_cel(self.layer)
 
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
 
 
@@ -170,13 +194,15 @@ class AppendFrames(Action):
         self.length = length
 
     def redo(self):
+        idx = len(self.frames)
         self.frames.append_frames(self.length)
-        self.doc.ani.cleared = True
+        self.doc.ani.notify_xsheet_observers('inserted', idx, self.length)
         self._notify_document_observers()
 
     def undo(self):
-        self.frames.remove_frames(self.length)
-        self.doc.ani.cleared = True
+        idx = self.frames.idx
+        removed = self.frames.remove_frames(self.length)
+        self.doc.ani.notify_xsheet_observers('removed', idx, len(removed))
         self._notify_document_observers()
 
 
@@ -188,13 +214,15 @@ class InsertFrames(Action):
         self.length = length
 
     def redo(self):
+        idx = self.frames.idx
         self.frames.insert_empty_frames(self.length)
-        self.doc.ani.cleared = True
+        self.doc.ani.notify_xsheet_observers('inserted', idx, self.length)
         self._notify_document_observers()
 
     def undo(self):
-        self.frames.remove_frames(self.length)
-        self.doc.ani.cleared = True
+        idx = self.frames.idx
+        removed = self.frames.remove_frames(self.length)
+        self.doc.ani.notify_xsheet_observers('removed', idx, len(removed))
         self._notify_document_observers()
 
 
@@ -212,11 +240,12 @@ class RemoveFrames(Action):
             self.doc.ani.frames.count_cel(frame.cel) == 1:
                 self.doc.layers.remove(frame.cel)
                 self.doc.layer_idx = len(self.doc.layers) - 1
-                self._notify_canvas_observers(frame.cel)
+                self._notify_canvas_observers([frame.cel])
 
-        self.frames.remove_frames(self.length)
+        idx = self.frames.idx
+        removed = self.frames.remove_frames(self.length)
 
-        self.doc.ani.cleared = True
+        self.doc.ani.notify_xsheet_observers('removed', idx, len(removed))
         self._notify_document_observers()
         
     def undo(self):
@@ -226,9 +255,11 @@ class RemoveFrames(Action):
                 self.doc.layers.append(frame.cel)
                 self._notify_canvas_observers([frame.cel])
 
+        idx = self.frames.idx
         self.frames.insert_frames(self.frames_to_remove)
 
-        self.doc.ani.cleared = True
+        self.doc.ani.notify_xsheet_observers('inserted', idx,
+                                             len(self.frames_to_remove))
         self._notify_document_observers()
 
 
@@ -255,6 +286,9 @@ class PasteCel(Action):
         self.doc.ani.edit_frame = None
 
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
+        if self.prev_edit_operation == 'cut':
+            self.doc.ani.notify_frame_changed(self.prev_edit_frame)
         self._notify_document_observers()
 
     def undo(self):
@@ -262,4 +296,5 @@ class PasteCel(Action):
         self.doc.ani.edit_frame = self.prev_edit_frame
         self.frame.add_cel(self.prev_cel)
         self.doc.ani.update_opacities()
+        self.doc.ani.notify_frame_changed(self.frame)
         self._notify_document_observers()
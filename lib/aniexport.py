@@ -0,0 +1,321 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Export of animations to image sequences and videos."""
+
+import os
+import shutil
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from distutils.spawn import find_executable
+import logging
+logger = logging.getLogger(__name__)
+
+from gi.repository import GdkPixbuf
+
+import tiledsurface
+import pixbufsurface
+import helpers
+from framecache import flatten_tile
+from avi import AVIWriter
+
+#: Command line video encoders, in order of preference
+VIDEO_ENCODERS = ['ffmpeg', 'avconv']
+
+
+def _encode_png(pixbuf, filename):
+    # GdkPixbuf releases the GIL while it compresses
+    pixbuf.savev(filename, 'png', [], [])
+    return filename
+
+
+def link_or_copy(src, dst):
+    """Make dst a hardlink of src, or a copy where links are unsupported"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+def sequence_filenames(filename, count):
+    """Return the numbered filenames of an image sequence
+
+    >>> sequence_filenames('/tmp/walk-001.png', 3)
+    ['/tmp/walk-001.png', '/tmp/walk-002.png', '/tmp/walk-003.png']
+    """
+    prefix, ext = os.path.splitext(filename)
+    # if we have a number already, strip it
+    l = prefix.rsplit('-', 1)
+    if l[-1].isdigit():
+        prefix = l[0]
+    return ['%s-%03d%s' % (prefix, i+1, ext) for i in range(count)]
+
+
+def save_png_sequence(ani, filename, threads=None, feedback_cb=None,
+                      cancelled=None, alpha=True):
+    """Save one PNG per frame of an animation
+
+    :param ani: the animation to export
+    :type ani: lib.animation.Animation
+    :param filename: name of the first file, numbers are appended
+    :param threads: number of encoder threads, default is one per CPU
+    :param feedback_cb: called after each encoded cel, to show progress
+    :param cancelled: called after each encoded cel, the export stops
+        if it returns True
+    :param alpha: save the transparency of the cels
+    :returns: False if the export was cancelled, True otherwise
+
+    Each distinct cel is encoded only once, held frames are hardlinked
+    (or copied) from the file of the frame showing the cel first.  The
+    progress is kept in ``ani.export_progress`` as a (done, total)
+    tuple, for `feedback_cb` to display.
+
+    The cels are rendered one after the other by the calling thread,
+    and compressed to PNG by a pool of threads meanwhile.  At most two
+    rendered cels per thread wait for their encoder.
+
+    """
+    filenames = sequence_filenames(filename, len(ani.frames))
+    x, y, w, h = ani.doc.get_effective_bbox()
+    if w == 0 or h == 0:
+        # workaround to save empty documents
+        x, y, w, h = 0, 0, 1, 1
+
+    # Group the frames by the cel they show
+    jobs = []
+    holds = {}
+    first_file = {}
+    for i, fn in enumerate(filenames):
+        cel = ani.frames.cel_at(i)
+        if cel in first_file:
+            holds[first_file[cel]].append(fn)
+            continue
+        first_file[cel] = fn
+        holds[fn] = []
+        jobs.append((cel, fn))
+
+    total = len(jobs)
+    ani.export_progress = (0, total)
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    threads = max(1, min(threads, total))
+
+    pool = ThreadPool(threads)
+    pending = deque()
+    done = 0
+    try:
+        for i, (cel, fn) in enumerate(jobs):
+            if cel is None:
+                surface = tiledsurface.Surface()
+            else:
+                surface = cel._surface
+            pixbuf = pixbufsurface.render_as_pixbuf(surface, x, y, w, h,
+                                                    alpha=alpha)
+            pending.append(pool.apply_async(_encode_png, (pixbuf, fn)))
+            del pixbuf
+            last = (i == total-1)
+            while pending and (last or len(pending) >= 2*threads):
+                fn = pending.popleft().get()
+                for held_fn in holds[fn]:
+                    link_or_copy(fn, held_fn)
+                done += 1
+                ani.export_progress = (done, total)
+                if feedback_cb:
+                    feedback_cb()
+                if cancelled and cancelled():
+                    logger.info('PNG export cancelled after %d of %d cels',
+                                done, total)
+                    return False
+        logger.info('Saved %d frames, %d distinct cels encoded',
+                    len(filenames), total)
+        return True
+    finally:
+        pool.close()
+        pool.join()
+
+
+def find_video_encoder():
+    """Return the path of an installed video encoder, or None"""
+    for name in VIDEO_ENCODERS:
+        path = find_executable(name)
+        if path:
+            return path
+    return None
+
+
+class FrameRenderer (object):
+    """Flattens animation frames into a pixbuf of the output size
+
+    Frames are rendered straight from the layers into one reused
+    pixbufsurface, at a mipmap level for quick downscaled output, then
+    scaled to the output size if needed.  Video encoders want even
+    dimensions, so with `even_size` the output size is rounded down to
+    them.
+
+    """
+
+    def __init__(self, doc, rect, width=None, mipmap_level=0, even_size=True):
+        object.__init__(self)
+        x, y, w, h = rect
+        scale = 2**mipmap_level
+        x, y = x // scale, y // scale
+        w, h = max(1, w // scale), max(1, h // scale)
+        self.background = doc.background
+        self.mipmap_level = mipmap_level
+        self.surface = pixbufsurface.Surface(x, y, w, h)
+        if width is None:
+            width = w
+        height = int(round(h * float(width) / w))
+        if even_size:
+            width = max(2, width - width % 2)
+            height = max(2, height - height % 2)
+        self.width = max(1, width)
+        self.height = max(1, height)
+
+    def render(self, layers):
+        """Render (layer, opacity) pairs, returns an RGBA pixbuf"""
+        for tx, ty in self.surface.get_tiles():
+            with self.surface.tile_request(tx, ty, readonly=False) as dst:
+                flatten_tile(dst, layers, self.background, tx, ty,
+                             self.mipmap_level)
+        pixbuf = self.surface.pixbuf
+        if (pixbuf.get_width(), pixbuf.get_height()) != (self.width,
+                                                         self.height):
+            pixbuf = pixbuf.scale_simple(self.width, self.height,
+                                         GdkPixbuf.InterpType.BILINEAR)
+        return pixbuf
+
+
+class EncoderPipe (object):
+    """Streams raw RGB frames into the stdin of an ffmpeg process"""
+
+    def __init__(self, encoder, filename, width, height, fps):
+        object.__init__(self)
+        cmd = [encoder, '-y',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', '%dx%d' % (width, height), '-r', str(fps),
+               '-i', '-',
+               '-an', '-vcodec', 'mpeg4', '-qscale', '3',
+               filename]
+        logger.debug('Running %r', cmd)
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def encode(self, pixbuf):
+        rgb = helpers.gdkpixbuf2numpy(pixbuf)[:, :, :3]
+        return rgb.tostring()
+
+    def write_frame(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise IOError('Video encoder failed with exit status %d'
+                          % self.proc.returncode)
+
+    def abort(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class AVIFile (object):
+    """Writes Motion-JPEG frames into an AVI file, without external tools"""
+
+    def __init__(self, filename, width, height, fps, quality=90):
+        object.__init__(self)
+        self.quality = quality
+        self.f = open(filename, 'wb')
+        self.writer = AVIWriter(self.f, width, height, fps, codec='MJPG')
+
+    def encode(self, pixbuf):
+        ok, data = pixbuf.save_to_bufferv('jpeg', ['quality'],
+                                          [str(self.quality)])
+        if not ok:
+            raise IOError('JPEG encoding of a video frame failed')
+        return data
+
+    def write_frame(self, data):
+        self.writer.write_frame(data)
+
+    def close(self):
+        self.writer.close()
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+
+
+def save_video(ani, filename, width=800, fps=24, encoder=None,
+               feedback_cb=None, cancelled=None):
+    """Save the animation as a video file
+
+    :param ani: the animation to export
+    :type ani: lib.animation.Animation
+    :param width: width of the video, the height is proportional
+    :param encoder: path of an ffmpeg compatible encoder, by default
+        the first found of `VIDEO_ENCODERS`.  An MJPEG AVI is written
+        directly if there is none.
+    :param feedback_cb: called after each frame, to show progress
+    :param cancelled: called after each frame, the export stops and the
+        file is removed if it returns True
+    :returns: False if the export was cancelled, True otherwise
+
+    Frames are streamed to the encoder as they are rendered, no
+    intermediate files are written.  Held frames are rendered and
+    encoded once, and their data repeated.
+
+    """
+    x, y, w, h = ani.doc.get_effective_bbox()
+    if w == 0 or h == 0:
+        x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
+    renderer = FrameRenderer(ani.doc, (x, y, w, h), width)
+    if encoder is None:
+        encoder = find_video_encoder()
+    if encoder:
+        out = EncoderPipe(encoder, filename, renderer.width,
+                          renderer.height, fps)
+    else:
+        logger.info('No video encoder found, writing an MJPEG AVI')
+        out = AVIFile(filename, renderer.width, renderer.height, fps)
+
+    total = len(ani.frames)
+    ani.export_progress = (0, total)
+    last_key = None
+    encoded = 0
+    try:
+        for i in xrange(total):
+            layers = ani.get_frame_layers(i)
+            key = tuple((id(l), opacity) for l, opacity in layers)
+            if key != last_key:
+                data = out.encode(renderer.render(layers))
+                last_key = key
+                encoded += 1
+            out.write_frame(data)
+            ani.export_progress = (i+1, total)
+            if feedback_cb:
+                feedback_cb()
+            if cancelled and cancelled():
+                logger.info('Video export cancelled after %d of %d frames',
+                            i+1, total)
+                out.abort()
+                out = None
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return False
+        out.close()
+        out = None
+    finally:
+        if out is not None:
+            out.abort()
+    logger.info('Saved %d frames to %r, %d distinct frames encoded',
+                total, filename, encoded)
+    return True
@@ -7,19 +7,23 @@
 # (at your option) any later version.
 
 import os
-import glob
+import contextlib
 from gettext import gettext as _
 import json
-import tempfile
-from subprocess import call
 import logging
 logger = logging.getLogger('animation subsystem')
 
 
 import pixbufsurface
+import helpers
 
 import anicommand
-from framelist import FrameList
+import aniexport
+from framelist import FrameList, LightboxSchedule
+from framecache import FrameCache
+from onionskin import OnionSkin, DEFAULT_TINT
+from thumbnailcache import ThumbnailCache
+from aniplayer import Player, Scrubber
 from xdna import XDNA
 
 
@@ -39,40 +43,78 @@ class Animation(object):
         self.framerate = 24.0
         self.cleared = False
         self.using_legacy = False
+
+        # Called with (change, idx, count) on edits of the frame list,
+        # see notify_xsheet_observers(). Replacing the whole list sets
+        # `cleared` instead.
+        self.xsheet_observers = []
         self.xdna = XDNA()
+        # Save the x-sheet in the compact run-length format:
+        self.compact_xsheet = False
 
         # For reproduction, "play", "pause", "stop":
         self.player_state = None
+        self.player = Player(self)
+        self.scrubber = Scrubber(self)
 
         # For cut/copy/paste operations:
         self.edit_operation = None
         self.edit_frame = None
 
+        # Flattened frames, blitted instead of rendered during playback:
+        self.frame_cache = FrameCache(doc)
+        self.play_lightbox = False
+
+        # Lightbox cels around the current one, composited once:
+        self.onion_skin = OnionSkin(doc)
+
+        # Opacity changes between frames for playing with the lightbox:
+        self._lightbox_schedule = None
+
+        # Cel thumbnails for the x-sheet, rendered when the GUI is idle:
+        self.thumbnails = ThumbnailCache(doc)
+
+        # Canvas damage collected during a frame change, see coalesced_damage():
+        self._damage = None
+        self.damage_dispatches = 0
+
+        # (done, total) steps of the running export:
+        self.export_progress = None
+
     def clear_xsheet(self, init=False):
         self.frames = FrameList(24, self.opacities)
+        self.frame_cache.clear()
+        self.onion_skin.clear()
+        self.thumbnails.clear()
         self.cleared = True
     
+    def _layer_indices(self):
+        """Map of layers to their index, instead of one index() per frame"""
+        return dict((l, i) for i, l in enumerate(self.doc.layers))
+
     def legacy_xsheet_as_str(self):
         """
         Return animation X-Sheet as data in json format.
 
         """
+        layer_idx = self._layer_indices()
         data = []
         for f in self.frames:
             if f.cel is not None:
-                layer_idx = self.doc.layers.index(f.cel)
+                idx = layer_idx[f.cel]
             else:
-                layer_idx = None
-            data.append((f.is_key, f.description, layer_idx))
-        str_data = json.dumps(data, sort_keys=True, indent=4)
+                idx = None
+            data.append((f.is_key, f.description, idx))
+        str_data = json.dumps(data, sort_keys=True)
         return str_data
 
-    def xsheet_as_str(self):
+    def iter_xsheet_json(self):
         """
-        Return animation X-Sheet as data in XDNA format.
+        Yield the X-Sheet in XDNA format as chunks of json, one per frame.
 
         """
         x = self.xdna
+        layer_idx = self._layer_indices()
 
         data = {
             'metadata': x.application_signature,
@@ -82,28 +124,96 @@ class Animation(object):
                 'raster_frame_lists': [[]]
             }
         }
+        # the frames are streamed into the empty frame list
+        frame_list = '"raster_frame_lists": [[]]'
+        head, tail = json.dumps(data, sort_keys=True).split(frame_list)
+        yield head + frame_list[:-2]
 
+        sep = '\n'
         for f in self.frames:
             if f.cel is not None:
-                layer_idx = self.doc.layers.index(f.cel)
+                idx = str(layer_idx[f.cel])
             else:
-                layer_idx = None
-            data['xsheet']['raster_frame_lists'][0].append({
-                'idx': layer_idx,
-                'is_key': f.is_key,
-                'description': f.description
-            })
-
-        str_data = json.dumps(data, sort_keys=True, indent=4)
-        return str_data
+                idx = 'null'
+            yield '%s{"description": %s, "idx": %s, "is_key": %s}' % (
+                sep, json.dumps(f.description), idx,
+                'true' if f.is_key else 'false')
+            sep = ',\n'
+        yield '\n]]' + tail
+
+    def xsheet_as_str(self):
+        """
+        Return animation X-Sheet as data in XDNA format.
+
+        """
+        return ''.join(self.iter_xsheet_json())
+
+    def iter_xsheet_runs(self):
+        """
+        Yield (layer idx, description, is_key, length) for each run of
+        identical frames. The frames holding a cel form a single run.
+
+        """
+        layer_idx = self._layer_indices()
+        run = None
+        length = 0
+        for f in self.frames:
+            if f.cel is not None:
+                idx = layer_idx[f.cel]
+            else:
+                idx = None
+            frame = (idx, f.description, f.is_key)
+            if frame == run:
+                length += 1
+                continue
+            if run is not None:
+                yield run + (length,)
+            run = frame
+            length = 1
+        if run is not None:
+            yield run + (length,)
+
+    def xsheet_as_rle(self):
+        """
+        Return animation X-Sheet in the compact run-length XDNA format.
+
+        """
+        header = {
+            'metadata': self.xdna.application_signature,
+            'framerate': self.framerate,
+            'frames': len(self.frames),
+        }
+        return self.xdna.runs_serialize(header, self.iter_xsheet_runs())
 
     def _write_xsheet(self, xsheetfile):
         """
         Save FrameList to file.
         
         """
-        str_data = self.xsheet_as_str()
-        xsheetfile.write(str_data)
+        if self.compact_xsheet:
+            xsheetfile.write(self.xsheet_as_rle())
+            return
+        for chunk in self.iter_xsheet_json():
+            xsheetfile.write(chunk)
+
+    def _rle_to_xsheet(self, ani_data):
+        header, runs = self.xdna.runs_deserialize(ani_data)
+        self.frames = FrameList(header['frames'], self.opacities)
+        self.framerate = header['framerate']
+        self.cleared = True
+
+        i = 0
+        for idx, description, is_key, length in runs:
+            if idx is not None or description or is_key:
+                cel = None
+                if idx is not None:
+                    cel = self.doc.layers[idx]
+                for f in self.frames[i:i+length]:
+                    f.is_key = is_key
+                    f.description = description
+                    f.cel = cel
+            i += length
+        logger.info('loaded %d frames from %d runs', i, len(runs))
 
     def str_to_xsheet(self, ani_data):
         """
@@ -111,6 +221,10 @@ class Animation(object):
     
         """
 
+        if self.xdna.is_rle(ani_data):
+            self._rle_to_xsheet(ani_data)
+            return
+
         data = json.loads(ani_data)
 
         # first check if it's in the legacy non-descriptive JSON or new XDNA format
@@ -180,96 +294,155 @@ class Animation(object):
             self._read_xsheet(xsheetfile)
     
     def save_png(self, filename, **kwargs):
-        prefix, ext = os.path.splitext(filename)
-        # if we have a number already, strip it
-        l = prefix.rsplit('-', 1)
-        if l[-1].isdigit():
-            prefix = l[0]
-        doc_bbox = self.doc.get_effective_bbox()
-        for i in range(len(self.frames)):
-            filename = '%s-%03d%s' % (prefix, i+1, ext)
-            cel = self.frames.cel_at(i)
-            cel._surface.save(filename, *doc_bbox, **kwargs)
+        """
+        Save one PNG file per frame, see aniexport.save_png_sequence().
+
+        The cels are decoded as they are rendered, one after the other,
+        so the cel store keeps to its memory budget meanwhile.
+
+        """
+        return aniexport.save_png_sequence(self, filename, **kwargs)
 
     def save_avi(self, filename, vid_width=800, vid_fps=24, **kwargs):
         """
         Save video file with codec mpeg4.
 
-        Requires command tools imagemagick and ffmpeg .
+        Frames are streamed to ffmpeg (or avconv), see
+        aniexport.save_video().  Without one of them installed, a
+        Motion-JPEG AVI is written instead.
+
+        """
+        prefix, ext = os.path.splitext(filename)
+        out_filename = prefix + '.avi'
+        return aniexport.save_video(self, out_filename, width=vid_width,
+                                    fps=vid_fps,
+                                    feedback_cb=kwargs.get('feedback_cb'),
+                                    cancelled=kwargs.get('cancelled'))
 
+    def get_frame_layers(self, idx, use_lightbox=False):
         """
-        tempdir = tempfile.mkdtemp()
-        jpgs_tempdir = os.path.join(tempdir, 'jpgs')
-        os.mkdir(jpgs_tempdir)
-        base_filename = os.path.basename(filename)
-        prefix, ext = os.path.splitext(base_filename)
-        out_filename = os.path.join(os.path.dirname(filename), prefix + '.avi')
-
-        pngs_filename = os.path.join(tempdir, 'tempani.png')
-        self.save_png(pngs_filename)
-
-        # convert pngs to jpegs with imagemagick command:
-        pngs_list = glob.glob(tempdir + os.path.sep + '*png')
-        pngs_list.sort()
-        for png_file in pngs_list:
-            f_basename = os.path.basename(png_file)
-            name, ext = os.path.splitext(f_basename)
-            jpg_file = os.path.join(jpgs_tempdir, name + '.jpg')
-            print "converting %s to %s..." % (png_file, jpg_file)
-            call(["convert",
-                  "-resize", str(vid_width),
-                  "-quality", "100",
-                  "-background", "white",
-                  "-flatten",
-                  png_file, jpg_file])
-
-        # convert the previous jpgs to video with ffmpeg command:
-        jpgs = jpgs_tempdir + os.path.sep + 'tempani-%03d.jpg'
-        call(["ffmpeg",
-              "-r", str(vid_fps),
-              "-b", "1800",
-              "-y", "-i",
-              jpgs, out_filename])
+        Return the (layer, opacity) pairs that make up the nth frame.
+
+        The layers are ordered bottom to top.  Layers that are not cels
+        of the x-sheet are included with their own opacity.
+
+        """
+        if use_lightbox:
+            opacities, visible = self.frames.get_opacities(idx)
+        else:
+            opacities = {}
+            cel = self.frames.cel_at(idx)
+            if cel is not None:
+                opacities[cel] = 1
+        cels = self.frames.get_cel_set()
+        layers = []
+        for layer in self.doc.layers:
+            if layer in cels:
+                opacity = opacities.get(layer, 0)
+            else:
+                opacity = layer.effective_opacity
+            if opacity > 0:
+                layers.append((layer, opacity))
+        return layers
+
+    @contextlib.contextmanager
+    def coalesced_damage(self):
+        """
+        Collect the canvas damage of a frame change and dispatch it once.
+
+        Within the block, the bboxes of the affected cels are merged into
+        one region, which is sent to the canvas observers when the block
+        ends.  Nested blocks join the outermost one.  Every dispatch
+        increments `damage_dispatches`.
+
+        """
+        if self._damage is not None:
+            yield
+            return
+        self._damage = helpers.Region()
+        try:
+            yield
+        finally:
+            damage = self._damage
+            self._damage = None
+            if damage:
+                self.damage_dispatches += 1
+                for rect in damage:
+                    for f in self.doc.canvas_observers:
+                        f(*rect)
+
+    def notify_xsheet_observers(self, change, idx, count=1):
+        """Tell the x-sheet views that frames changed
+
+        :param change: 'inserted', 'removed' or 'changed'
+        :param idx: index of the first frame concerned
+        :param count: number of consecutive frames concerned
+
+        """
+        for f in self.xsheet_observers:
+            f(change, idx, count)
+
+    def notify_frame_changed(self, frame):
+        try:
+            idx = self.frames.index(frame)
+        except ValueError:
+            return # not in the x-sheet any more
+        self.notify_xsheet_observers('changed', idx)
 
     def _notify_canvas_observers(self, affected_layer):
-        bbox = affected_layer._surface.get_bbox()
+        # from the PNG header of a cel that is not decoded yet
+        bbox = affected_layer.get_bbox()
+        if self._damage is not None:
+            self._damage.add(bbox)
+            return
         for f in self.doc.canvas_observers:
             f(*bbox)
 
     def hide_all_frames(self):
-        cels = []
-        for cel in self.frames.get_all_cels():
-            cel.visible = False
-            self._notify_canvas_observers(cel)
+        with self.coalesced_damage():
+            for cel in self.frames.get_all_cels():
+                cel.visible = False
+                self._notify_canvas_observers(cel)
 
     def change_visible_frame(self, prev_idx, cur_idx):
         prev_cel = self.frames.cel_at(prev_idx)
         cur_cel = self.frames.cel_at(cur_idx)
         if prev_cel == cur_cel:
             return
-        if prev_cel != None:
-            prev_cel.visible = False
-            self._notify_canvas_observers(prev_cel)
-        if cur_cel == None:
-            return
-        cur_cel.opacity = 1
-        cur_cel.visible = True
-        self._notify_canvas_observers(cur_cel)
+        with self.coalesced_damage():
+            if prev_cel != None:
+                prev_cel.visible = False
+                self._notify_canvas_observers(prev_cel)
+            if cur_cel == None:
+                return
+            cur_cel.opacity = 1
+            cur_cel.visible = True
+            self._notify_canvas_observers(cur_cel)
 
     def update_opacities(self):
         opacities, visible = self.frames.get_opacities()
-
-        for cel, opa in opacities.items():
-            if cel is None:
-                continue
-            cel.opacity = opa
-            self._notify_canvas_observers(cel)
-
-        for cel, vis in visible.items():
-            if cel is None:
-                continue
-            cel.visible = vis
-            self._notify_canvas_observers(cel)
+        idx = self.frames.idx
+        self.onion_skin.update(opacities, self.frames.cel_at(idx),
+                               self.frames.get_cels_after(idx))
+
+        # Only the cels whose opacity changed need a redraw
+        with self.coalesced_damage():
+            for cel, opa in opacities.items():
+                if cel is None:
+                    continue
+                vis = visible[cel]
+                if cel.opacity == opa and cel.visible == vis:
+                    continue
+                cel.opacity = opa
+                cel.visible = vis
+                self._notify_canvas_observers(cel)
+
+    def set_lightbox_tint(self, enabled):
+        """Tint the lightbox cels before and after the current frame"""
+        tint = DEFAULT_TINT if enabled else None
+        with self.coalesced_damage():
+            for cel in self.onion_skin.set_tint(tint):
+                self._notify_canvas_observers(cel)
 
     def select_without_undo(self, idx):
         """Like the command but without undo/redo."""
@@ -293,16 +466,59 @@ class Animation(object):
     def stop_animation(self):
         self.player_state = "stop"
 
-    def player_next(self, use_lightbox=False):
+    def player_goto(self, idx, use_lightbox=False):
+        self.play_lightbox = use_lightbox
         prev_idx = self.frames.idx
-        if self.frames.has_next():
-            self.frames.goto_next()
+        self.frames.select(idx)
+        if self.frames.idx == prev_idx:
+            # Nothing to step from, e.g. the first frame of playback
+            # after hide_all_frames(): show the whole frame
+            self._show_current_frame(use_lightbox)
+        elif use_lightbox:
+            self._step_lightbox(prev_idx, self.frames.idx)
         else:
-            self.frames.select(0)
+            self.change_visible_frame(prev_idx, self.frames.idx)
+
+    def _show_current_frame(self, use_lightbox):
         if use_lightbox:
             self.update_opacities()
+            return
+        cel = self.frames.cel_at(self.frames.idx)
+        if cel is None or (cel.visible and cel.opacity == 1):
+            return
+        cel.opacity = 1
+        cel.visible = True
+        self._notify_canvas_observers(cel)
+
+    def _step_lightbox(self, prev_idx, cur_idx):
+        """
+        Apply the lightbox opacities of a frame change from the schedule.
+
+        The onion skin is left as it is, playback draws cached frames;
+        update_opacities() brings it up to date when playback stops.
+
+        """
+        schedule = self._lightbox_schedule
+        if schedule is None or schedule.frames is not self.frames:
+            schedule = self._lightbox_schedule = LightboxSchedule(self.frames)
+        changes = schedule.changes(prev_idx, cur_idx)
+        if changes is None:
+            self.update_opacities()
+            return
+        with self.coalesced_damage():
+            for cel, opa, vis in changes:
+                if cel.opacity == opa and cel.visible == vis:
+                    continue
+                cel.opacity = opa
+                cel.visible = vis
+                self._notify_canvas_observers(cel)
+
+    def player_next(self, use_lightbox=False):
+        if self.frames.has_next():
+            idx = self.frames.idx + 1
         else:
-            self.change_visible_frame(prev_idx, self.frames.idx)
+            idx = 0
+        self.player_goto(idx, use_lightbox)
 
     def toggle_key(self):
         frame = self.frames.get_selected()
@@ -349,7 +565,13 @@ class Animation(object):
         self.doc.do(anicommand.RemoveCel(self.doc, frame))
 
     def select_frame(self, idx):
-        self.doc.do(anicommand.SelectFrame(self.doc, idx))
+        # successive frame changes are a single undo entry
+        cmd = self.doc.get_last_command()
+        if (isinstance(cmd, anicommand.SelectFrame)
+            and cmd.frames is self.frames):
+            self.doc.update_last_command(idx=idx)
+        else:
+            self.doc.do(anicommand.SelectFrame(self.doc, idx))
 
     def change_opacityfactor(self, opacityfactor):
         self.frames.set_opacityfactor(opacityfactor)
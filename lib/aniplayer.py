@@ -0,0 +1,325 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Clock driven animation playback."""
+
+import time
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+
+#: Number of recent frames the achieved frame rate is measured over
+FPS_WINDOW = 48
+
+#: Selection changes closer than this, in seconds, are a scrub
+SCRUB_INTERVAL = 0.15
+
+#: Mipmap levels below the display at which scrubbed frames are shown
+SCRUB_COARSE_LEVELS = 2
+
+
+class PlaybackClock (object):
+    """Maps wall clock time to the frame that should be on screen
+
+    The frame is computed from the time elapsed since the clock started,
+    so slow frames never shift the rest of the timeline.  Playback loops
+    over `frame_count` frames.
+
+    """
+
+    def __init__(self, framerate, frame_count, start_idx=0, clock=time.time):
+        object.__init__(self)
+        self.clock = clock
+        self.framerate = framerate
+        self.frame_count = frame_count
+        self.start_idx = start_idx
+        self.start_time = clock()
+
+    def _elapsed_frames(self, now):
+        if now is None:
+            now = self.clock()
+        return (now - self.start_time) * self.framerate
+
+    def target_frame(self, now=None):
+        """Index of the frame due at `now`"""
+        n = int(self._elapsed_frames(now))
+        return (self.start_idx + n) % self.frame_count
+
+    def frame_time(self, n):
+        """Time at which the nth frame since the start is due"""
+        return self.start_time + n / float(self.framerate)
+
+    def frames_since_start(self, now=None):
+        return int(self._elapsed_frames(now))
+
+    def delay_to_next(self, now=None):
+        """Seconds until the next frame is due"""
+        elapsed = self._elapsed_frames(now)
+        return (int(elapsed) + 1 - elapsed) / self.framerate
+
+    def restart(self, framerate, start_idx, now=None):
+        """Continue from start_idx at a new frame rate"""
+        if now is None:
+            now = self.clock()
+        self.framerate = framerate
+        self.start_idx = start_idx
+        self.start_time = now
+
+
+class Player (object):
+    """Drives the playback of an animation from a PlaybackClock
+
+    The GUI calls `tick()` whenever its timer fires, and waits
+    `next_delay()` before the next call.  Each tick shows the frame due
+    at that time; frames whose time passed while the previous ones were
+    shown are dropped.  Between ticks, `prefetch()` renders the next
+    frames into the frame cache.
+
+    Timings are available from `stats()`.  The render latency of a
+    frame is the time from when it was due to when the canvas finished
+    drawing it, reported through `frame_rendered()`.
+
+    """
+
+    def __init__(self, ani, clock=time.time):
+        object.__init__(self)
+        self.ani = ani
+        self.clock = clock
+        self.playback_clock = None
+        self.use_lightbox = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames_shown = 0
+        self.frames_dropped = 0
+        self._shown_times = deque(maxlen=FPS_WINDOW)
+        self._latencies = deque(maxlen=FPS_WINDOW)
+        self._due = {} # frame idx: due time, until rendered
+        self._last_n = None
+
+    def start(self, framerate, use_lightbox=False):
+        """Start playing from the selected frame"""
+        self.use_lightbox = use_lightbox
+        self.playback_clock = PlaybackClock(framerate, len(self.ani.frames),
+                                            self.ani.frames.idx, self.clock)
+        self.reset_stats()
+        self.tick()
+
+    def stop(self):
+        if self.playback_clock is not None:
+            logger.info('Playback stats: %r', self.stats())
+            if self.use_lightbox:
+                # the onion skin is not updated frame by frame
+                self.ani.update_opacities()
+        self.playback_clock = None
+
+    @property
+    def playing(self):
+        return self.playback_clock is not None
+
+    def set_framerate(self, framerate):
+        """Change the frame rate without jumping to another frame"""
+        if self.playback_clock is None:
+            return
+        self.playback_clock.restart(framerate, self.ani.frames.idx)
+        self._last_n = None
+
+    def tick(self, now=None):
+        """Show the frame due now, returns its index"""
+        c = self.playback_clock
+        if now is None:
+            now = self.clock()
+        c.frame_count = len(self.ani.frames)
+        n = c.frames_since_start(now)
+        if self._last_n is not None:
+            if n == self._last_n:
+                return self.ani.frames.idx
+            self.frames_dropped += max(0, n - self._last_n - 1)
+        self._last_n = n
+        idx = c.target_frame(now)
+        self.ani.player_goto(idx, self.use_lightbox)
+        self.frames_shown += 1
+        self._shown_times.append(now)
+        self._due[idx] = c.frame_time(n)
+        return idx
+
+    def next_delay(self, now=None):
+        """Seconds to wait before the next tick()"""
+        return self.playback_clock.delay_to_next(now)
+
+    def upcoming_frames(self, count=2):
+        """Indices of the frames shown after the current one"""
+        frame_count = len(self.ani.frames)
+        return [(self.ani.frames.idx + i) % frame_count
+                for i in range(1, count+1)]
+
+    def prefetch(self, count=2):
+        """Render part of the next frames into the frame cache
+
+        Returns True while there is more to render, to be used as an
+        idle callback.
+
+        """
+        if self.playback_clock is None:
+            return False
+        for idx in self.upcoming_frames(count):
+            if self.ani.frame_cache.prefetch(idx, self.use_lightbox):
+                return True
+        return False
+
+    def frame_rendered(self, idx, now=None):
+        """Record that the canvas finished drawing the nth frame"""
+        due = self._due.pop(idx, None)
+        if due is None:
+            return
+        if now is None:
+            now = self.clock()
+        self._latencies.append(now - due)
+
+    def stats(self):
+        """Return a dict of playback timings
+
+        fps: frame rate achieved over the last frames
+        shown: frames shown since the start
+        dropped: frames skipped to keep up with the clock
+        latency: mean render latency of the last frames, in seconds
+        max_latency: worst of those latencies
+
+        """
+        times = self._shown_times
+        fps = 0.0
+        if len(times) > 1 and times[-1] > times[0]:
+            fps = (len(times) - 1) / (times[-1] - times[0])
+        latencies = self._latencies
+        latency = max_latency = 0.0
+        if latencies:
+            latency = sum(latencies) / len(latencies)
+            max_latency = max(latencies)
+        return {
+            'fps': fps,
+            'shown': self.frames_shown,
+            'dropped': self.frames_dropped,
+            'latency': latency,
+            'max_latency': max_latency,
+        }
+
+
+class Scrubber (object):
+    """Shows frames cheaply while the x-sheet selection is dragged
+
+    The GUI reports every selection change with `move()`.  Once changes
+    come faster than `interval`, they are a scrub: only the latest frame
+    is shown, with `show()`, and it is drawn from the frame cache at a
+    coarse mipmap level (`coarse_levels`) instead of being selected with
+    an undoable command.  When the selection rests for `interval`,
+    `finish()` ends the scrub and gives the frame to select for real, at
+    full quality.
+
+    The display latency of a frame is the time from its selection to the
+    end of its drawing, reported through `frame_rendered()`.
+
+    """
+
+    def __init__(self, ani, clock=time.time, interval=SCRUB_INTERVAL):
+        object.__init__(self)
+        self.ani = ani
+        self.clock = clock
+        self.interval = interval
+        self.coarse_levels = SCRUB_COARSE_LEVELS
+        self.active = False
+        self.target = None
+        self.start_idx = None
+        self._last_move = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames_shown = 0
+        self.frames_skipped = 0
+        self._latencies = deque(maxlen=FPS_WINDOW)
+        self._due = {} # frame idx: time it was selected, until rendered
+
+    def move(self, idx, now=None):
+        """Record a selection change, returns True if it is scrubbed"""
+        if now is None:
+            now = self.clock()
+        rapid = (self._last_move is not None
+                 and now - self._last_move < self.interval)
+        self._last_move = now
+        if not (rapid or self.active):
+            return False
+        if not self.active:
+            self.active = True
+            self.start_idx = self.ani.frames.idx
+            self.reset_stats()
+        if self.target is not None:
+            # replaced before being shown
+            self.frames_skipped += 1
+            self._due.pop(self.target, None)
+        self.target = idx
+        self._due.setdefault(idx, now)
+        return True
+
+    def show(self):
+        """Show the latest frame scrubbed to, skipping the earlier ones"""
+        if self.target is None:
+            return
+        self.ani.player_goto(self.target)
+        self.frames_shown += 1
+        self.target = None
+
+    def resting(self, now=None):
+        """Whether the selection stopped moving long enough to finish"""
+        if now is None:
+            now = self.clock()
+        return now - self._last_move >= self.interval
+
+    def finish(self):
+        """End the scrub, returns the frame to select
+
+        The selection goes back to where the scrub started, so that the
+        command selecting the returned frame undoes the whole scrub.
+
+        """
+        idx = self.target
+        if idx is None:
+            idx = self.ani.frames.idx
+        self.target = None
+        self.active = False
+        self.ani.frames.select(self.start_idx)
+        logger.info('Scrubbing stats: %r', self.stats())
+        return idx
+
+    def frame_rendered(self, idx, now=None):
+        """Record that the canvas finished drawing the nth frame"""
+        due = self._due.pop(idx, None)
+        if due is None:
+            return
+        if now is None:
+            now = self.clock()
+        self._latencies.append(now - due)
+
+    def stats(self):
+        """Return a dict of scrubbing timings
+
+        shown: frames shown during the scrub
+        skipped: frames passed over without being shown
+        latency: mean display latency of the last frames, in seconds
+        max_latency: worst of those latencies
+
+        """
+        latencies = self._latencies
+        latency = max_latency = 0.0
+        if latencies:
+            latency = sum(latencies) / len(latencies)
+            max_latency = max(latencies)
+        return {
+            'shown': self.frames_shown,
+            'skipped': self.frames_skipped,
+            'latency': latency,
+            'max_latency': max_latency,
+        }
@@ -0,0 +1,136 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Minimal AVI (RIFF) container writer.
+
+Writes a single video stream, either uncompressed 24 bit frames
+("DIB ") or Motion-JPEG ("MJPG") frames.  It needs no external tools,
+so video export keeps working when no encoder is installed.
+
+"""
+
+import struct
+
+import numpy
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+# File offsets of the header data rewritten by AVIWriter.close():
+# 'RIFF' size 'AVI ' 'LIST' size 'hdrl' 'avih' size <main header>
+# 'LIST' size 'strl' 'strh' size <stream header> ...
+MAIN_HEADER_OFFSET = 32
+STREAM_HEADER_OFFSET = MAIN_HEADER_OFFSET + 56 + 20
+
+CODECS = {
+    # codec: (BITMAPINFOHEADER compression, chunk id)
+    'DIB ': ('\0\0\0\0', '00db'),
+    'MJPG': ('MJPG', '00dc'),
+}
+
+
+def rgb_to_dib(rgb):
+    """Convert a HxWx3 uint8 RGB array to uncompressed DIB frame data
+
+    DIB rows are stored bottom-up in BGR order, padded to 4 bytes.
+    """
+    h, w, channels = rgb.shape
+    assert channels == 3
+    stride = (w*3 + 3) & ~3
+    dib = numpy.zeros((h, stride), 'uint8')
+    dib[:, :w*3] = rgb[::-1, :, ::-1].reshape(h, w*3)
+    return dib.tostring()
+
+
+class AVIWriter (object):
+    """Writes frames into an AVI file, one at a time.
+
+    The file object must be seekable: the headers are completed when the
+    writer is closed.
+    """
+
+    def __init__(self, fileobj, width, height, fps, codec='DIB '):
+        object.__init__(self)
+        if codec not in CODECS:
+            raise ValueError('Unsupported AVI codec %r' % (codec,))
+        self.f = fileobj
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.codec = codec
+        self.compression, self.chunk_id = CODECS[codec]
+        self.index = []
+        self.max_frame_size = 0
+        self._write_headers()
+        self.movi_start = self.f.tell()
+        self.f.write('LIST\0\0\0\0movi')
+
+    def _chunk(self, fourcc, data):
+        self.f.write(fourcc)
+        self.f.write(struct.pack('<I', len(data)))
+        self.f.write(data)
+        if len(data) % 2:
+            self.f.write('\0')
+
+    def _main_header(self):
+        usec_per_frame = int(round(1000000.0 / self.fps))
+        max_bytes_per_sec = int(self.max_frame_size * self.fps)
+        return struct.pack('<14I', usec_per_frame, max_bytes_per_sec, 0,
+                           AVIF_HASINDEX, len(self.index), 0, 1,
+                           self.max_frame_size, self.width, self.height,
+                           0, 0, 0, 0)
+
+    def _stream_header(self):
+        scale = 1000
+        rate = int(round(self.fps * scale))
+        return struct.pack('<4s4sIHHIIIIIIII4h', 'vids', self.codec, 0, 0, 0,
+                           0, scale, rate, 0, len(self.index),
+                           self.max_frame_size, 0xffffffff, 0,
+                           0, 0, self.width, self.height)
+
+    def _stream_format(self):
+        image_size = ((self.width*3 + 3) & ~3) * self.height
+        return struct.pack('<IiiHH4sIiiII', 40, self.width, self.height, 1,
+                           24, self.compression, image_size, 0, 0, 0, 0)
+
+    def _write_headers(self):
+        self.f.write('RIFF\0\0\0\0AVI ')
+        strl = 'strl'
+        for fourcc, data in (('strh', self._stream_header()),
+                             ('strf', self._stream_format())):
+            strl += fourcc + struct.pack('<I', len(data)) + data
+        hdrl = 'hdrl'
+        hdrl += 'avih' + struct.pack('<I', 56) + self._main_header()
+        hdrl += 'LIST' + struct.pack('<I', len(strl)) + strl
+        self.f.write('LIST' + struct.pack('<I', len(hdrl)) + hdrl)
+
+    def write_frame(self, data):
+        """Append one frame of already encoded data"""
+        offset = self.f.tell() - (self.movi_start + 8)
+        self._chunk(self.chunk_id, data)
+        self.index.append((offset, len(data)))
+        self.max_frame_size = max(self.max_frame_size, len(data))
+
+    def close(self):
+        """Write the index and complete the headers"""
+        movi_end = self.f.tell()
+        index = ''.join(struct.pack('<4sIII', self.chunk_id, AVIIF_KEYFRAME,
+                                    offset, size)
+                        for offset, size in self.index)
+        self._chunk('idx1', index)
+        riff_end = self.f.tell()
+        # Patch the sizes and frame counts unknown at the start
+        self.f.seek(4)
+        self.f.write(struct.pack('<I', riff_end - 8))
+        self.f.seek(MAIN_HEADER_OFFSET)
+        self.f.write(self._main_header())
+        self.f.seek(STREAM_HEADER_OFFSET)
+        self.f.write(self._stream_header())
+        self.f.seek(self.movi_start + 4)
+        self.f.write(struct.pack('<I', movi_end - self.movi_start - 8))
+        self.f.seek(riff_end)
@@ -0,0 +1,204 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Headless rendering of animation files to image sequences.
+
+Used by the dopey-render script:
+
+    dopey-render.py [options] scene1.ora [scene2.ora ...]
+
+Each file is split into ranges of frames, rendered by a pool of worker
+processes.  Every worker loads the file itself, with lazily decoded
+cels, so only the cels of its frames are decoded.
+
+"""
+
+import os
+import json
+import time
+import zipfile
+import multiprocessing
+from optparse import OptionParser
+import logging
+logger = logging.getLogger(__name__)
+
+import document
+import tiledsurface
+import aniexport
+from xdna import XDNA
+
+
+def parse_range(text):
+    """Parse a 1-based inclusive frame range into a 0-based [start, end)
+
+    >>> parse_range('10-20')
+    (9, 20)
+    >>> parse_range('5')
+    (4, 5)
+    >>> parse_range('5-')
+    (4, None)
+    """
+    first, sep, last = text.partition('-')
+    start = int(first) - 1
+    if not sep:
+        return start, start + 1
+    if not last:
+        return start, None
+    return start, int(last)
+
+
+def count_frames(filename):
+    """Number of frames in the x-sheet of an ORA file, without loading it"""
+    try:
+        data = zipfile.ZipFile(filename).read('animation.xsheet')
+    except KeyError:
+        root, ext = os.path.splitext(filename)
+        try:
+            data = open(root + '.xsheet').read()
+        except IOError:
+            data = None
+    if data is None:
+        doc = document.Document()
+        doc.load(filename, lazy_cels=True)
+        return len(doc.ani.frames)
+    xdna = XDNA()
+    if xdna.is_rle(data):
+        header, runs = xdna.runs_deserialize(data)
+        return header['frames']
+    data = json.loads(data)
+    if type(data) is dict:
+        return len(data['xsheet']['raster_frame_lists'][0])
+    return len(data)
+
+
+def split_jobs(filename, outdir, start, end, chunk, options):
+    """Split a frame range of a file into render jobs"""
+    count = count_frames(filename)
+    if end is None or end > count:
+        end = count
+    jobs = []
+    for first in xrange(start, end, chunk):
+        jobs.append((filename, outdir, count, first, min(first+chunk, end),
+                     options))
+    return jobs
+
+
+def render_job(job):
+    """Render frames [first, last) of a file to PNG
+
+    Returns (filename, frames, distinct frames rendered, bytes written).
+
+    """
+    filename, outdir, count, first, last, options = job
+    doc = document.Document()
+    doc.load(filename, lazy_cels=True)
+    ani = doc.ani
+
+    x, y, w, h = doc.get_effective_bbox()
+    if w == 0 or h == 0:
+        x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
+    renderer = aniexport.FrameRenderer(doc, (x, y, w, h),
+                                       width=options.get('width'),
+                                       mipmap_level=options.get('mipmap', 0),
+                                       even_size=False)
+    base = os.path.splitext(os.path.basename(filename))[0]
+    names = aniexport.sequence_filenames(os.path.join(outdir, base + '.png'),
+                                         count)
+
+    last_key = last_name = None
+    rendered = nbytes = 0
+    for i in xrange(first, last):
+        layers = ani.get_frame_layers(i)
+        key = tuple((id(l), opacity) for l, opacity in layers)
+        if key == last_key:
+            # held frame
+            aniexport.link_or_copy(last_name, names[i])
+        else:
+            pixbuf = renderer.render(layers)
+            pixbuf.savev(names[i], 'png', [], [])
+            rendered += 1
+            last_key = key
+        last_name = names[i]
+        nbytes += os.path.getsize(names[i])
+    return filename, last - first, rendered, nbytes
+
+
+def render(filenames, outdir, start=0, end=None, chunk=24, processes=None,
+           **options):
+    """Render animation files to image sequences in outdir
+
+    :param start, end: frame range, 0-based, end excluded (None: all)
+    :param chunk: number of frames per job
+    :param processes: number of worker processes, default one per CPU
+    :param options: width, mipmap - size of the output
+    :returns: (frames, distinct frames rendered, bytes written, seconds)
+
+    """
+    t0 = time.time()
+    jobs = []
+    for filename in filenames:
+        jobs += split_jobs(filename, outdir, start, end, chunk, options)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+
+    frames = rendered = nbytes = 0
+    pool = None
+    try:
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(render_job, jobs)
+        else:
+            results = (render_job(job) for job in jobs)
+        for filename, n, r, b in results:
+            frames += n
+            rendered += r
+            nbytes += b
+            logger.info('%s: %d frames done', filename, n)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return frames, rendered, nbytes, time.time() - t0
+
+
+def main(argv=None):
+    parser = OptionParser('usage: %prog [options] FILE.ora [FILE.ora ...]')
+    parser.add_option('-o', '--output', default='.',
+                      help='directory for the image sequences')
+    parser.add_option('-r', '--range', default=None,
+                      help='frames to render, like 1-24 (default: all)')
+    parser.add_option('-w', '--width', type='int', default=None,
+                      help='scale the frames to this width')
+    parser.add_option('-m', '--mipmap', type='int', default=0,
+                      help='render at this mipmap level (1: half size...)')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='number of worker processes (default: CPUs)')
+    parser.add_option('-c', '--chunk', type='int', default=24,
+                      help='frames per job (default: %default)')
+    options, filenames = parser.parse_args(argv)
+    if not filenames:
+        parser.error('no files to render')
+    if not 0 <= options.mipmap <= tiledsurface.MAX_MIPMAP_LEVEL:
+        parser.error('mipmap level must be 0 to %d'
+                     % tiledsurface.MAX_MIPMAP_LEVEL)
+    start, end = 0, None
+    if options.range:
+        start, end = parse_range(options.range)
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    frames, rendered, nbytes, seconds = render(
+        filenames, options.output, start, end, max(1, options.chunk),
+        options.jobs, width=options.width, mipmap=options.mipmap)
+    seconds = max(seconds, 1e-6)
+    print '%d frames (%d rendered, the rest held) in %.2fs' % (
+        frames, rendered, seconds)
+    print '%.1f frames/s, %.2f MB/s' % (frames / seconds,
+                                        nbytes / seconds / 1024**2)
+    return 0
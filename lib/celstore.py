@@ -0,0 +1,209 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Lazy decoding of animation cels."""
+
+import os
+import struct
+import tempfile
+import contextlib
+import functools
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+import helpers
+import tiledsurface
+
+N = tiledsurface.N
+
+#: Default memory budget for decoded cels, in bytes
+DEFAULT_BUDGET = 512 * 1024 * 1024
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def png_size(data):
+    """Return the (width, height) of PNG data, read from its header
+
+    >>> png_size(PNG_SIGNATURE + '\\0\\0\\0\\x0dIHDR' +
+    ...          struct.pack('>II', 640, 480) + '\\x08\\x06\\0\\0\\0')
+    (640, 480)
+    """
+    if data[:8] != PNG_SIGNATURE or data[12:16] != 'IHDR':
+        raise ValueError('Not a PNG file')
+    return struct.unpack('>II', data[16:24])
+
+
+class CompressedCel (object):
+    """PNG data of a cel and where it goes in the document"""
+
+    def __init__(self, data, x, y):
+        object.__init__(self)
+        self.data = data
+        self.x = x
+        self.y = y
+        w, h = png_size(data)
+        # tile aligned, like the bbox of the decoded surface
+        tx0, ty0 = x // N, y // N
+        tx1, ty1 = (x+w-1) // N, (y+h-1) // N
+        self.bbox = helpers.Rect(tx0*N, ty0*N, (tx1-tx0+1)*N, (ty1-ty0+1)*N)
+
+
+class CelStore (object):
+    """Keeps cels as compressed PNG data until their pixels are needed
+
+    Layers added to the store are empty until their surface is first
+    accessed: showing, exporting or painting the cel decodes it
+    (see `Layer.deferred_load`).  Decoded cels are kept under a memory
+    budget, the least recently used ones are dropped back to their PNG
+    data when it is exceeded.  Each access to the surface of a decoded
+    cel makes it the most recently used one (see `touch()`).
+
+    A cel that is changed after decoding no longer matches its PNG data,
+    so it leaves the store and stays decoded like any other layer.  Cels
+    for which `pinned` returns True (visible ones, the current layer)
+    are never dropped.  `decoded` is called with each cel after it is
+    decoded.
+
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.budget = budget
+        self.pinned = lambda layer: False
+        self.decoded = lambda layer: None
+        self._cels = {} # layer: CompressedCel
+        self._decoded = OrderedDict() # layer: bytes, least recent first
+        self._observers = {}
+        self._busy = False
+        self._no_eviction = 0
+        self.decodes = 0
+        self.evictions = 0
+
+    def __contains__(self, layer):
+        return layer in self._cels
+
+    def __len__(self):
+        return len(self._cels)
+
+    @property
+    def nbytes(self):
+        """Memory used by the decoded cels of the store, in bytes"""
+        return sum(self._decoded.itervalues())
+
+    def add(self, layer, data, x, y):
+        """Make an empty layer load the PNG data at (x, y) when needed"""
+        cel = CompressedCel(data, x, y)
+        self._cels[layer] = cel
+        cb = functools.partial(self._layer_modified_cb, layer)
+        layer.content_observers.append(cb)
+        self._observers[layer] = cb
+        self._defer(layer, cel)
+
+    def _defer(self, layer, cel):
+        layer.surface_accessed = None
+        layer.deferred_bbox = cel.bbox
+        layer.deferred_load = self._load
+
+    def touch(self, layer):
+        """Make a decoded cel the most recently used one"""
+        nbytes = self._decoded.pop(layer, None)
+        if nbytes is not None:
+            self._decoded[layer] = nbytes
+
+    def pending_png(self, layer):
+        """Return (data, x, y) if the layer is not decoded, else None"""
+        cel = self._cels.get(layer)
+        if cel is None or layer.deferred_load is None:
+            return None
+        return cel.data, cel.x, cel.y
+
+    def forget(self, layer):
+        """Decode a layer if needed and stop managing it"""
+        if layer not in self._cels:
+            return
+        layer._surface # decodes
+        self._release(layer)
+
+    def _release(self, layer):
+        layer.surface_accessed = None
+        self._decoded.pop(layer, None)
+        del self._cels[layer]
+        cb = self._observers.pop(layer)
+        if cb in layer.content_observers:
+            layer.content_observers.remove(cb)
+
+    def reset(self):
+        """Forget all cels without decoding them, for discarded layers"""
+        for layer in self._cels:
+            layer.deferred_load = None
+            layer.surface_accessed = None
+        self._cels.clear()
+        self._decoded.clear()
+        self._observers.clear()
+
+    def clear(self):
+        """Decode every cel and empty the store"""
+        with self.eviction_suspended():
+            for layer in self._cels.keys():
+                self.forget(layer)
+
+    @contextlib.contextmanager
+    def eviction_suspended(self):
+        """Keep all decoded cels while in the block, e.g. during an export"""
+        self._no_eviction += 1
+        try:
+            yield
+        finally:
+            self._no_eviction -= 1
+        self._evict()
+
+    def _load(self, layer):
+        cel = self._cels[layer]
+        fd, tmp = tempfile.mkstemp('.png', 'mypaint')
+        self._busy = True
+        try:
+            os.write(fd, cel.data)
+            os.close(fd)
+            layer._surface.load_from_png(tmp, cel.x, cel.y)
+        finally:
+            self._busy = False
+            os.remove(tmp)
+        self.decodes += 1
+        self.decoded(layer)
+        tile_bytes = N * N * 4 * 2
+        self._decoded[layer] = len(layer._surface.get_tiles()) * tile_bytes
+        layer.surface_accessed = self.touch
+        self._evict(keep=layer)
+
+    def _layer_modified_cb(self, layer, *args):
+        if self._busy:
+            return
+        # The PNG data is outdated, keep the layer decoded from now on
+        self._release(layer)
+
+    def _evict(self, keep=None):
+        if self._no_eviction:
+            return
+        nbytes = self.nbytes
+        for layer in self._decoded.keys():
+            if nbytes <= self.budget:
+                break
+            if layer is keep or self.pinned(layer):
+                continue
+            nbytes -= self._decoded.pop(layer)
+            self._busy = True
+            try:
+                layer._surface.clear()
+            finally:
+                self._busy = False
+            self._defer(layer, self._cels[layer])
+            self.evictions += 1
+            logger.debug('dropped decoded cel %r, %d bytes decoded',
+                         layer.name, nbytes)
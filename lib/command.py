@@ -6,11 +6,17 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+from collections import deque
+
 import layer
 import helpers
 from gettext import gettext as _
 
 class CommandStack:
+    #: Number of undo steps kept, not counting automatic_undo commands or
+    #: commands without undo_step_counted
+    max_undo_steps = 30
+
     def __init__(self):
         self.call_before_action = []
         self.stack_observers = []
@@ -19,11 +25,13 @@ class CommandStack:
     def __repr__(self):
         return "<CommandStack\n  <Undo len=%d last3=%r>\n" \
                 "  <Redo len=%d last3=%r> >" % (
-                    len(self.undo_stack), self.undo_stack[-3:],
+                    len(self.undo_stack), list(self.undo_stack)[-3:],
                     len(self.redo_stack), self.redo_stack[:3],  )
 
     def clear(self):
-        self.undo_stack = []
+        # deque: old commands are trimmed from the left in O(1)
+        self.undo_stack = deque()
+        self.undo_steps = 0 # counted commands in undo_stack, see _counted()
         self.redo_stack = []
         self.notify_stack_observers()
 
@@ -31,7 +39,7 @@ class CommandStack:
         for f in self.call_before_action: f()
         self.redo_stack = [] # discard
         command.redo()
-        self.undo_stack.append(command)
+        self._push_undo(command)
         self.reduce_undo_history()
         self.notify_stack_observers()
 
@@ -39,6 +47,8 @@ class CommandStack:
         if not self.undo_stack: return
         for f in self.call_before_action: f()
         command = self.undo_stack.pop()
+        if self._counted(command):
+            self.undo_steps -= 1
         command.undo()
         self.redo_stack.append(command)
         self.notify_stack_observers()
@@ -49,20 +59,28 @@ class CommandStack:
         for f in self.call_before_action: f()
         command = self.redo_stack.pop()
         command.redo()
-        self.undo_stack.append(command)
+        self._push_undo(command)
         self.notify_stack_observers()
         return command
 
+    @staticmethod
+    def _counted(command):
+        return command.undo_step_counted and not command.automatic_undo
+
+    def _push_undo(self, command):
+        self.undo_stack.append(command)
+        if self._counted(command):
+            self.undo_steps += 1
+
     def reduce_undo_history(self):
+        """Drop the commands older than the last max_undo_steps steps"""
         stack = self.undo_stack
-        self.undo_stack = []
-        steps = 0
-        for item in reversed(stack):
-            self.undo_stack.insert(0, item)
-            if not item.automatic_undo:
-                steps += 1
-            if steps == 30: # and memory > ...
-                break
+        limit = self.max_undo_steps # and memory > ...
+        while stack and (self.undo_steps > limit or
+                         (self.undo_steps == limit and
+                          not self._counted(stack[0]))):
+            if self._counted(stack.popleft()):
+                self.undo_steps -= 1
 
     def get_last_command(self):
         if not self.undo_stack: return None
@@ -72,6 +90,7 @@ class CommandStack:
         cmd = self.get_last_command()
         if cmd is None:
             return None
+        self.redo_stack = [] # discard, like do()
         cmd.update(**kwargs)
         self.notify_stack_observers() # the display_name may have changed
         return cmd
@@ -89,6 +108,9 @@ class Action:
 
     """
     automatic_undo = False
+    #: False for commands that don't count toward max_undo_steps, like
+    #: frame navigation: they never push real edits out of the history
+    undo_step_counted = True
     display_name = _("Unknown Action")
 
     def __repr__(self):
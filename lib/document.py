@@ -36,6 +36,8 @@ import stroke
 import layer
 import brush
 import animation
+from celstore import CelStore
+from tilestore import TileStore
 
 ## Module constants
 
@@ -83,6 +85,15 @@ class Document():
         self.brush = brush.Brush(brushinfo)
         self.ani = animation.Animation(self)
 
+        #: Load the cels of ORA files only when they are needed
+        self.lazy_cels = False
+        self.cel_store = CelStore()
+        self.cel_store.pinned = self._cel_pinned
+        self.cel_store.decoded = self._cel_decoded
+
+        #: Share identical tiles between layers, see `share_tiles()`
+        self.tile_store = None
+
         self.brush.brushinfo.observers.append(self.brushsettings_changed_cb)
         self.stroke = None
         self.canvas_observers = []  #: See `layer_modified_cb()`
@@ -227,6 +238,7 @@ class Document():
 
     def clear(self, init=False):
         self.split_stroke()
+        self.cel_store.reset()
         self.set_symmetry_axis(None)
         if not init:
             bbox = self.get_bbox()
@@ -253,6 +265,78 @@ class Document():
         return self.layers[self.layer_idx]
     layer = property(get_current_layer)
 
+    def _cel_pinned(self, layer):
+        """Decoded cels that are shown or edited are kept decoded"""
+        if layer.effective_opacity > 0:
+            return True
+        return self.layer_idx is not None and layer is self.layer
+
+    def _cel_decoded(self, layer):
+        self.share_tiles([layer])
+
+
+    def share_tiles(self, layers=None):
+        """Store identical tiles of layers only once
+
+        Does nothing unless `tile_store` is set.  Layers that are not
+        decoded yet are shared when they get decoded.  Returns the number
+        of tiles freed.
+
+        """
+        if self.tile_store is None:
+            return 0
+        if layers is None:
+            layers = self.layers
+        shared = 0
+        for l in layers:
+            if l.deferred_load is None:
+                shared += self.tile_store.share(l._tiled_surface)
+        return shared
+
+
+    def update_mipmaps(self, max_time=None):
+        """Rebuild the dirty mipmaps of the layers, see `update_mipmaps()`
+
+        Layers that are not decoded have no mipmaps to update.  Returns
+        True if some are still dirty after max_time seconds.
+
+        """
+        t0 = time.time()
+        for l in self.layers:
+            if l.deferred_load is not None:
+                continue
+            update = getattr(l._tiled_surface, 'update_mipmaps', None)
+            if update is None:
+                continue # GEGL
+            remaining = None
+            if max_time is not None:
+                remaining = max_time - (time.time() - t0)
+                if remaining <= 0:
+                    return True
+            if update(remaining):
+                return True
+        return False
+
+    def get_tile_stats(self):
+        """Memory figures of the tile sharing, see `TileStore.stats()`
+
+        The figures of the tile buffer pool are under the 'pool' key, those
+        of the compression of cold tiles under 'compression' and those of
+        the tile swap, if any, under 'swap'; see `tiledsurface.TilePool`,
+        `TileCompressor` and `TileSwap`.
+
+        """
+        store = self.tile_store
+        if store is None:
+            store = TileStore()
+        stats = store.stats(l._tiled_surface for l in self.layers)
+        stats['pool'] = tiledsurface.tile_pool.stats()
+        stats['compression'] = tiledsurface.tile_compressor.stats()
+        swap = tiledsurface.tile_compressor.swap
+        if swap is not None:
+            stats['swap'] = swap.stats()
+        return stats
+
 
     def split_stroke(self):
         """Splits the current stroke, announcing the newly stacked stroke
@@ -496,19 +580,17 @@ class Document():
 
         assert dst.shape[-1] == 4
         if dst.dtype == 'uint8':
-            dst_8bit = dst
-            dst = numpy.empty((N, N, 4), dtype='uint16')
-        else:
-            dst_8bit = None
+            with tiledsurface.tile_pool.scratch() as dst_16bit:
+                self.blit_tile_into(dst_16bit, dst_has_alpha, tx, ty,
+                                    mipmap_level, layers, background)
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(dst_16bit, dst)
+            return
 
         background.blit_tile_into(dst, dst_has_alpha, tx, ty, mipmap_level)
 
         for layer in layers:
             layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level)
 
-        if dst_8bit is not None:
-            mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, dst_8bit)
-
     def get_rendered_image_behind_current_layer(self, tx, ty):
         dst = numpy.empty((N, N, 4), dtype='uint16')
         l = self.layers[0:self.layer_idx]
@@ -828,10 +910,15 @@ class Document():
 
         def add_layer(x, y, opac, surface, name, layer_name, visible=True,
                       locked=False, selected=False,
-                      compositeop=DEFAULT_COMPOSITE_OP, rect=[]):
+                      compositeop=DEFAULT_COMPOSITE_OP, rect=[],
+                      png_data=None):
             layer = ET.Element('layer')
             stack.append(layer)
-            store_surface(surface, name, rect)
+            if png_data is not None:
+                # still compressed cel, written as loaded
+                write_file_str(name, png_data)
+            else:
+                store_surface(surface, name, rect)
             a = layer.attrib
             if layer_name:
                 a['name'] = layer_name
@@ -856,12 +943,21 @@ class Document():
             if l.is_empty():
                 continue
             opac = l.opacity
-            x, y, w, h = l.get_bbox()
+            pending = self.cel_store.pending_png(l)
+            if pending is not None:
+                png_data, x, y = pending
+                surface = rect = None
+            else:
+                png_data = None
+                x, y, w, h = l.get_bbox()
+                surface = l._surface
+                rect = (x, y, w, h)
             sel = (idx == self.layer_idx)
-            el = add_layer(x-x0, y-y0, opac, l._surface,
+            el = add_layer(x-x0, y-y0, opac, surface,
                            'data/layer%03d.png' % idx, l.name, l.visible,
                            locked=l.locked, selected=sel,
-                           compositeop=l.compositeop, rect=(x, y, w, h))
+                           compositeop=l.compositeop, rect=rect,
+                           png_data=png_data)
 
             # strokemap
             sio = StringIO()
@@ -871,7 +967,10 @@ class Document():
             el.attrib['mypaint_strokemap_v2'] = name
             write_file_str(name, data)
 
-        ani_data = self.ani.xsheet_as_str()
+        if self.ani.compact_xsheet:
+            ani_data = self.ani.xsheet_as_rle()
+        else:
+            ani_data = self.ani.xsheet_as_str()
         write_file_str('animation.xsheet', ani_data)
 
         # save background as layer (solid color or tiled)
@@ -915,8 +1014,16 @@ class Document():
         if v in ['true', '1']: return True
         else: return False
 
-    def load_ora(self, filename, feedback_cb=None):
-        """Loads from an OpenRaster file"""
+    def load_ora(self, filename, feedback_cb=None, lazy_cels=None):
+        """Loads from an OpenRaster file
+
+        With `lazy_cels` (default: the `lazy_cels` attribute), the layers
+        used as cels by the x-sheet are kept as PNG data in `cel_store`
+        until they are needed.
+
+        """
+        if lazy_cels is None:
+            lazy_cels = self.lazy_cels
         logger.info('load_ora: %r', filename)
         t0 = time.time()
         tempdir = tempfile.mkdtemp('mypaint')
@@ -1000,12 +1107,16 @@ class Document():
             self.add_layer(insert_idx=0, name=name)
             t1 = time.time()
 
-            # extract the png form the zip into a file first
-            # the overhead for doing so seems to be neglegible (around 5%)
-            z.extract(src, tempdir)
-            tmp_filename = join(tempdir, src)
-            self.load_layer_from_png(tmp_filename, x, y, feedback_cb)
-            os.remove(tmp_filename)
+            if lazy_cels:
+                # decoded when needed, see below for non-cel layers
+                self.cel_store.add(self.layers[0], z.read(src), x, y)
+            else:
+                # extract the png form the zip into a file first
+                # the overhead for doing so seems to be neglegible (around 5%)
+                z.extract(src, tempdir)
+                tmp_filename = join(tempdir, src)
+                self.load_layer_from_png(tmp_filename, x, y, feedback_cb)
+                os.remove(tmp_filename)
 
             layer = self.layers[0]
 
@@ -1040,6 +1151,18 @@ class Document():
         except KeyError:
             self.ani.load_xsheet(filename)
 
+        if lazy_cels:
+            # only the cels of the x-sheet stay compressed
+            cels = set(self.ani.frames.get_all_cels())
+            for layer in self.layers:
+                if layer not in cels:
+                    self.cel_store.forget(layer)
+            logger.info('%d cels left compressed', len(self.cel_store))
+
+        if self.tile_store is not None:
+            self.share_tiles()
+            logger.info('Tile sharing: %r', self.get_tile_stats())
+
         if selected_layer is not None:
             for i, layer in zip(range(len(self.layers)), self.layers):
                 if layer is selected_layer:
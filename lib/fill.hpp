@@ -12,6 +12,8 @@
 
 #include "fix15.hpp"
 
+#include <vector>
+
 
 /* Flood fill */
 
@@ -132,6 +134,18 @@ typedef struct {
 } _floodfill_point;
 
 
+static inline void
+_floodfill_overflow(std::vector<_floodfill_point> &overflow,
+                    const unsigned int x,
+                    const unsigned int y)
+{
+    _floodfill_point p;
+    p.x = x;
+    p.y = y;
+    overflow.push_back(p);
+}
+
+
 /* tile_flood_fill:
 
 Flood fill one tile from a sequence of seed positions, and return overflows
@@ -140,6 +154,9 @@ Returns four lists of overflow coordinates denoting on which pixels of the
 next tile to the N, E, S, and W the fill has overflowed. These coordinates
 can be fed back unto tile_flood_fill() for the tile identified.
 
+The GIL is released while filling, so tiles with distinct dst arrays can be
+filled from several Python threads at once.
+
 */
 
 PyObject *
@@ -197,10 +214,12 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
 #ifdef HEAVY_DEBUG
         assert(PySequence_Size(seed_tup) == 2);
 #endif
-        if (! PyArg_ParseTuple(seed_tup, "ii", &x, &y)) {
+        const bool parsed = PyArg_ParseTuple(seed_tup, "ii", &x, &y);
+        Py_XDECREF(seed_tup);
+        if (! parsed) {
+            PyErr_Clear();
             continue;
         }
-        Py_DECREF(seed_tup);
         x = MAX(0, MIN(x, MYPAINT_TILE_SIZE-1));
         y = MAX(0, MIN(y, MYPAINT_TILE_SIZE-1));
         const fix15_short_t *src_pixel = _floodfill_getpixel(src_arr, x, y);
@@ -214,10 +233,10 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
         }
     }
 
-    PyObject *result_n = PyList_New(0);
-    PyObject *result_e = PyList_New(0);
-    PyObject *result_s = PyList_New(0);
-    PyObject *result_w = PyList_New(0);
+    // Overflows to the N, E, S, W; no Python objects from here on
+    std::vector<_floodfill_point> overflows[4];
+
+    Py_BEGIN_ALLOW_THREADS
 
     while (! g_queue_is_empty(queue)) {
         _floodfill_point *pos = (_floodfill_point*) g_queue_pop_head(queue);
@@ -296,12 +315,7 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                 else {
                     // Overflow onto the tile to the North.
                     // Scanlining not possible here: pixel is over the border.
-                    PyObject *s = Py_BuildValue("ii", x, MYPAINT_TILE_SIZE-1);
-                    PyList_Append(result_n, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    _floodfill_overflow(overflows[0], x, MYPAINT_TILE_SIZE-1);
                 }
                 if (y < MYPAINT_TILE_SIZE - 1) {
                     fix15_short_t *src_pixel_below = _floodfill_getpixel(
@@ -334,38 +348,38 @@ tile_flood_fill (PyObject *src, /* readonly HxWx4 array of uint16 */
                 else {
                     // Overflow onto the tile to the South
                     // Scanlining not possible here: pixel is over the border.
-                    PyObject *s = Py_BuildValue("ii", x, 0);
-                    PyList_Append(result_s, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    _floodfill_overflow(overflows[2], x, 0);
                 }
                 // If the fill is now at the west or east extreme, we have
                 // overflowed there too.  Seed West and East tiles.
                 if (x == 0) {
-                    PyObject *s = Py_BuildValue("ii", MYPAINT_TILE_SIZE-1, y);
-                    PyList_Append(result_w, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    _floodfill_overflow(overflows[3], MYPAINT_TILE_SIZE-1, y);
                 }
                 else if (x == MYPAINT_TILE_SIZE-1) {
-                    PyObject *s = Py_BuildValue("ii", 0, y);
-                    PyList_Append(result_e, s);
-                    Py_DECREF(s);
-#ifdef HEAVY_DEBUG
-                    assert(s->ob_refcnt == 1);
-#endif
+                    _floodfill_overflow(overflows[1], 0, y);
                 }
             }
         }
     }
 
-    // Clean up working state, and return where the fill has overflowed
-    // into neighbouring tiles.
     g_queue_free(queue);
+
+    Py_END_ALLOW_THREADS
+
+    // Return where the fill has overflowed into neighbouring tiles.
+    PyObject *results[4];
+    for (int i=0; i<4; ++i) {
+        const std::vector<_floodfill_point> &points = overflows[i];
+        results[i] = PyList_New(points.size());
+        for (size_t j=0; j<points.size(); ++j) {
+            PyList_SET_ITEM(results[i], j, Py_BuildValue("ii", points[j].x,
+                                                         points[j].y));
+        }
+    }
+    PyObject *result_n = results[0];
+    PyObject *result_e = results[1];
+    PyObject *result_s = results[2];
+    PyObject *result_w = results[3];
     PyObject *result = Py_BuildValue("[OOOO]", result_n, result_e,
                                                result_s, result_w);
     Py_DECREF(result_n);
@@ -0,0 +1,282 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Cache of flattened animation frames, used for smooth playback."""
+
+import functools
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+
+import mypaintlib
+import tiledsurface
+
+N = tiledsurface.N
+
+#: Default memory budget of the cache, in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+def flatten_tile(buf, layers, background, tx, ty, mipmap_level=0):
+    """Composite (layer, opacity) pairs over the background into buf
+
+    buf is an 8-bit RGBU tile, the layers are ordered bottom to top.
+    """
+    with tiledsurface.tile_pool.scratch() as dst:
+        background.blit_tile_into(dst, False, tx, ty, mipmap_level)
+        for layer, opacity in layers:
+            layer._surface.composite_tile(dst, False, tx, ty,
+                                          mipmap_level=mipmap_level,
+                                          opacity=opacity,
+                                          mode=layer.compositeop)
+        mypaintlib.tile_convert_rgbu16_to_rgbu8(dst, buf)
+
+
+class CachedFrame (object):
+    """Flattened 8-bit tiles of one frame composition.
+
+    The tiles are rendered lazily, only the ones that are actually
+    displayed are stored.
+
+    """
+
+    def __init__(self, layers, background, mipmap_level):
+        object.__init__(self)
+        self.layers = layers
+        self.background = background
+        self.mipmap_level = mipmap_level
+        self.tiles = {}
+        self.nbytes = 0
+
+    def render_tile(self, tx, ty):
+        """Composite and store one tile, returning its RGBU 8-bit buffer"""
+        buf = numpy.empty((N, N, 4), 'uint8')
+        flatten_tile(buf, self.layers, self.background, tx, ty,
+                     self.mipmap_level)
+        self.tiles[(tx, ty)] = buf
+        self.nbytes += buf.nbytes
+        return buf
+
+    def invalidate(self, x, y, w, h):
+        """Drop the tiles touching a model-space rectangle"""
+        if w == 0 and h == 0:
+            dropped = self.tiles.keys()
+        else:
+            # tile coordinates at this frame's mipmap level
+            size = N * 2**self.mipmap_level
+            tx0, ty0 = x // size, y // size
+            tx1, ty1 = (x+w-1) // size, (y+h-1) // size
+            dropped = [(tx, ty) for (tx, ty) in self.tiles
+                       if tx0 <= tx <= tx1 and ty0 <= ty <= ty1]
+        for pos in dropped:
+            self.nbytes -= self.tiles.pop(pos).nbytes
+
+
+class FrameCache (object):
+    """LRU cache of flattened frames under a memory budget.
+
+    Each frame of the x-sheet is flattened once (background, cel and
+    onion skins) at the mipmap level used for display, and is then
+    blitted straight into the render surface during playback.
+
+    Frames are keyed by their composition, so held frames share their
+    buffers. Only the frames containing a layer whose content changed are
+    invalidated, and only in the damaged area.  A change of the
+    background surface invalidates every frame drawn over it.
+
+    """
+
+    def __init__(self, doc, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.doc = doc
+        self.budget = budget
+        self._frames = OrderedDict() # least recently used first
+        self._keys_by_layer = {}
+        self._layer_observers = {}
+        self._background = None
+        self._background_observer = None
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Tiles shown when drawing the last frame, for prefetch()
+        self._view_mipmap_level = None
+        self._view_idx = None
+        self._view_tiles = set()
+
+    @property
+    def nbytes(self):
+        """Memory used by the cached tiles, in bytes"""
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._frames)
+
+    def clear(self):
+        """Drop every cached frame and stop observing layers"""
+        for layer, cb in self._layer_observers.iteritems():
+            if cb in layer.content_observers:
+                layer.content_observers.remove(cb)
+        self._layer_observers = {}
+        self._keys_by_layer = {}
+        self._observe_background(None)
+        self._frames.clear()
+        self._nbytes = 0
+        self._view_mipmap_level = None
+        self._view_idx = None
+        self._view_tiles = set()
+
+    def get_frame(self, idx, mipmap_level=0, use_lightbox=False):
+        """Return the (possibly empty) CachedFrame for the nth frame"""
+        layers = self.doc.ani.get_frame_layers(idx, use_lightbox)
+        background = self.doc.background
+        self._observe_background(background)
+        key = (mipmap_level, id(background),
+               tuple((id(l), opa, l.compositeop) for l, opa in layers))
+        frame = self._frames.pop(key, None)
+        if frame is None:
+            frame = CachedFrame(layers, background, mipmap_level)
+            for layer, opacity in layers:
+                self._observe(layer)
+                self._keys_by_layer.setdefault(layer, set()).add(key)
+        self._frames[key] = frame
+        return frame
+
+    def render_into(self, surface, tiles, mipmap_level, idx,
+                    use_lightbox=False, coarse_levels=0):
+        """Blit the flattened nth frame into a pixbufsurface.Surface
+
+        This is the playback replacement for `Document.render_into()`.
+        Missing tiles are rendered and kept for the next time the frame is
+        shown.
+
+        With `coarse_levels`, the frame is flattened that many mipmap
+        levels below the display and scaled up, which is 4 times cheaper
+        per level.  Used to keep up with scrubbing.
+
+        """
+        level = min(mipmap_level + coarse_levels, tiledsurface.MAX_MIPMAP_LEVEL)
+        if level != mipmap_level:
+            self._render_coarse(surface, tiles, mipmap_level, level, idx,
+                                use_lightbox)
+            return
+        if (idx, mipmap_level) != (self._view_idx, self._view_mipmap_level):
+            # a new pass over the view: forget the tiles of the last one
+            self._view_idx = idx
+            self._view_mipmap_level = mipmap_level
+            self._view_tiles = set()
+        self._view_tiles.update(tiles)
+        frame = self.get_frame(idx, mipmap_level, use_lightbox)
+        for tx, ty in tiles:
+            buf = frame.tiles.get((tx, ty))
+            if buf is None:
+                self.misses += 1
+                buf = self._render_tile(frame, tx, ty)
+            else:
+                self.hits += 1
+            with surface.tile_request(tx, ty, readonly=False) as dst:
+                dst[:] = buf
+        self._evict()
+
+    def _render_coarse(self, surface, tiles, mipmap_level, level, idx,
+                       use_lightbox):
+        frame = self.get_frame(idx, level, use_lightbox)
+        scale = 2**(level - mipmap_level)
+        n = N // scale
+        for tx, ty in tiles:
+            ctx, cty = tx // scale, ty // scale
+            buf = frame.tiles.get((ctx, cty))
+            if buf is None:
+                self.misses += 1
+                buf = self._render_tile(frame, ctx, cty)
+            else:
+                self.hits += 1
+            x0 = (tx - ctx*scale) * n
+            y0 = (ty - cty*scale) * n
+            part = buf[y0:y0+n, x0:x0+n]
+            with surface.tile_request(tx, ty, readonly=False) as dst:
+                dst[:] = part.repeat(scale, axis=0).repeat(scale, axis=1)
+        self._evict()
+
+    def prefetch(self, idx, use_lightbox=False, max_tiles=16):
+        """Render some missing tiles of a frame that will be shown soon
+
+        Only the tiles last shown by `render_into()` are rendered, at most
+        `max_tiles` per call.  Returns True while tiles remain missing, so
+        it can be used as an idle callback.
+
+        """
+        if self._view_mipmap_level is None:
+            return False
+        frame = self.get_frame(idx, self._view_mipmap_level, use_lightbox)
+        missing = [t for t in self._view_tiles if t not in frame.tiles]
+        for tx, ty in missing[:max_tiles]:
+            self._render_tile(frame, tx, ty)
+        self._evict()
+        return len(missing) > max_tiles
+
+    def _render_tile(self, frame, tx, ty):
+        buf = frame.render_tile(tx, ty)
+        self._nbytes += buf.nbytes
+        return buf
+
+    def _invalidate(self, frame, x, y, w, h):
+        nbytes = frame.nbytes
+        frame.invalidate(x, y, w, h)
+        self._nbytes -= nbytes - frame.nbytes
+
+    def _observe(self, layer):
+        if layer in self._layer_observers:
+            return
+        cb = functools.partial(self._layer_modified_cb, layer)
+        layer.content_observers.append(cb)
+        self._layer_observers[layer] = cb
+
+    def _layer_modified_cb(self, layer, x, y, w, h):
+        for key in self._keys_by_layer.get(layer, ()):
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._invalidate(frame, x, y, w, h)
+
+    def _observe_background(self, background):
+        if background is self._background:
+            return
+        if self._background is not None:
+            observers = self._background.observers
+            if self._background_observer in observers:
+                observers.remove(self._background_observer)
+        self._background = background
+        self._background_observer = None
+        if background is not None:
+            cb = functools.partial(self._background_modified_cb, background)
+            background.observers.append(cb)
+            self._background_observer = cb
+
+    def _background_modified_cb(self, background, *args):
+        # the background repeats, so any change can show anywhere
+        for frame in self._frames.itervalues():
+            if frame.background is background:
+                self._invalidate(frame, 0, 0, 0, 0)
+
+    def _evict(self):
+        """Drop least recently used frames until under budget"""
+        while self._nbytes > self.budget and len(self._frames) > 1:
+            key, frame = self._frames.popitem(last=False)
+            self._nbytes -= frame.nbytes
+            for layer, opacity in frame.layers:
+                keys = self._keys_by_layer.get(layer)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_layer[layer]
+                    cb = self._layer_observers.pop(layer)
+                    if cb in layer.content_observers:
+                        layer.content_observers.remove(cb)
+            logger.debug('evicted frame, %d bytes cached', self._nbytes)
@@ -6,6 +6,8 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+from bisect import bisect_left, bisect_right
+
 DEFAULT_OPACITIES = {
     'cel': 1./2, # The inmediate next and previous cels
     'key': 1./2, # The cel keys that are after and before the current cel 
@@ -28,11 +30,42 @@ DEFAULT_NEXTPREV = {
 }
 
 class Frame(object):
+    # long x-sheets have many thousands of frames
+    __slots__ = ('_frames', '_is_key', '_cel', '_skip_visible', 'description')
+
     def __init__(self, is_key=False, cel=None):
+        # The FrameList this frame belongs to, notified of changes so
+        # it can keep its index up to date:
+        self._frames = None
         self.is_key = is_key
         self.description = ""
         self.cel = cel
         self.skip_visible = False
+
+    def _changed(self):
+        if self._frames is not None:
+            self._frames._frame_changed(self)
+
+    def _get_is_key(self):
+        return self._is_key
+    def _set_is_key(self, is_key):
+        self._is_key = is_key
+        self._changed()
+    is_key = property(_get_is_key, _set_is_key)
+
+    def _get_cel(self):
+        return self._cel
+    def _set_cel(self, cel):
+        self._cel = cel
+        self._changed()
+    cel = property(_get_cel, _set_cel)
+
+    def _get_skip_visible(self):
+        return self._skip_visible
+    def _set_skip_visible(self, skip_visible):
+        self._skip_visible = skip_visible
+        self._changed()
+    skip_visible = property(_get_skip_visible, _set_skip_visible)
     
     def set_key(self):
         self.is_key = True
@@ -56,11 +89,30 @@ class Frame(object):
 class FrameList(list):
     """
     The list of frames that constitutes an animation.
+
+    Lookups of cels and keys go through sorted lists of the positions
+    of keys, cels, skipped cels and cel runs (frames whose cel differs
+    from the previous cel), so they are O(log n) instead of scanning the
+    list.  Inserting or removing frames shifts the positions after the
+    change in place, and a frame changing its key, cel or skip flags
+    updates its own entries.  The lightbox opacities of each frame are
+    kept until the frames or the lightbox settings change.
     
     """
     def __init__(self, length, opacities=None, active_cels=None, nextprev=None):
-        self.append_frames(length)
+        # Goes up on any change that can alter the lightbox opacities:
+        self.generation = 0
+        self._positions = None # frame: position, rebuilt when needed
+        self._key_positions = []
+        self._cel_positions = []
+        self._skip_positions = []
+        self._run_positions = []
+        self._opacities = {} # idx: result of get_opacities()
+        self._opacities_generation = None
+        self._cel_set = None
+        self._cel_set_generation = None
         self.idx = 0
+        self.append_frames(length)
         if opacities is None:
             opacities = {}
         self.opacities = dict(DEFAULT_OPACITIES)
@@ -85,16 +137,129 @@ class FrameList(list):
         self.converted_opacities = {}
         for k, v in self.opacities.items():
             self.converted_opacities[k] = v * factor
+        self.generation += 1
 
     def setup_active_cels(self, active_cels):
         self.active_cels.update(active_cels)
+        self.generation += 1
     
     def setup_nextprev(self, nextprev):
         self.nextprev.update(nextprev)
+        self.generation += 1
+
+    ## Index of frame positions
+
+    def _ensure_positions(self):
+        """
+        Rebuild the frame to position map if frames were inserted or
+        removed.
+
+        """
+        if self._positions is not None:
+            return
+        self._positions = {}
+        for n, f in enumerate(self):
+            self._positions[f] = n
+
+    def _position_of(self, frame):
+        if 0 <= self.idx < len(self) and self[self.idx] is frame:
+            return self.idx # usually the edited frame is the selected one
+        return self.index(frame)
+
+    def _index_frame(self, n):
+        f = self[n]
+        _update_sorted(self._key_positions, n,
+                       f.is_key and not f.skip_visible)
+        _update_sorted(self._cel_positions, n, f.cel is not None)
+        _update_sorted(self._skip_positions, n,
+                       f.cel is not None and f.skip_visible)
+
+    def _next_cel_position(self, n):
+        cels = self._cel_positions
+        i = bisect_right(cels, n)
+        if i < len(cels):
+            return cels[i]
+        return None
+
+    def _update_run(self, n):
+        """
+        Check if the frame at n starts a run of its cel.
+
+        """
+        if n is None:
+            return
+        cels = self._cel_positions
+        i = bisect_left(cels, n)
+        starts = i < len(cels) and cels[i] == n
+        if starts and i > 0:
+            starts = self[cels[i-1]].cel != self[n].cel
+        _update_sorted(self._run_positions, n, starts)
+
+    def _frame_changed(self, frame):
+        self.generation += 1
+        n = self._position_of(frame)
+        self._index_frame(n)
+        self._update_run(n)
+        self._update_run(self._next_cel_position(n))
+
+    def _frames_inserted(self, start, count):
+        self._positions = None
+        self.generation += 1
+        for positions in (self._key_positions, self._cel_positions,
+                          self._skip_positions, self._run_positions):
+            i = bisect_left(positions, start)
+            positions[i:] = [n + count for n in positions[i:]]
+        for n in xrange(start, start+count):
+            self._index_frame(n)
+        cels = self._cel_positions
+        for n in cels[bisect_left(cels, start):bisect_left(cels, start+count)]:
+            self._update_run(n)
+        self._update_run(self._next_cel_position(start+count-1))
+
+    def _frames_removed(self, start, count):
+        self._positions = None
+        self.generation += 1
+        for positions in (self._key_positions, self._cel_positions,
+                          self._skip_positions, self._run_positions):
+            i = bisect_left(positions, start)
+            j = bisect_left(positions, start+count)
+            positions[i:] = [n - count for n in positions[j:]]
+        self._update_run(self._next_cel_position(start-1))
+
+    def _attach(self, frame):
+        frame._frames = self
+        return frame
+
+    def _detach(self, frame):
+        frame._frames = None
+        return frame
+
+    def index(self, frame):
+        """
+        Return the position of the frame in the list.
+
+        """
+        self._ensure_positions()
+        try:
+            return self._positions[frame]
+        except KeyError:
+            raise ValueError("Frame is not in the list.")
+
+    def _cels_between(self, start, end):
+        """
+        Return the frames with a cel in the range [start, end).
+
+        """
+        cels = self._cel_positions
+        return [self[n] for n in
+                cels[bisect_left(cels, start):bisect_left(cels, end)]]
+
+    ## Structural changes
 
     def append_frames(self, length):
-        for l in range(length):
-            self.append(Frame())
+        start = len(self)
+        self.extend([self._attach(Frame()) for l in xrange(length)])
+        self._frames_inserted(start, length)
     
     def frames_to_remove(self, length, at_end=False):
         """
@@ -112,26 +277,33 @@ class FrameList(list):
         """
         Remove frames from the current position or from the end.
         """
-        removed = []
         if at_end:
             idx = len(self) - 1
         else:
             idx = self.idx
         if idx + length > len(self):
             length = len(self) - idx
-        for l in range(length):
-            removed.append(self.pop(idx))
+        # one block operation, not a pop() per frame
+        removed = list(self[idx:idx+length])
+        del self[idx:idx+length]
+        for f in removed:
+            self._detach(f)
         if self.idx > len(self) - 1:
             self.idx = len(self) - 1
+        self._frames_removed(idx, len(removed))
         return removed
 
     def insert_frames(self, frames):
-        for f in frames:
-            self.insert(self.idx, f)
+        # same order as inserting them one by one at the selected frame
+        self[self.idx:self.idx] = [self._attach(f) for f in reversed(frames)]
+        self._frames_inserted(self.idx, len(frames))
 
     def insert_empty_frames(self, length):
-        for l in range(length):
-            self.insert(self.idx, Frame())
+        self[self.idx:self.idx] = [self._attach(Frame())
+                                   for l in xrange(length)]
+        self._frames_inserted(self.idx, length)
+
+    ## Navigation
     
     def get_selected(self):
         return self[self.idx]
@@ -176,54 +348,61 @@ class FrameList(list):
         if self.idx == 0:
             return False
         return True
+
+    def _get_next_key_idx(self):
+        keys = self._key_positions
+        i = bisect_right(keys, self.idx)
+        if i < len(keys):
+            return keys[i]
+        return None
+
+    def _get_previous_key_idx(self):
+        keys = self._key_positions
+        i = bisect_left(keys, self.idx)
+        if i > 0:
+            return keys[i-1]
+        return None
     
     def get_next_key(self):
-        for f in (self[self.idx+1:]):
-            if f.is_key and not f.skip_visible:
-                return f
-        return None
+        n = self._get_next_key_idx()
+        if n is None:
+            return None
+        return self[n]
     
     def get_previous_key(self):
-        for f in reversed(self[:self.idx]):
-            if f.is_key and not f.skip_visible:
-                return f
-        return None
+        n = self._get_previous_key_idx()
+        if n is None:
+            return None
+        return self[n]
     
     def goto_next_key(self):
-        f = self.get_next_key()
-        if f is None:
+        n = self._get_next_key_idx()
+        if n is None:
             raise IndexError("Trying to go to inexistent next keyframe.")
-        self.idx = self.index(f)
+        self.idx = n
     
     def goto_previous_key(self):
-        f = self.get_previous_key()
-        if f is None:
+        n = self._get_previous_key_idx()
+        if n is None:
             raise IndexError("Trying to go to inexistent previous keyframe.")
-        self.idx = self.index(f)
+        self.idx = n
     
     def has_next_key(self):
-        f = self.get_next_key()
-        if f is None:
-            return False
-        return True
+        return self._get_next_key_idx() is not None
     
     def has_previous_key(self):
-        f = self.get_previous_key()
-        if f is None:
-            return False
-        return True
+        return self._get_previous_key_idx() is not None
     
     def cel_at(self, n):
         """
         Return the cel at the nth frame.
         
         """
-        if self[n].cel is not None:
-            return self[n].cel
-        for f in reversed(self[:n]):
-            if f.cel is not None:
-                return f.cel
-        return None
+        cels = self._cel_positions
+        i = bisect_right(cels, n)
+        if i == 0:
+            return None
+        return self[cels[i-1]].cel
     
     def get_previous_cel(self):
         """
@@ -249,11 +428,34 @@ class FrameList(list):
 
     def get_all_cels(self):
         cels = []
-        for f in self:
-            if f.cel is not None and f.cel not in cels:
+        seen = set()
+        for f in self._cels_between(0, len(self)):
+            if f.cel not in seen:
+                seen.add(f.cel)
                 cels.append(f.cel)
         return cels
 
+    def get_cel_set(self):
+        """
+        Return the cels of all frames as a frozenset.
+
+        The set is kept until the frames change.
+
+        """
+        if self._cel_set_generation != self.generation:
+            self._cel_set = frozenset(self.get_all_cels())
+            self._cel_set_generation = self.generation
+        return self._cel_set
+
+    def get_cels_after(self, n):
+        """
+        Return the set of cels shown after the nth frame and not before.
+
+        """
+        before = set(f.cel for f in self._cels_between(0, n+1))
+        return set(f.cel for f in self._cels_between(n+1, len(self))
+                   if f.cel not in before)
+
     def _get_previous_frame_with_cel(self):
         """
         Return the previous frame with a cel that is different than
@@ -263,8 +465,19 @@ class FrameList(list):
         cur_cel = self.cel_at(self.idx)
         if not cur_cel:
             return None
-        for f in reversed(self[:self.idx]):
-            if f.cel is not None and f.cel != cur_cel and not f.skip_visible:
+        cels = self._cel_positions
+        runs = self._run_positions
+        # the cel frame just before the run of the current cel
+        run_start = runs[bisect_right(runs, self.idx) - 1]
+        i = bisect_left(cels, run_start)
+        if i == 0:
+            return None
+        f = self[cels[i-1]]
+        if not f.skip_visible:
+            return f
+        for n in reversed(cels[:i-1]):
+            f = self[n]
+            if f.cel != cur_cel and not f.skip_visible:
                 return f
         return None
     
@@ -277,8 +490,18 @@ class FrameList(list):
         cur_cel = self.cel_at(self.idx)
         if not cur_cel:
             return None
-        for f in (self[self.idx+1:]):
-            if f.cel is not None and f.cel != cur_cel and not f.skip_visible:
+        cels = self._cel_positions
+        runs = self._run_positions
+        # the start of the next run
+        i = bisect_right(runs, self.idx)
+        if i == len(runs):
+            return None
+        f = self[runs[i]]
+        if not f.skip_visible:
+            return f
+        for n in cels[bisect_right(cels, runs[i]):]:
+            f = self[n]
+            if f.cel != cur_cel and not f.skip_visible:
                 return f
         return None
     
@@ -293,7 +516,7 @@ class FrameList(list):
         """
         return self.cel_at(self.index(frame))
     
-    def get_opacities(self):
+    def get_opacities(self, idx=None):
         """
         Return a map of cels and the opacity they should have.
 
@@ -301,7 +524,30 @@ class FrameList(list):
         opaque, and she may want to see the neighbour cels
         transparented.
 
+        If idx is given, the opacities are calculated as if the nth
+        frame was the selected one.
+
+        The result is kept until the frames or the lightbox settings
+        change, and is shared between callers: don't modify it.
+
         """
+        if idx is None:
+            idx = self.idx
+        if self._opacities_generation != self.generation:
+            self._opacities = {}
+            self._opacities_generation = self.generation
+        result = self._opacities.get(idx)
+        if result is None:
+            selected_idx = self.idx
+            self.idx = idx
+            try:
+                result = self._calculate_opacities()
+            finally:
+                self.idx = selected_idx
+            self._opacities[idx] = result
+        return result
+
+    def _calculate_opacities(self):
         opacities = {}
 
         def get_opa(nextprev, c):
@@ -311,72 +557,64 @@ class FrameList(list):
             return 0
 
         # explicit skip of cels:
-        for frame in self:
-            if frame.skip_visible:
-                opacities[frame.cel] = 0
+        for n in self._skip_positions:
+            opacities[self[n].cel] = 0
 
         # current cel, always full opacity:
-        cel = self.cel_for_frame(self.get_selected())
+        cel = self.cel_at(self.idx)
         if cel:
             opacities[cel] = 1
 
         # next:
         cel = self.get_previous_cel()
-        if cel and cel not in opacities.keys():
+        if cel and cel not in opacities:
             opacities[cel] = get_opa('previous', 'cel')
 
         # previous:
         cel = self.get_next_cel()
-        if cel and cel not in opacities.keys():
+        if cel and cel not in opacities:
             opacities[cel] = get_opa('next', 'cel')
 
         # previous key:
-        prevkey_idx = 0
-        if self.has_previous_key():
-            prevkey = self.get_previous_key()
-            prevkey_idx = self.index(prevkey)
-            cel = self.cel_for_frame(prevkey)
-            if cel and cel not in opacities.keys():
+        prevkey_idx = self._get_previous_key_idx()
+        if prevkey_idx is None:
+            prevkey_idx = 0
+        else:
+            cel = self.cel_at(prevkey_idx)
+            if cel and cel not in opacities:
                 opacities[cel] = get_opa('previous', 'key')
         
         # next key:
-        nextkey_idx = len(self)-1
-        if self.has_next_key():
-            nextkey = self.get_next_key()
-            nextkey_idx = self.index(nextkey)
-            cel = self.cel_for_frame(nextkey)
-            if cel and cel not in opacities.keys():
+        nextkey_idx = self._get_next_key_idx()
+        if nextkey_idx is None:
+            nextkey_idx = len(self)-1
+        else:
+            cel = self.cel_at(nextkey_idx)
+            if cel and cel not in opacities:
                 opacities[cel] = get_opa('next', 'key')
         
-        def has_cel(f):
-            return f.cel is not None
-        
         # inbetweens:
-        next_inbetweens_range = self[self.idx:nextkey_idx]
-        for frame in filter(has_cel, next_inbetweens_range):
+        for frame in self._cels_between(self.idx, nextkey_idx):
             cel = frame.cel
-            if cel not in opacities.keys():
+            if cel not in opacities:
                 opacities[cel] = get_opa('next', 'inbetweens')
-        prev_inbetweens_range = self[prevkey_idx:self.idx]
-        for frame in filter(has_cel, prev_inbetweens_range):
+        for frame in self._cels_between(prevkey_idx, self.idx):
             cel = frame.cel
-            if cel not in opacities.keys():
+            if cel not in opacities:
                 opacities[cel] = get_opa('previous', 'inbetweens')
         
         # frames outside inmediate keys:
-        next_outside_range = self[nextkey_idx:]
-        for frame in filter(has_cel, next_outside_range):
+        for frame in self._cels_between(nextkey_idx, len(self)):
             cel = frame.cel
-            if cel not in opacities.keys():
+            if cel not in opacities:
                 if frame.is_key:
                     opacities[cel] = get_opa('next', 'other keys')
                 else:
                     opacities[cel] = get_opa('next', 'other')
 
-        prev_outside_range = self[:prevkey_idx]
-        for frame in filter(has_cel, prev_outside_range):
+        for frame in self._cels_between(0, prevkey_idx):
             cel = frame.cel
-            if cel not in opacities.keys():
+            if cel not in opacities:
                 if frame.is_key:
                     opacities[cel] = get_opa('previous', 'other keys')
                 else:
@@ -393,11 +631,89 @@ class FrameList(list):
 
     def count_cel(self, item):
         count = 0
-        for f in self:
-            if f.cel and f.cel == item:
+        for f in self._cels_between(0, len(self)):
+            if f.cel == item:
                 count += 1
         return count
 
+
+class LightboxSchedule(object):
+    """
+    The lightbox opacities of every frame, as changes between frames.
+
+    Stepping from a frame to the next one during playback only has to
+    apply the few cels whose opacity or visibility differs, instead of
+    computing get_opacities() again.  The schedule is rebuilt when the
+    frame list or its lightbox settings change (see `generation`).
+
+    """
+    #: Largest jump between frames still done with the changes in between
+    MAX_STEPS = 8
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.generation = None
+        self._changes = []
+
+    def _rebuild(self):
+        frames = self.frames
+        self._changes = []
+        first = prev = None
+        for idx in xrange(len(frames)):
+            opacities, visible = frames.get_opacities(idx)
+            state = dict((cel, (opa, visible[cel]))
+                         for cel, opa in opacities.iteritems()
+                         if cel is not None)
+            if prev is None:
+                first = state
+            else:
+                self._changes.append(_state_changes(prev, state))
+            prev = state
+        if prev is not None:
+            # looping back to the first frame
+            self._changes.insert(0, _state_changes(prev, first))
+        self.generation = frames.generation
+
+    def changes(self, prev_idx, idx):
+        """
+        Return (cel, opacity, visible) for the cels that change when going
+        from frame prev_idx to frame idx, or None if they are too far apart.
+
+        """
+        if self.generation != self.frames.generation:
+            self._rebuild()
+        count = len(self._changes)
+        if count == 0:
+            return []
+        steps = (idx - prev_idx) % count
+        if steps > self.MAX_STEPS:
+            return None
+        if steps == 1:
+            return self._changes[idx]
+        merged = {}
+        for n in xrange(1, steps+1):
+            for cel, opa, vis in self._changes[(prev_idx + n) % count]:
+                merged[cel] = (opa, vis)
+        return [(cel, opa, vis) for cel, (opa, vis) in merged.iteritems()]
+
+
+def _state_changes(before, after):
+    return [(cel, opa, vis) for cel, (opa, vis) in after.iteritems()
+            if before.get(cel) != (opa, vis)]
+
+
+def _update_sorted(positions, n, present):
+    """
+    Add or remove n from a sorted list of positions.
+
+    """
+    i = bisect_left(positions, n)
+    found = i < len(positions) and positions[i] == n
+    if present and not found:
+        positions.insert(i, n)
+    elif found and not present:
+        del positions[i]
+
 def print_list(frames):
     """
     Utility funtion for debugging.
@@ -713,6 +1029,19 @@ True
 >>> frames.idx
 3
 
+Frames are inserted in the order they would have if inserted one by
+one at the selected frame:
+
+>>> frames = FrameList(2)
+>>> frames.insert_frames([Frame(cel='x'), Frame(cel='y')])
+>>> [f.cel for f in frames]
+['y', 'x', None, None]
+
+Frames have no instance dictionary, long x-sheets stay compact:
+
+>>> hasattr(frames[0], '__dict__')
+False
+
 Count cels occurrencies
 -----------------------
 
@@ -729,6 +1058,65 @@ Count cels occurrencies
 >>> frames.count_cel('qwe')
 0
 
+Keeping the index up to date
+----------------------------
+
+>>> frames = FrameList(6)
+>>> frames[1].add_cel('a')
+>>> frames[4].add_cel('b')
+>>> frames[4].set_key()
+>>> frames.cel_at(3), frames.cel_at(5)
+('a', 'b')
+
+>>> frames.select(2)
+>>> frames.insert_empty_frames(2)
+>>> frames.cel_at(5), frames.cel_at(6)
+('a', 'b')
+
+>>> frames.index(frames.get_next_key())
+6
+
+>>> frames[6].remove_cel()
+>>> frames.cel_at(7)
+'a'
+
+>>> frames[6].toggle_key()
+>>> frames.has_next_key()
+False
+
+>>> rem = frames.remove_frames(2)
+>>> frames.index(rem[0])
+Traceback (most recent call last):
+ValueError: Frame is not in the list.
+
+>>> rem[0].add_cel('c')
+>>> frames.insert_frames(rem)
+>>> frames.get_all_cels()
+['a', 'c']
+
+Inserting and removing frames shifts the positions after them, frames
+holding the same cel make one run:
+
+>>> frames = FrameList(5)
+>>> frames[0].add_cel('a')
+>>> frames[1].add_cel('a')
+>>> frames[3].add_cel('b')
+>>> frames._cel_positions, frames._run_positions
+([0, 1, 3], [0, 3])
+
+>>> frames.select(2)
+>>> frames.insert_empty_frames(2)
+>>> frames._cel_positions, frames._run_positions
+([0, 1, 5], [0, 5])
+
+>>> frames.get_next_cel()
+'b'
+
+>>> frames.select(0)
+>>> rem = frames.remove_frames(2)
+>>> frames._cel_positions, frames._run_positions
+([3], [3])
+
 Frames that are not considered for onion-skin
 ---------------------------------------------
 
@@ -765,6 +1153,37 @@ True
 >>> set(frames.get_opacities()[1].items()) == set([('a', False), ('b', True), ('c', False)])
 True
 
+Lightbox schedule
+-----------------
+
+>>> frames = FrameList(6)
+>>> frames[0].add_cel('a')
+>>> frames[2].add_cel('b')
+>>> frames[4].add_cel('c')
+>>> schedule = LightboxSchedule(frames)
+
+Each step gives what get_opacities() would change:
+
+>>> def apply_changes(state, changes):
+...     for cel, opa, vis in changes:
+...         state[cel] = opa
+>>> state = frames.get_opacities(0)[0]
+>>> for idx in [1, 2, 3, 4, 5, 0, 3]:
+...     apply_changes(state, schedule.changes(frames.idx, idx))
+...     frames.select(idx)
+...     assert state == frames.get_opacities()[0], idx
+>>> schedule.changes(2, 3)
+[]
+
+Editing the frames rebuilds it:
+
+>>> frames[3].add_cel('d')
+>>> frames.select(2)
+>>> ('d', 1, True) in schedule.changes(2, 3)
+True
+>>> schedule.generation == frames.generation
+True
+
 """)
 
 import doctest
@@ -92,6 +92,44 @@ class Rect (object):
     def __repr__(self):
         return 'Rect(%d, %d, %d, %d)' % (self.x, self.y, self.w, self.h)
 
+class Region (object):
+    """A union of rectangles, for coalescing redraws.
+
+    Overlapping rectangles are merged into their bounding box as they are
+    added, so each area is redrawn only once. Empty rectangles are ignored.
+
+      >>> region = Region()
+      >>> region.add(Rect(0, 0, 10, 10))
+      >>> region.add(Rect(5, 5, 10, 10))
+      >>> region.add(Rect(100, 0, 10, 10))
+      >>> region.add(Rect(0, 0, 0, 0))
+      >>> list(region)
+      [Rect(0, 0, 15, 15), Rect(100, 0, 10, 10)]
+      >>> region.add(Rect(10, 0, 95, 5))
+      >>> list(region)
+      [Rect(0, 0, 110, 15)]
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.rects = []
+    def __iter__(self):
+        return iter(self.rects)
+    def __len__(self):
+        return len(self.rects)
+    def add(self, rect):
+        if rect.empty(): return
+        rect = rect.copy()
+        merged = True
+        while merged:
+            merged = False
+            for other in self.rects:
+                if rect.overlaps(other):
+                    self.rects.remove(other)
+                    rect.expandToIncludeRect(other)
+                    merged = True
+                    break
+        self.rects.append(rect)
+
 def rotated_rectangle_bbox(corners):
     list_y = [y for (x, y) in corners]
     list_x = [x for (x, y) in corners]
@@ -77,6 +77,13 @@ class Layer (object):
     def __init__(self, name="", compositeop=DEFAULT_COMPOSITE_OP):
         object.__init__(self)
         self._surface = tiledsurface.Surface()
+        #: Called with the layer on first access to its surface, see
+        #: `lib.celstore.CelStore`.  The bbox is known before that.
+        self.deferred_load = None
+        self.deferred_bbox = None
+        #: Called with the layer on each access to its decoded surface,
+        #: see `lib.celstore.CelStore.touch()`.
+        self.surface_accessed = None
         self.opacity = 1.0
         self.name = name
         self.visible = True
@@ -97,6 +104,20 @@ class Layer (object):
         for f in self.content_observers:
             f(*args)
 
+    def _get_surface(self):
+        if self.deferred_load is not None:
+            load = self.deferred_load
+            self.deferred_load = None
+            load(self)
+        elif self.surface_accessed is not None:
+            self.surface_accessed(self)
+        return self._tiled_surface
+
+    def _set_surface(self, surface):
+        self._tiled_surface = surface
+
+    _surface = property(_get_surface, _set_surface)
+
     def get_effective_opacity(self):
         if self.visible:
             return self.opacity
@@ -108,9 +129,13 @@ class Layer (object):
         return self._surface.get_alpha(x, y, radius)
 
     def get_bbox(self):
+        if self.deferred_load is not None:
+            return self.deferred_bbox.copy()
         return self._surface.get_bbox()
 
     def is_empty(self):
+        if self.deferred_load is not None:
+            return False
         return self._surface.is_empty()
 
     def save_as_png(self, filename, *args, **kwargs):
@@ -270,6 +295,9 @@ class Layer (object):
                 assert False, 'invalid strokemap'
 
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        if self.effective_opacity == 0:
+            # nothing to draw, and no need to decode a deferred layer
+            return
         self._surface.composite_tile(
             dst, dst_has_alpha, tx, ty,
             mipmap_level=mipmap_level,
@@ -346,7 +374,9 @@ class Layer (object):
         return self.strokes[-1]
 
     def set_symmetry_axis(self, center_x):
+        # The state survives loading, so don't decode a deferred layer
+        surface = self._tiled_surface
         if center_x is None:
-            self._surface.set_symmetry_state(False, 0.0)
+            surface.set_symmetry_state(False, 0.0)
         else:
-            self._surface.set_symmetry_state(True, center_x)
+            surface.set_symmetry_state(True, center_x)
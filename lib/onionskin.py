@@ -0,0 +1,282 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Onion skin compositor for the animation lightbox."""
+
+import logging
+from collections import OrderedDict
+logger = logging.getLogger(__name__)
+
+import numpy
+
+import tiledsurface
+from layer import DEFAULT_COMPOSITE_OP
+
+N = tiledsurface.N
+
+
+#: Colors of the cels before and after the current frame, when tinted
+DEFAULT_TINT = ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0))
+
+#: How much of the tint color replaces the color of the cels
+TINT_STRENGTH = 0.5
+
+#: Default memory budget of the composite tiles, in bytes
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+
+def tint_tile(tile, color, strength=TINT_STRENGTH):
+    """Shift the colors of a premultiplied tile towards an RGB color
+
+    The alpha is kept, so the shapes stay the same.
+
+    """
+    alpha = tile[:, :, 3] * strength
+    for i, c in enumerate(color):
+        tile[:, :, i] = tile[:, :, i] * (1.0 - strength) + alpha * c
+
+
+class OnionSkin (object):
+    """Cached composite of the lightbox cels, drawn in place of them
+
+    The neighbour cels and keys shown around the current cel are
+    composited once, with their lightbox opacities, into premultiplied
+    tiles.  Rendering then composites one tile instead of every cel.
+
+    When the selected frame moves, `update()` only drops the tiles of the
+    cels whose opacity changed, the rest of the composite is kept.  The
+    cels stay in the document with their opacities set, so everything
+    that doesn't use the onion skin draws them as before.
+
+    The composite is made per run of onion cels that are adjacent in the
+    layer stack, and each run is drawn where its cels are (see
+    `substitute()`), so the layers stack up as if the cels were drawn
+    one by one.  With a `tint`, the cels shown before the current frame
+    are tinted with its first color, the ones shown after it with the
+    second.
+
+    The composite tiles of all mipmap levels are kept under `budget`
+    bytes, the least recently drawn ones are dropped first.
+
+    """
+
+    def __init__(self, doc, budget=DEFAULT_BUDGET):
+        object.__init__(self)
+        self.doc = doc
+        self.budget = budget
+        self.cels = [] # (cel, opacity) pairs, bottom to top
+        self.next_cels = set() # cels shown after the current frame
+        self.tint = None # (previous color, next color) or None
+        self._runs = set() # tuples of adjacent cels, see substitute()
+        # (run, tx, ty, mipmap_level): tile or None, least recently used first
+        self._tiles = OrderedDict()
+        self._nbytes = 0
+        self._layer_observers = {}
+
+    @property
+    def nbytes(self):
+        """Memory used by the composite tiles, in bytes"""
+        return self._nbytes
+
+    def clear(self):
+        """Forget the cels and the composite"""
+        self.next_cels = set()
+        self._set_cels([])
+
+    def update(self, opacities, current_cel=None, next_cels=()):
+        """Show cels with new opacities
+
+        :param opacities: map of cels and their lightbox opacity
+        :param current_cel: the cel drawn at full opacity, not part of the
+            onion skin
+        :param next_cels: the cels shown after the current frame, tinted
+            with the second color of `tint`
+        :returns: the cels that were added, removed or changed opacity
+
+        """
+        next_cels = set(next_cels)
+        cels = [(l, opacities[l]) for l in self.doc.layers
+                if l is not current_cel and opacities.get(l, 0) > 0]
+        old = dict(self.cels)
+        new = dict(cels)
+        changed = [l for l in set(old) | set(new)
+                   if old.get(l) != new.get(l)]
+        if self.tint is not None:
+            changed += [l for l in set(old) & set(new)
+                        if (l in self.next_cels) != (l in next_cels)
+                        and l not in changed]
+        for layer in changed:
+            self.invalidate(*layer.get_bbox())
+        self.next_cels = next_cels
+        self._set_cels(cels)
+        return changed
+
+    def set_tint(self, tint):
+        """Change the tint colors, None for no tint
+
+        :returns: the cels whose colors changed
+
+        """
+        if tint == self.tint:
+            return []
+        self.tint = tint
+        self._clear_tiles()
+        return [l for l, opacity in self.cels]
+
+    def _set_cels(self, cels):
+        layers = set(l for l, opacity in cels)
+        for layer, cb in self._layer_observers.items():
+            if layer not in layers:
+                if cb in layer.content_observers:
+                    layer.content_observers.remove(cb)
+                del self._layer_observers[layer]
+        for layer in layers:
+            if layer not in self._layer_observers:
+                cb = self._layer_modified_cb
+                layer.content_observers.append(cb)
+                self._layer_observers[layer] = cb
+        self.cels = cels
+        if not cels:
+            self._clear_tiles()
+
+    def _clear_tiles(self):
+        self._tiles.clear()
+        self._nbytes = 0
+
+    def _drop_tile(self, key):
+        src = self._tiles.pop(key)
+        if src is not None:
+            self._nbytes -= src.nbytes
+
+    def _evict(self):
+        """Drop least recently used tiles until under budget"""
+        while self._nbytes > self.budget and self._tiles:
+            key, src = self._tiles.popitem(last=False)
+            if src is not None:
+                self._nbytes -= src.nbytes
+
+    def _layer_modified_cb(self, x, y, w, h):
+        self.invalidate(x, y, w, h)
+
+    def invalidate(self, x, y, w, h):
+        """Drop the composite tiles touching a model-space rectangle"""
+        if w == 0 and h == 0:
+            self._clear_tiles()
+            return
+        dropped = []
+        for key in self._tiles:
+            run, tx, ty, mipmap_level = key
+            size = N * 2**mipmap_level
+            if (tx*size < x+w and x < (tx+1)*size and
+                    ty*size < y+h and y < (ty+1)*size):
+                dropped.append(key)
+        for key in dropped:
+            self._drop_tile(key)
+
+    def substitute(self, layers, keep=None):
+        """Replace the onion cels in a list of layers by the onion skin
+
+        Each run of onion cels with no other layer between them is
+        replaced by one layer drawing their composite, at the place of
+        the run.  The layers are returned unchanged if some cel of the
+        onion skin is not in the list (hidden layers above, removed
+        cels), if one of them has a blending mode other than normal, or
+        if `keep` is one of them.
+
+        """
+        cels = [l for l, opacity in self.cels]
+        if not cels or keep in cels:
+            return layers
+        if any(l.compositeop != DEFAULT_COMPOSITE_OP for l in cels):
+            return layers
+        onion = set(cels)
+        if len(onion & set(layers)) != len(onion):
+            return layers
+        result = []
+        run = []
+        for layer in layers:
+            if layer in onion:
+                run.append(layer)
+                continue
+            if run:
+                result.append(OnionRun(self, tuple(run)))
+                run = []
+            result.append(layer)
+        if run:
+            result.append(OnionRun(self, tuple(run)))
+        runs = set(r.cels for r in result if isinstance(r, OnionRun))
+        if runs != self._runs:
+            # layers were moved since the last time
+            self._runs = runs
+            for key in self._tiles.keys():
+                if key[0] not in runs:
+                    self._drop_tile(key)
+        return result
+
+    def composite_run_tile(self, run, dst, dst_has_alpha, tx, ty,
+                           mipmap_level=0):
+        """Composite the cached tile of a run of onion cels over dst"""
+        key = (run, tx, ty, mipmap_level)
+        if key in self._tiles:
+            src = self._tiles.pop(key)
+            self._tiles[key] = src # most recently used
+        else:
+            src = self._render_run_tile(run, tx, ty, mipmap_level)
+            self._tiles[key] = src
+            if src is not None:
+                self._nbytes += src.nbytes
+                self._evict()
+        if src is not None:
+            func = tiledsurface.svg2composite_func[DEFAULT_COMPOSITE_OP]
+            func(src, dst, dst_has_alpha, 1.0)
+
+    def _render_run_tile(self, run, tx, ty, mipmap_level):
+        opacities = dict(self.cels)
+        src = numpy.zeros((N, N, 4), 'uint16')
+        for layer in run:
+            opacity = opacities[layer]
+            if self.tint is None:
+                layer._surface.composite_tile(src, True, tx, ty,
+                                              mipmap_level=mipmap_level,
+                                              opacity=opacity,
+                                              mode=layer.compositeop)
+                continue
+            if layer in self.next_cels:
+                color = self.tint[1]
+            else:
+                color = self.tint[0]
+            with tiledsurface.tile_pool.scratch(zero=True) as tmp:
+                layer._surface.composite_tile(tmp, True, tx, ty,
+                                              mipmap_level=mipmap_level,
+                                              opacity=opacity,
+                                              mode=layer.compositeop)
+                tint_tile(tmp, color)
+                func = tiledsurface.svg2composite_func[DEFAULT_COMPOSITE_OP]
+                func(tmp, src, True, 1.0)
+        if not src[:, :, 3].any():
+            return None
+        return src
+
+
+class OnionRun (object):
+    """Adjacent cels of an onion skin, drawn as a single layer"""
+
+    # Enough of the layer interface for Document.blit_tile_into()
+    opacity = 1.0
+    visible = True
+    effective_opacity = 1.0
+    compositeop = DEFAULT_COMPOSITE_OP
+
+    def __init__(self, onion_skin, cels):
+        object.__init__(self)
+        self.onion_skin = onion_skin
+        self.cels = cels # tuple, bottom to top
+
+    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        self.onion_skin.composite_run_tile(self.cels, dst, dst_has_alpha,
+                                           tx, ty, mipmap_level)
@@ -10,6 +10,8 @@
 #ifndef PIXOPS_HPP
 #define PIXOPS_HPP
 
+#include <vector>
+
 // make the "heavy_debug" readable from python
 #ifdef HEAVY_DEBUG
 const bool heavy_debug = true;
@@ -60,6 +62,59 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y) {
 
 }
 
+#ifndef SWIG
+
+struct _downscale_job {
+  const uint16_t *src;
+  int src_strides;
+  uint16_t *dst;
+  int dst_strides;
+  int dst_x;
+  int dst_y;
+};
+
+#endif /* #ifndef SWIG */
+
+// downscale a list of (src, dst, dst_x, dst_y) tuples, the arguments of
+// tile_downscale_rgba16(), with the GIL released; the caller keeps the
+// arrays alive
+void tile_downscale_rgba16_many(PyObject *jobs) {
+
+#ifdef HEAVY_DEBUG
+  assert(PyList_Check(jobs));
+#endif
+
+  const Py_ssize_t n = PyList_GET_SIZE(jobs);
+  std::vector<_downscale_job> work(n);
+  for (Py_ssize_t i=0; i<n; i++) {
+    PyObject *job = PyList_GET_ITEM(jobs, i);
+    PyArrayObject* src_arr = ((PyArrayObject*)PyTuple_GET_ITEM(job, 0));
+    PyArrayObject* dst_arr = ((PyArrayObject*)PyTuple_GET_ITEM(job, 1));
+#ifdef HEAVY_DEBUG
+    assert(PyArray_TYPE(src_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(src_arr));
+    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(dst_arr));
+#endif
+    work[i].src = (uint16_t*)PyArray_DATA(src_arr);
+    work[i].src_strides = PyArray_STRIDES(src_arr)[0];
+    work[i].dst = (uint16_t*)PyArray_DATA(dst_arr);
+    work[i].dst_strides = PyArray_STRIDES(dst_arr)[0];
+    work[i].dst_x = PyInt_AsLong(PyTuple_GET_ITEM(job, 2));
+    work[i].dst_y = PyInt_AsLong(PyTuple_GET_ITEM(job, 3));
+  }
+
+  // no Python objects from here on
+  Py_BEGIN_ALLOW_THREADS
+  for (size_t i=0; i<work.size(); i++) {
+    tile_downscale_rgba16_c(work[i].src, work[i].src_strides,
+                            work[i].dst, work[i].dst_strides,
+                            work[i].dst_x, work[i].dst_y);
+  }
+  Py_END_ALLOW_THREADS
+
+}
+
 
 #include "compositing.hpp"
 #include "blendmodes.hpp"
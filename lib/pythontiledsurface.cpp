@@ -46,7 +46,8 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
         assert(PyArray_ISCARRAY(rgba));
         assert(PyArray_TYPE(rgba) == NPY_UINT16);
 #endif
-        // tiledsurface.py will keep a reference in its tiledict, at least until the final end_atomic()
+        // tiledsurface.py keeps the buffer alive until the final end_atomic(),
+        // in its tiledict or held back by its TilePool
         Py_DECREF((PyObject *)rgba);
         request->buffer = (uint16_t*)PyArray_DATA(rgba);
     }
@@ -55,8 +55,8 @@ class StrokeShape (object):
 
     def _update_strokemap_with_percept_diff(self, before, after, tx, ty):
         # get the pixel data to compare
-        data_before = before.get((tx, ty), tiledsurface.transparent_tile).rgba
-        data_after = after.get((tx, ty), tiledsurface.transparent_tile).rgba
+        data_before = before.get((tx, ty), tiledsurface.transparent_tile).get_pixels()
+        data_after = after.get((tx, ty), tiledsurface.transparent_tile).get_pixels()
         # calculate pixel changes, and add to the stroke's tiled bitmap
         differences = empty((N, N), 'uint8')
         mypaintlib.tile_perceptual_change_strokemap(data_before, data_after,
@@ -0,0 +1,140 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Thumbnails of the cels of an animation."""
+
+import time
+import functools
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+import helpers
+import tiledsurface
+import pixbufsurface
+
+#: Default width and height of the thumbnails, in pixels
+DEFAULT_SIZE = 48
+
+
+class ThumbnailCache (object):
+    """Renders cel thumbnails on demand, a few at a time
+
+    `get()` never renders: it returns the last thumbnail of the cel, if
+    any, and queues the cel when that thumbnail is missing or outdated.
+    The queue is worked off by `render_pending()`, called when the GUI is
+    idle, and the observers are told about each new thumbnail.
+
+    Thumbnails are cached by cel and content generation.  The generation
+    of a cel goes up whenever its surface changes, which is noticed
+    through the layer's content observers.  All cels are framed by the
+    document frame and rendered from the mipmap level closest to the
+    thumbnail size, so that rendering one costs a few tiles at most.
+
+    """
+
+    def __init__(self, doc, size=DEFAULT_SIZE):
+        object.__init__(self)
+        self.doc = doc
+        self.size = size
+        #: called with the cel of each new thumbnail, None for all cels
+        self.observers = []
+        self._generations = {} # cel: content generation
+        self._thumbnails = {} # cel: (generation, pixbuf)
+        self._pending = OrderedDict() # cel: None, oldest request first
+        self._observed = {} # cel: content observer
+        self._rect = None
+
+    def clear(self):
+        """Drop all thumbnails, and stop observing the cels"""
+        for cel, cb in self._observed.iteritems():
+            if cb in cel.content_observers:
+                cel.content_observers.remove(cb)
+        self._observed.clear()
+        self._generations.clear()
+        self._thumbnails.clear()
+        self._pending.clear()
+
+    def set_size(self, size):
+        if size != self.size:
+            self.size = size
+            self._thumbnails.clear()
+
+    def get(self, cel):
+        """Return the latest thumbnail of a cel, or None
+
+        The thumbnail may be outdated; a new one is then requested.
+
+        """
+        if cel not in self._observed:
+            cb = functools.partial(self._cel_modified_cb, cel)
+            cel.content_observers.append(cb)
+            self._observed[cel] = cb
+        generation = self._generations.get(cel, 0)
+        generation_done, pixbuf = self._thumbnails.get(cel, (None, None))
+        if generation_done != generation:
+            self._pending[cel] = None
+        return pixbuf
+
+    @property
+    def pending(self):
+        """Number of thumbnails waiting to be rendered"""
+        return len(self._pending)
+
+    def _cel_modified_cb(self, cel, *args):
+        self._generations[cel] = self._generations.get(cel, 0) + 1
+
+    def _frame_rect(self):
+        x, y, w, h = self.doc.get_effective_bbox()
+        if w == 0 or h == 0:
+            x, y, w, h = 0, 0, tiledsurface.N, tiledsurface.N
+        return x, y, w, h
+
+    def render_pending(self, max_time=0.01):
+        """Render queued thumbnails for about max_time seconds
+
+        Returns True if some are still waiting, to be used as an idle
+        callback.
+
+        """
+        rect = self._frame_rect()
+        if rect != self._rect:
+            # framed differently, all thumbnails are outdated; they are
+            # shown until the visible ones are requested again
+            self._rect = rect
+            for cel, (generation, pixbuf) in self._thumbnails.items():
+                self._thumbnails[cel] = (None, pixbuf)
+            for f in self.observers:
+                f(None)
+        t0 = time.time()
+        while self._pending:
+            cel, junk = self._pending.popitem(last=False)
+            if cel not in self.doc.layers:
+                continue
+            generation = self._generations.get(cel, 0)
+            pixbuf = self.render(cel)
+            self._thumbnails[cel] = (generation, pixbuf)
+            for f in self.observers:
+                f(cel)
+            if time.time() - t0 > max_time:
+                break
+        return bool(self._pending)
+
+    def render(self, cel):
+        """Render the thumbnail of a cel, framed like the document"""
+        x, y, w, h = self._rect or self._frame_rect()
+        mipmap_level = 0
+        while (mipmap_level < tiledsurface.MAX_MIPMAP_LEVEL
+               and max(w, h) >= 2 * self.size):
+            mipmap_level += 1
+            x, y, w, h = x/2, y/2, w/2, h/2
+        pixbuf = pixbufsurface.render_as_pixbuf(cel._surface, x, y, w, h,
+                                                alpha=True,
+                                                mipmap_level=mipmap_level)
+        # over white, like the canvas
+        return helpers.pixbuf_thumbnail(pixbuf, self.size, self.size)
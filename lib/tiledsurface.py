@@ -13,9 +13,16 @@ from numpy import *
 import time
 import sys
 import os
+import multiprocessing
 import contextlib
 import functools
+import hashlib
+import tempfile
+import weakref
+import zlib
 import logging
+from itertools import islice
+from collections import deque
 logger = logging.getLogger(__name__)
 
 import mypaintlib
@@ -31,21 +38,606 @@ use_gegl = True if os.environ.get('MYPAINT_ENABLE_GEGL', 0) else False
 
 
 
+#: Most colors of uniform tiles whose shared pixels are kept in memory
+MAX_UNIFORM_COLORS = 256
+
+#: Most tile buffers kept for reuse by the tile pool
+TILE_POOL_SIZE = 256
+
+#: Size of a tile's pixel buffer, in bytes
+TILE_BYTES = N * N * 4 * 2
+
+#: Most threads running native tile work with the GIL released, like
+#: filling the tiles of a flood fill frontier or downscaling mipmaps
+WORKER_THREADS = min(4, multiprocessing.cpu_count())
+
+#: Most mipmap tiles planned for one native downscale in update_mipmaps()
+MIPMAP_BATCH = 64
+
+#: Fewest tile quadrants worth handing to a worker thread, a round trip
+#: through the thread pool costs about as much as 25 of them
+DOWNSCALE_JOBS_PER_THREAD = 64
+
+# shared read-only pixels of uniform tiles, by color
+_uniform_pixels = {}
+# the same converted to 8 bits, by (color, with alpha)
+_uniform_pixels8 = {}
+
+
+class TilePool (object):
+    """Recycles the pixel buffers of tiles
+
+    Painting, mipmap updates and undo create and drop tiles all the time.
+    A tile gives its buffer back to the pool when it dies, be it dropped
+    by `MyPaintSurface.clear()`, `trim()` or `_load_tiledict()`, or with
+    the last snapshot using it when the undo history is trimmed.  put()
+    does not recycle buffers still referenced elsewhere, e.g. by a numpy
+    view.
+
+    Between begin_atomic() and end_atomic() the buffers given back are
+    held, and only pooled at the last end_atomic(): the C++ side may
+    still hold a pointer to the buffer of a tile dropped meanwhile, like
+    the original of a copy-on-write.
+
+    """
+
+    def __init__(self, size=TILE_POOL_SIZE):
+        object.__init__(self)
+        self.size = size
+        self._buffers = []
+        self.allocated = 0 # new buffers
+        self.reused = 0 # allocations avoided
+        self.high_water = 0 # most buffers in the pool
+        self._atomic = 0
+        self._held = [] # buffers given back during an atomic operation
+
+    def get(self, zero=True):
+        """Return a tile buffer, cleared if `zero` is true"""
+        if self._buffers:
+            buf = self._buffers.pop()
+            self.reused += 1
+            if zero:
+                buf.fill(0)
+            return buf
+        self.allocated += 1
+        if zero:
+            return zeros((N, N, 4), 'uint16')
+        return empty((N, N, 4), 'uint16')
+
+    def put(self, buf, refs=1):
+        """Give a buffer that is no longer used back to the pool
+
+        `refs` is the number of references to `buf` the caller holds.
+        If there are more, the buffer is still in use and not recycled.
+
+        """
+        if buf.base is not None or buf.shape != (N, N, 4):
+            return
+        if self._atomic:
+            # kept alive in any case, checked at the last end_atomic()
+            self._held.append(buf)
+            return
+        # references: the caller's, the call's argument, buf and the
+        # argument of getrefcount
+        if sys.getrefcount(buf) > refs + 3:
+            return
+        if len(self._buffers) >= self.size:
+            return
+        self._buffers.append(buf)
+        self.high_water = max(self.high_water, len(self._buffers))
+
+    def begin_atomic(self):
+        self._atomic += 1
+
+    def end_atomic(self):
+        self._atomic -= 1
+        if not self._atomic:
+            held = self._held
+            self._held = []
+            while held:
+                self.put(held.pop(), refs=0)
+
+    @contextlib.contextmanager
+    def scratch(self, zero=False):
+        """A temporary tile buffer for the duration of a with block"""
+        buf = self.get(zero)
+        try:
+            yield buf
+        finally:
+            # references: buf and the target of the with statement
+            self.put(buf, refs=2)
+
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'pooled': len(self._buffers),
+            'high_water': self.high_water,
+        }
+
+tile_pool = TilePool()
+
+# worker threads of flood fills and mipmap updates, started on first use
+_workers = None
+
+def _get_workers():
+    global _workers
+    if _workers is None and WORKER_THREADS > 1:
+        from multiprocessing.pool import ThreadPool
+        _workers = ThreadPool(WORKER_THREADS)
+    return _workers
+
+
+def _downscale_tiles(jobs):
+    """Run tile_downscale_rgba16() argument tuples in native batches
+
+    The native code releases the GIL, so large batches are split over
+    the worker threads.  Each job writes its own quadrant of a tile.
+
+    """
+    count = min(WORKER_THREADS, len(jobs) // DOWNSCALE_JOBS_PER_THREAD)
+    workers = None
+    if count > 1:
+        workers = _get_workers()
+    if workers is None:
+        mypaintlib.tile_downscale_rgba16_many(jobs)
+        return
+    workers.map(mypaintlib.tile_downscale_rgba16_many,
+                [jobs[i::count] for i in xrange(count)])
+
+
+class TileSwap (object):
+    """Memory-mapped scratch file for the tiles paged out of memory
+
+    The file is an array of tile-sized slots, extended by `grow` slots
+    when all are taken.  Freed slots are reused first.  When a swap is
+    set on the `TileCompressor`, it pages out the least recently used
+    tiles once more than `max_resident` tiles have pixels in memory.
+
+    A tile is paged out in place, so the surfaces and undo snapshots
+    sharing it all see it paged out, and it stays read-only if it was.
+    It is paged in again, into a fresh buffer, when its pixels are
+    accessed, see `Tile.rgba`.
+
+    """
+
+    def __init__(self, max_resident, dirname=None, grow=1024):
+        object.__init__(self)
+        self.max_resident = max_resident
+        self.grow = grow
+        self._file = tempfile.TemporaryFile(prefix='mypaint-swap',
+                                            dir=dirname)
+        self._slots = None # memmap of (slots, N, N, 4) uint16
+        self._free = []
+        self.used = 0 # slots holding a tile
+        self.page_outs = 0
+        self.page_ins = 0
+
+    def _extend(self):
+        count = 0
+        if self._slots is not None:
+            count = len(self._slots)
+        size = count + self.grow
+        self._file.truncate(size * TILE_BYTES)
+        # pixels are always copied in and out, no view of the old map is
+        # left
+        self._slots = numpy.memmap(self._file, 'uint16', 'r+',
+                                   shape=(size, N, N, 4))
+        self._free.extend(xrange(size-1, count-1, -1))
+
+    def write(self, rgba):
+        """Store the pixels of a tile, returning its slot"""
+        if not self._free:
+            self._extend()
+        slot = self._free.pop()
+        self._slots[slot] = rgba
+        self.used += 1
+        self.page_outs += 1
+        return slot
+
+    def read(self, slot, rgba):
+        """Copy the pixels stored in a slot into rgba"""
+        rgba[:] = self._slots[slot]
+
+    def free(self, slot):
+        self._free.append(slot)
+        self.used -= 1
+
+    def close(self):
+        self._slots = None
+        self._file.close()
+
+    def stats(self):
+        slots = 0
+        if self._slots is not None:
+            slots = len(self._slots)
+        return {
+            'slots': slots,
+            'used': self.used,
+            'file_bytes': slots * TILE_BYTES,
+            'page_outs': self.page_outs,
+            'page_ins': self.page_ins,
+        }
+
+
+class TileCompressor (object):
+    """Compresses the least recently used tiles under a memory budget
+
+    Tiles of all surfaces and undo snapshots are accounted together.  When
+    their pixel buffers use more than `budget` bytes, the tiles used the
+    longest time ago are compressed with zlib until the buffers fit in
+    3/4 of it.  A compressed tile is decompressed when its pixels are
+    next accessed, see `Tile.rgba`.
+
+    With a `TileSwap` as `swap`, the tiles over its resident-set limit
+    are paged out to disk first, in the same order.
+
+    Each use of a tile with pixels is appended to a queue, so eviction
+    takes the least recently used tiles from its front without sorting,
+    skipping the entries of tiles used again since.  Tiles are only
+    referenced weakly, and drop out when they are deleted.
+
+    Nothing is compressed or paged out while a surface is between
+    begin_atomic() and end_atomic(): the C++ side then holds pointers to
+    the pixels of the tiles it works on.  A buffer still referenced from
+    Python, like the array of a `tile_request()` block, is left alone too.
+
+    """
+
+    def __init__(self, budget=None, level=1):
+        object.__init__(self)
+        self.budget = budget # None: no compression
+        self.level = level
+        self.swap = None
+        self._tiles = {} # id: (ref to Tile with pixels, last use)
+        self._uses = deque() # (use, id) oldest first, some outdated
+        self._clock = 0
+        self._packed = {} # id: ref to compressed Tile
+        self._atomic = 0
+        self.hits = 0 # accesses to uncompressed tiles
+        self.misses = 0 # decompressions
+        self.compressions = 0
+
+    @property
+    def nbytes(self):
+        """Memory used by the uncompressed tiles, in bytes"""
+        return len(self._tiles) * TILE_BYTES
+
+    def update(self, tile):
+        """Account for a tile whose pixels were stored differently"""
+        key = id(tile)
+        self._tiles.pop(key, None)
+        self._packed.pop(key, None)
+        if tile._rgba is not None:
+            self._use(key, weakref.ref(tile))
+        elif tile._packed is not None:
+            self._packed[key] = weakref.ref(tile)
+
+    def forget(self, tile):
+        """Stop accounting for a tile, which will never be compressed"""
+        self._tiles.pop(id(tile), None)
+        self._packed.pop(id(tile), None)
+
+    def touch(self, tile):
+        """Make a tile the most recently used one"""
+        key = id(tile)
+        entry = self._tiles.get(key)
+        if entry is not None:
+            self._use(key, entry[0])
+            self.hits += 1
+
+    def _use(self, key, ref):
+        self._clock += 1
+        self._tiles[key] = (ref, self._clock)
+        self._uses.append((self._clock, key))
+        if len(self._uses) > 2 * len(self._tiles) + 256:
+            # drop the outdated entries, keeping the order
+            tiles = self._tiles
+            self._uses = deque(u for u in self._uses
+                               if tiles.get(u[1], (None, None))[1] == u[0])
+
+    def begin_atomic(self):
+        self._atomic += 1
+
+    def end_atomic(self):
+        self._atomic -= 1
+        if not self._atomic:
+            self.maybe_compress()
+
+    def maybe_compress(self):
+        """Page out or compress cold tiles if over budget
+
+        Returns the number of tiles that left memory.
+
+        """
+        if self._atomic:
+            return 0
+        evicted = 0
+        swap = self.swap
+        if swap is not None and len(self._tiles) > swap.max_resident:
+            excess = len(self._tiles) - swap.max_resident * 3 // 4
+            evicted += self._evict(excess, lambda t: t.page_out(swap))
+            logger.debug('paged out %d tiles, %d slots used', evicted,
+                         swap.used)
+        if self.budget is not None and self.nbytes > self.budget:
+            excess = (self.nbytes - self.budget * 3 // 4) // TILE_BYTES
+            compressed = self._evict(excess,
+                                     lambda t: t.compress(self.level))
+            self.compressions += compressed
+            evicted += compressed
+            logger.debug('compressed %d tiles, %d bytes uncompressed',
+                         compressed, self.nbytes)
+        return evicted
+
+    def _evict(self, count, func):
+        """Apply func to the count least recently used tiles it accepts"""
+        done = 0
+        tiles = self._tiles
+        uses = self._uses
+        busy = []
+        while done < count and uses:
+            use, key = uses.popleft()
+            entry = tiles.get(key)
+            if entry is None or entry[1] != use:
+                continue # used again since, or gone
+            tile = entry[0]()
+            if tile is None:
+                del tiles[key]
+                continue
+            if func(tile):
+                done += 1
+            else:
+                busy.append((key, entry[0]))
+        # buffers still in use elsewhere count as used now
+        for key, ref in busy:
+            self._use(key, ref)
+        return done
+
+    def _packed_tiles(self):
+        for ref in self._packed.values():
+            tile = ref()
+            if tile is not None:
+                yield tile
+
+    def stats(self):
+        return {
+            'tiles': len(self._tiles),
+            'nbytes': self.nbytes,
+            'compressed': len(self._packed),
+            'compressed_bytes': sum(len(t._packed)
+                                    for t in self._packed_tiles()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'compressions': self.compressions,
+        }
+
+tile_compressor = TileCompressor()
+
+
 class Tile (object):
-    def __init__(self, copy_from=None):
+    """Pixels of one tile
+
+    A tile whose pixels all have the same value, like a transparent tile
+    after erasing or a filled one, is stored as that value alone, its
+    `color`.  The pixel buffer is only allocated when `rgba` is accessed,
+    which is what writing does.  Use `get_pixels()` to read any tile
+    without allocating.  Buffers come from the `TilePool`.
+
+    A tile that was not used for a while can also be compressed by the
+    `TileCompressor`, then the buffer is restored when `rgba` is accessed.
+
+    """
+
+    pool = tile_pool
+    compressor = tile_compressor
+
+    def __init__(self, copy_from=None, color=None):
         object.__init__(self)
         # note: pixels are stored with premultiplied alpha
         #       15bits are used, but fully opaque or white is stored as 2**15 (requiring 16 bits)
         #       This is to allow many calcuations to divide by 2**15 instead of (2**16-1)
-        if copy_from is None:
-            self.rgba = zeros((N, N, 4), 'uint16')
-        else:
-            self.rgba = copy_from.rgba.copy()
+        self.color = color
+        self._rgba = None
+        self._packed = None # zlib compressed pixels
+        self._swapped = None # (TileSwap, slot) of paged out pixels
+        self._digest = None # of the pixels, while they are not in _rgba
+        self._empty = None # whether they are all zero, likewise
+        if copy_from is not None:
+            self.color = copy_from.color
+            self._packed = copy_from._packed
+            self._digest = copy_from._digest
+            self._empty = copy_from._empty
+            if copy_from._rgba is not None:
+                self._rgba = self.pool.get(zero=False)
+                self._rgba[:] = copy_from._rgba
+            elif copy_from._swapped is not None:
+                swap, slot = copy_from._swapped
+                self._rgba = self.pool.get(zero=False)
+                swap.read(slot, self._rgba)
+        elif color is None:
+            self._rgba = self.pool.get()
+        self.compressor.update(self)
         self.readonly = False
 
+    def __del__(self):
+        self.compressor.forget(self)
+        self._free_slot()
+        rgba = self._rgba
+        self._rgba = None
+        if rgba is not None:
+            self.pool.put(rgba)
+
     def copy(self):
         return Tile(copy_from=self)
 
+    def _get_rgba(self):
+        if self._rgba is None:
+            if self._packed is not None:
+                rgba = self.pool.get(zero=False)
+                pixels = frombuffer(zlib.decompress(self._packed), 'uint16')
+                rgba[:] = pixels.reshape((N, N, 4))
+                self._packed = None
+                self.compressor.misses += 1
+            elif self._swapped is not None:
+                swap, slot = self._swapped
+                rgba = self.pool.get(zero=False)
+                swap.read(slot, rgba)
+                self._free_slot()
+                swap.page_ins += 1
+            elif self.color is not None:
+                rgba = self.pool.get(zero=False)
+                rgba[:] = self.color
+                self.color = None
+            else:
+                raise AttributeError('rgba')
+            self._rgba = rgba
+            self._digest = None
+            self.compressor.update(self)
+        return self._rgba
+
+    def _set_rgba(self, rgba):
+        self._rgba = rgba
+        self.color = None
+        self._packed = None
+        self._digest = None
+        self._free_slot()
+        self.compressor.update(self)
+
+    def _del_rgba(self):
+        self._rgba = None
+        self.color = None
+        self._packed = None
+        self._digest = None
+        self._free_slot()
+        self.compressor.update(self)
+
+    def _free_slot(self):
+        if self._swapped is not None:
+            swap, slot = self._swapped
+            self._swapped = None
+            swap.free(slot)
+
+    rgba = property(_get_rgba, _set_rgba, _del_rgba)
+
+    def get_pixels(self):
+        """Return the pixels for reading, shared between uniform tiles"""
+        if self._rgba is None and self.color is not None:
+            return uniform_pixels(self.color)
+        return self.rgba
+
+    def get_digest(self):
+        """Return the SHA-1 digest of the pixels
+
+        The digest of compressed or paged out pixels was taken before
+        they left memory, so they are not restored for it.
+
+        """
+        if self._rgba is not None:
+            return hashlib.sha1(self._rgba).digest()
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.get_pixels()).digest()
+        return self._digest
+
+    def is_empty(self):
+        """Return True if all pixels are zero
+
+        Like the digest, this was recorded for compressed or paged out
+        pixels before they left memory.
+
+        """
+        if self._rgba is not None:
+            return not self._rgba.any()
+        if self.color is not None:
+            return not any(self.color)
+        return self._empty
+
+    def compact(self):
+        """Drop the pixel buffer if all pixels are equal
+
+        Returns True if the tile is uniform.
+
+        """
+        if self._rgba is None:
+            return self.color is not None
+        color = uniform_color(self._rgba)
+        if color is None:
+            return False
+        if (color not in _uniform_pixels
+                and len(_uniform_pixels) >= MAX_UNIFORM_COLORS):
+            return False
+        uniform_pixels(color)
+        rgba = self._rgba
+        self._rgba = None
+        self.color = color
+        self._digest = None
+        self.compressor.update(self)
+        self.pool.put(rgba)
+        return True
+
+    def compress(self, level=1):
+        """Replace the pixel buffer by its zlib compressed data
+
+        Returns False if the buffer is still in use elsewhere.
+
+        """
+        rgba = self._rgba
+        # references: self._rgba, rgba and the argument of getrefcount
+        if rgba is None or sys.getrefcount(rgba) > 3:
+            return False
+        self._packed = zlib.compress(buffer(rgba), level)
+        self._digest = hashlib.sha1(rgba).digest()
+        self._empty = not rgba.any()
+        self._rgba = None
+        self.compressor.update(self)
+        self.pool.put(rgba)
+        return True
+
+    def page_out(self, swap):
+        """Move the pixel buffer to a `TileSwap`
+
+        Returns False if the buffer is still in use elsewhere.
+
+        """
+        rgba = self._rgba
+        # references: self._rgba, rgba and the argument of getrefcount
+        if rgba is None or sys.getrefcount(rgba) > 3:
+            return False
+        self._swapped = (swap, swap.write(rgba))
+        self._digest = hashlib.sha1(rgba).digest()
+        self._empty = not rgba.any()
+        self._rgba = None
+        self.compressor.update(self)
+        self.pool.put(rgba)
+        return True
+
+
+def uniform_color(rgba):
+    """Return the color of a tile's pixels as a tuple if they are all equal"""
+    first = rgba[0, 0]
+    if not (rgba[-1, -1] == first).all():
+        return None
+    if not (rgba == first).all():
+        return None
+    return tuple(int(c) for c in first)
+
+
+def uniform_pixels(color):
+    """Return read-only pixels all of one color, shared by uniform tiles
+
+    The arrays are kept for the lifetime of the process: the C++ side of
+    the surfaces only keeps pointers to the pixels it was handed.
+
+    """
+    pixels = _uniform_pixels.get(color)
+    if pixels is None:
+        if not any(color):
+            pixels = transparent_tile.rgba
+        else:
+            pixels = empty((N, N, 4), 'uint16')
+            pixels[:] = color
+        _uniform_pixels[color] = pixels
+    return pixels
+
 
 
 svg2mypaintlibmode = {
@@ -74,6 +666,7 @@ for svg_id, mode_enum in svg2mypaintlibmode.iteritems():
 # tile for read-only operations on empty spots
 transparent_tile = Tile()
 transparent_tile.readonly = True
+tile_compressor.forget(transparent_tile)
 
 # tile with invalid pixel memory (needs refresh)
 mipmap_dirty_tile = Tile()
@@ -168,6 +761,11 @@ class MyPaintSurface (object):
         self._backend = mypaintlib.TiledSurface(self)
         self.tiledict = {}
         self.observers = []
+        self._written = set() # tiles to check by compact_uniform_tiles()
+        # tiles of this mipmap level whose pixels are outdated: a bitmask
+        # of the changed quadrants, bit x + 2*y for the child tile
+        # (2*tx + x, 2*ty + y) of the level below
+        self._dirty_mipmaps = {} # (tx, ty): quadrant mask
 
         # Used to implement repeating surfaces, like Background
         if looped_size[0] % N or looped_size[1] % N:
@@ -198,15 +796,23 @@ class MyPaintSurface (object):
 
         # Forwarding API
         self.set_symmetry_state = self._backend.set_symmetry_state
-        self.begin_atomic = self._backend.begin_atomic
 
         self.get_color = self._backend.get_color
         self.get_alpha = self._backend.get_alpha
         self.draw_dab = self._backend.draw_dab
 
 
+    def begin_atomic(self):
+        # the tiles used until end_atomic() must stay uncompressed, and
+        # their buffers must not be recycled
+        tile_compressor.begin_atomic()
+        tile_pool.begin_atomic()
+        self._backend.begin_atomic()
+
     def end_atomic(self):
 	bbox = self._backend.end_atomic()
+	tile_pool.end_atomic()
+	tile_compressor.end_atomic()
 	if (bbox[2] > 0 and bbox[3] > 0):
 	    self.notify_observers(*bbox)
 
@@ -221,6 +827,7 @@ class MyPaintSurface (object):
     def clear(self):
         tiles = self.tiledict.keys()
         self.tiledict = {}
+        self._dirty_mipmaps.clear()
         self.notify_observers(*get_tiles_bbox(tiles))
         if self.mipmap: self.mipmap.clear()
 
@@ -255,22 +862,59 @@ class MyPaintSurface (object):
         self._set_tile_numpy(tx, ty, numpy_tile, readonly)
 
     def _regenerate_mipmap(self, t, tx, ty):
-        t = Tile()
-        self.tiledict[(tx, ty)] = t
-        empty = True
+        jobs = []
+        t = self._plan_mipmap(t, tx, ty, jobs)
+        for job in jobs:
+            mypaintlib.tile_downscale_rgba16(*job)
+        return t
 
+    def _plan_mipmap(self, t, tx, ty, jobs):
+        """Prepare a dirty mipmap tile, returning it
+
+        The downscaling left to do is appended to jobs, as argument tuples
+        of tile_downscale_rgba16().  Dirty tiles of the level below are
+        regenerated right away.
+
+        """
+        mask = self._dirty_mipmaps.pop((tx, ty), 0xf)
+        if t is None or t is mipmap_dirty_tile:
+            mask = 0xf # no pixels to keep
+        srcs = []
         for x in xrange(2):
             for y in xrange(2):
-                src = self.parent.tiledict.get((tx*2 + x, ty*2 + y), transparent_tile)
-                if src is mipmap_dirty_tile:
-                    src = self.parent._regenerate_mipmap(src, tx*2 + x, ty*2 + y)
-                mypaintlib.tile_downscale_rgba16(src.rgba, t.rgba, x*N/2, y*N/2)
-                if src.rgba is not transparent_tile.rgba:
-                    empty = False
-        if empty:
-            # rare case, no need to speed it up
-            del self.tiledict[(tx, ty)]
-            t = transparent_tile
+                if not mask & (1 << (x + 2*y)):
+                    continue # unchanged quadrant
+                pos = (tx*2 + x, ty*2 + y)
+                src = self.parent.tiledict.get(pos, transparent_tile)
+                if (src is mipmap_dirty_tile
+                        or pos in self.parent._dirty_mipmaps):
+                    src = self.parent._regenerate_mipmap(src, *pos)
+                srcs.append((x, y, src))
+
+        if mask != 0xf:
+            # only the changed quadrants are downscaled again
+            rgba = t.rgba
+            for x, y, src in srcs:
+                jobs.append((src.get_pixels(), rgba, x*N/2, y*N/2))
+            return t
+
+        colors = set((0, 0, 0, 0) if src is transparent_tile else src.color
+                     for x, y, src in srcs)
+        if colors == set([(0, 0, 0, 0)]):
+            self.tiledict.pop((tx, ty), None)
+            return transparent_tile
+        if len(colors) == 1 and None not in colors:
+            # the four tiles are uniform, so is the downscaled one
+            t = Tile(color=colors.pop())
+            self.tiledict[(tx, ty)] = t
+            return t
+
+        t = Tile(color=(0, 0, 0, 0))
+        t.rgba = tile_pool.get(zero=False) # all four quadrants are written
+        self.tiledict[(tx, ty)] = t
+        rgba = t.rgba
+        for x, y, src in srcs:
+            jobs.append((src.get_pixels(), rgba, x*N/2, y*N/2))
         return t
 
     def _get_tile_numpy(self, tx, ty, readonly):
@@ -278,6 +922,8 @@ class MyPaintSurface (object):
         #           yes it is
         # Note: we must return memory that stays valid for writing until the
         # last end_atomic(), because of the caching in tiledsurface.hpp.
+        # A tile replaced meanwhile, e.g. by a copy-on-write below, may be
+        # dropped: the tile_pool holds its buffer back until then.
 
         if self.looped:
             tx = tx % (self.looped_size[0] / N)
@@ -290,29 +936,71 @@ class MyPaintSurface (object):
             else:
                 t = Tile()
                 self.tiledict[(tx, ty)] = t
-        if t is mipmap_dirty_tile:
+        if t is mipmap_dirty_tile or (tx, ty) in self._dirty_mipmaps:
             t = self._regenerate_mipmap(t, tx, ty)
         if t.readonly and not readonly:
             # shared memory, get a private copy for writing
             t = t.copy()
             self.tiledict[(tx, ty)] = t
-        if not readonly:
-            # assert self.mipmap_level == 0
-            self._mark_mipmap_dirty(tx, ty)
-        return t.rgba
+        tile_compressor.touch(t)
+        if readonly:
+            return t.get_pixels()
+        # assert self.mipmap_level == 0
+        self._mark_mipmap_dirty(tx, ty)
+        return t.rgba # a uniform tile gets its own pixels here
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass # Data can be modified directly, no action needed
 
     def _mark_mipmap_dirty(self, tx, ty):
         #assert self.mipmap_level == 0
+        self._written.add((tx, ty))
         for level, mipmap in enumerate(self.mipmaps):
             if level == 0:
                 continue
             fac = 2**(level)
-            if mipmap.tiledict.get((tx/fac, ty/fac), None) == mipmap_dirty_tile:
-                break
-            mipmap.tiledict[(tx/fac, ty/fac)] = mipmap_dirty_tile
+            pos = (tx/fac, ty/fac)
+            # quadrant of the changed tile of the level below
+            bit = 1 << ((tx/(fac/2) & 1) + 2*(ty/(fac/2) & 1))
+            mask = mipmap._dirty_mipmaps.get(pos, 0)
+            if mask & bit:
+                break # and so are the levels above
+            mipmap._dirty_mipmaps[pos] = mask | bit
+            if pos not in mipmap.tiledict:
+                mipmap.tiledict[pos] = mipmap_dirty_tile
+
+    @property
+    def mipmaps_pending(self):
+        """Number of mipmap tiles waiting for `update_mipmaps()`"""
+        return sum(len(m._dirty_mipmaps) for m in self.mipmaps[1:])
+
+    def update_mipmaps(self, max_time=None):
+        """Rebuild the dirty mipmap tiles, for about max_time seconds
+
+        Works level by level, from the largest one, so that every tile is
+        downscaled from ready tiles of the level below: nothing recurses,
+        and each tile of a level is rebuilt once however many of its
+        children changed, only in the quadrants that did.  The tiles are
+        downscaled natively in batches of `MIPMAP_BATCH`, with the GIL
+        released, on the worker threads.
+
+        Meant to run when idle, the renderer still rebuilds the tiles it
+        needs right away (see `_get_tile_numpy()`).  Returns True if some
+        tiles are still dirty.
+
+        """
+        t0 = time.time()
+        for mipmap in self.mipmaps[1:]:
+            dirty = mipmap._dirty_mipmaps
+            while dirty:
+                jobs = []
+                for tx, ty in list(islice(dirty, MIPMAP_BATCH)):
+                    mipmap._plan_mipmap(mipmap.tiledict.get((tx, ty)),
+                                        tx, ty, jobs)
+                _downscale_tiles(jobs)
+                if max_time is not None and time.time() - t0 > max_time:
+                    return self.mipmaps_pending > 0
+        return False
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
         # used mainly for saving (transparent PNG)
@@ -329,6 +1017,8 @@ class MyPaintSurface (object):
             if src is transparent_tile.rgba:
                 #dst[:] = 0 # <-- notably slower than memset()
                 mypaintlib.tile_clear(dst)
+            elif self._blit_uniform_tile(dst, dst_has_alpha, tx, ty):
+                pass
             else:
 
                 if dst.dtype == 'uint16':
@@ -342,6 +1032,44 @@ class MyPaintSurface (object):
                 else:
                     raise ValueError, 'Unsupported destination buffer type'
 
+    def _blit_uniform_tile(self, dst, dst_has_alpha, tx, ty):
+        """Fast path of blit_tile_into() for uniform tiles"""
+        color = self._tile_color(tx, ty)
+        if color is None:
+            return False
+        if dst.dtype == 'uint16':
+            dst[:] = color
+            return True
+        if dst.dtype != 'uint8':
+            return False
+        # the dithering noise is the same for each tile, so the converted
+        # pixels are too
+        key = (color, dst_has_alpha)
+        pixels = _uniform_pixels8.get(key)
+        if pixels is None:
+            if len(_uniform_pixels8) >= MAX_UNIFORM_COLORS:
+                _uniform_pixels8.clear()
+            pixels = empty((N, N, 4), 'uint8')
+            if dst_has_alpha:
+                mypaintlib.tile_convert_rgba16_to_rgba8(uniform_pixels(color),
+                                                        pixels)
+            else:
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(uniform_pixels(color),
+                                                        pixels)
+            _uniform_pixels8[key] = pixels
+        dst[:] = pixels
+        return True
+
+    def _tile_color(self, tx, ty):
+        """Color of a tile if it is stored as uniform, else None"""
+        if self.looped:
+            tx = tx % (self.looped_size[0] / N)
+            ty = ty % (self.looped_size[1] / N)
+        t = self.tiledict.get((tx, ty))
+        if t is None or (tx, ty) in self._dirty_mipmaps:
+            return None
+        return t.color
+
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, opacity=1.0,
                        mode=DEFAULT_COMPOSITE_OP):
         """Composite one tile of this surface over a NumPy array.
@@ -353,6 +1081,16 @@ class MyPaintSurface (object):
         if not (tx,ty) in self.tiledict:
             return
 
+        color = self._tile_color(tx, ty)
+        if color is not None:
+            if color[3] == 0:
+                return # transparent
+            if (color[3] == 1<<15 and opacity == 1.0
+                    and mode == DEFAULT_COMPOSITE_OP):
+                # opaque, covers dst
+                dst[:] = color
+                return
+
         with self.tile_request(tx, ty, readonly=True) as src:
             func = svg2composite_func[mode]
             func(src, dst, dst_has_alpha, opacity)
@@ -362,6 +1100,7 @@ class MyPaintSurface (object):
 
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface"""
+        self.compact_uniform_tiles()
         sshot = SurfaceSnapshot()
         for t in self.tiledict.itervalues():
             t.readonly = True
@@ -391,6 +1130,25 @@ class MyPaintSurface (object):
             self.notify_observers(*bbox)
 
 
+    def compact_uniform_tiles(self):
+        """Store the uniform tiles changed since the last call compactly
+
+        Returns the number of tiles that dropped their pixel buffer.  Must
+        not be called during a stroke, like `lib.tilestore.TileStore.share`.
+
+        """
+        written = self._written
+        self._written = set()
+        compacted = 0
+        for pos in written:
+            t = self.tiledict.get(pos)
+            if t is None or t._rgba is None:
+                continue
+            if t.compact():
+                compacted += 1
+        return compacted
+
+
     ## Loading tile data
 
 
@@ -408,6 +1166,7 @@ class MyPaintSurface (object):
                 s.blit_tile_into(dst, True, tx, ty)
 
         dirty_tiles.update(self.tiledict.keys())
+        self.compact_uniform_tiles()
         bbox = get_tiles_bbox(dirty_tiles)
         self.notify_observers(*bbox)
 
@@ -490,6 +1249,8 @@ class MyPaintSurface (object):
         logger.debug("PNG loader flags: %r", flags)
 
         dirty_tiles.update(self.tiledict.keys())
+        self.compact_uniform_tiles()
+        tile_compressor.maybe_compress()
         bbox = get_tiles_bbox(dirty_tiles)
         self.notify_observers(*bbox)
 
@@ -525,7 +1286,7 @@ class MyPaintSurface (object):
     def remove_empty_tiles(self):
         """Removes tiles from the tiledict which contain no data"""
         for pos, data in self.tiledict.items():
-            if not data.rgba.any():
+            if data.is_empty():
                 self.tiledict.pop(pos)
 
     def get_move(self, x, y, sort=True):
@@ -592,69 +1353,104 @@ class MyPaintSurface (object):
             targ_b = 0
             targ_a = 0
 
-        # Flood-fill loop
+        # Flood-fill loop.  Each tile is queued once while it waits, with
+        # the seeds of all the overflows into it merged.  The tiles queued
+        # at the start of a round are distinct, so tile_flood_fill() fills
+        # them in parallel; their overflows make up the next round.
         filled = {}
-        tileq = [ ((tx, ty), [(px, py)]) ]
-        while len(tileq) > 0:
-            (tx, ty), seeds = tileq.pop(0)
-            # Bbox-derived limits
-            if tx > max_tx or ty > max_ty:
-                continue
-            if tx < min_tx or ty < min_ty:
-                continue
-            # Pixel limits within this tile...
-            min_x = 0
-            min_y = 0
-            max_x = N-1
-            max_y = N-1
-            # ... vary at the edges
-            if tx == min_tx:
-                min_x = min_px
-            if ty == min_ty:
-                min_y = min_py
-            if tx == max_tx:
-                max_x = max_px
-            if ty == max_ty:
-                max_y = max_py
-            # Flood-fill one tile
-            one = 1<<15
-            col = (int(fill_r*one), int(fill_g*one), int(fill_b*one), one)
-            with self.tile_request(tx, ty, readonly=True) as src:
-                dst = filled.get((tx, ty), None)
+        tileq = deque([(tx, ty)])
+        tileq_seeds = {(tx, ty): set([(px, py)])}
+        fill = functools.partial(_flood_fill_tile,
+                                 targ=(targ_r, targ_g, targ_b, targ_a),
+                                 color=(fill_r, fill_g, fill_b),
+                                 tolerance=tolerance)
+        while tileq:
+            jobs = []
+            for i in xrange(len(tileq)):
+                tx, ty = tpos = tileq.popleft()
+                seeds = tileq_seeds.pop(tpos)
+                # Bbox-derived limits
+                if tx > max_tx or ty > max_ty:
+                    continue
+                if tx < min_tx or ty < min_ty:
+                    continue
+                # Pixel limits within this tile...
+                min_x = 0
+                min_y = 0
+                max_x = N-1
+                max_y = N-1
+                # ... vary at the edges
+                if tx == min_tx:
+                    min_x = min_px
+                if ty == min_ty:
+                    min_y = min_py
+                if tx == max_tx:
+                    max_x = max_px
+                if ty == max_ty:
+                    max_y = max_py
+                # Tiles are fetched here, the workers only fill
+                with self.tile_request(tx, ty, readonly=True) as src:
+                    pass
+                dst = filled.get(tpos, None)
                 if dst is None:
-                    dst = zeros((N, N, 4), 'uint16')
-                    filled[(tx, ty)] = dst
-                overflows = mypaintlib.tile_flood_fill(src, dst, seeds,
-                               targ_r, targ_g, targ_b, targ_a,
-                               fill_r, fill_g, fill_b,
-                               min_x, min_y, max_x, max_y,
-                               tolerance)
-                seeds_n, seeds_e, seeds_s, seeds_w = overflows
+                    dst = tile_pool.get()
+                    filled[tpos] = dst
+                jobs.append((tpos, src, dst, list(seeds),
+                             (min_x, min_y, max_x, max_y)))
+            workers = None
+            if len(jobs) > 1:
+                workers = _get_workers()
+            if workers is not None:
+                results = workers.map(fill, jobs)
+            else:
+                results = map(fill, jobs)
             # Enqueue overflows in each cardinal direction
-            if seeds_n and ty > min_ty:
-                tpos = (tx, ty-1)
-                tileq.append((tpos, seeds_n))
-            if seeds_w and tx > min_tx:
-                tpos = (tx-1, ty)
-                tileq.append((tpos, seeds_w))
-            if seeds_s and ty < max_ty:
-                tpos = (tx, ty+1)
-                tileq.append((tpos, seeds_s))
-            if seeds_e and tx < max_tx:
-                tpos = (tx+1, ty)
-                tileq.append((tpos, seeds_e))
+            for (tx, ty), overflows in results:
+                seeds_n, seeds_e, seeds_s, seeds_w = overflows
+                for tpos, seeds in (((tx, ty-1), seeds_n),
+                                    ((tx-1, ty), seeds_w),
+                                    ((tx, ty+1), seeds_s),
+                                    ((tx+1, ty), seeds_e)):
+                    if not seeds:
+                        continue
+                    if not (min_tx <= tpos[0] <= max_tx and
+                            min_ty <= tpos[1] <= max_ty):
+                        continue
+                    queued = tileq_seeds.get(tpos)
+                    if queued is None:
+                        tileq_seeds[tpos] = set(seeds)
+                        tileq.append(tpos)
+                    else:
+                        queued.update(seeds)
 
         # Composite filled tiles into the destination surface
         comp = functools.partial(mypaintlib.tile_composite,
                                  mypaintlib.BlendingModeNormal)
-        for (tx, ty), src in filled.iteritems():
+        bbox = get_tiles_bbox(filled)
+        while filled:
+            (tx, ty), src = filled.popitem()
             with dst_surface.tile_request(tx, ty, readonly=False) as dst:
                 comp(src, dst, True, 1.0)
             dst_surface._mark_mipmap_dirty(tx, ty)
-        bbox = get_tiles_bbox(filled)
+            tile_pool.put(src)
+        dst_surface.compact_uniform_tiles()
         dst_surface.notify_observers(*bbox)
 
 
+def _flood_fill_tile(job, targ, color, tolerance):
+    """Flood-fills one tile of a fill: returns (tile position, overflows)"""
+    tpos, src, dst, seeds, limits = job
+    targ_r, targ_g, targ_b, targ_a = targ
+    fill_r, fill_g, fill_b = color
+    min_x, min_y, max_x, max_y = limits
+    overflows = mypaintlib.tile_flood_fill(src, dst, seeds,
+                                           targ_r, targ_g, targ_b, targ_a,
+                                           fill_r, fill_g, fill_b,
+                                           min_x, min_y, max_x, max_y,
+                                           tolerance)
+    return tpos, overflows
+
+
 class TiledSurfaceMove (object):
     """Ongoing move state for a tiled surface, processed in chunks
 
@@ -797,7 +1593,7 @@ class TiledSurfaceMove (object):
                         self.written.add(targ_t)
                     # Copy this source slice to the desination
                     targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] \
-                                = src_tile.rgba[src_y0:src_y1, src_x0:src_x1]
+                                = src_tile.get_pixels()[src_y0:src_y1, src_x0:src_x1]
                     updated.add(targ_t)
             # The source tile has been fully processed at this point, and can be blanked
             # if it's safe to do so
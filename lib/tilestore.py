@@ -0,0 +1,115 @@
+# This file is part of MyPaint.
+# Copyright (C) 2014 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Sharing of identical tiles between surfaces."""
+
+import weakref
+import logging
+logger = logging.getLogger(__name__)
+
+import tiledsurface
+
+N = tiledsurface.N
+
+#: Memory used by the pixels of one tile, in bytes
+TILE_BYTES = N * N * 4 * 2
+
+
+class TileStore (object):
+    """Content addressed store of read-only tiles
+
+    Cels of an animation share most of their tiles: the background, the
+    parts of a character that are held between drawings, blank tiles.
+    `share()` replaces the tiles of a surface with equal ones already
+    used by another surface, so their pixels are only stored once.
+
+    A tile is marked read-only, like the tiles of a snapshot, once a
+    second surface uses it, so a surface makes a private copy the first
+    time it paints on a shared tile (see
+    `MyPaintSurface._get_tile_numpy()`).  Tiles used by one surface only
+    stay writable, painting on them costs no copy.  Tiles are only
+    referenced weakly: a tile leaves the store when no surface uses it
+    any more.
+
+    Sharing must not happen during a stroke, while the C++ side of the
+    surface may still hold the memory of the tiles it is painting on.
+
+    """
+
+    def __init__(self):
+        object.__init__(self)
+        self._tiles = weakref.WeakValueDictionary() # digest: Tile
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def intern(self, tile):
+        """Return the stored tile equal to `tile`, storing it if needed
+
+        Tiles are compared by digest, so compressed or paged out tiles
+        stay out of memory.  A stored tile that was painted on since no
+        longer matches its key, and gets replaced.
+
+        """
+        key = tile.get_digest()
+        stored = self._tiles.get(key)
+        if stored is not None and (stored is tile or
+                                   stored.get_digest() == key):
+            if stored is not tile:
+                # used by a second surface from now on
+                stored.readonly = True
+                self.hits += 1
+            return stored
+        self.misses += 1
+        self._tiles[key] = tile
+        return tile
+
+    def share(self, surface):
+        """Make a surface use the stored copies of its tiles
+
+        Returns the number of tiles whose memory got freed.
+
+        """
+        tiledict = getattr(surface, 'tiledict', None)
+        if tiledict is None:
+            return 0 # not a MyPaintSurface
+        shared = 0
+        for pos, tile in tiledict.items():
+            stored = self.intern(tile)
+            if stored is not tile:
+                # same pixels, so the mipmaps stay valid
+                tiledict[pos] = stored
+                shared += 1
+        return shared
+
+    def stats(self, surfaces):
+        """Return a dict of memory figures for the tiles of some surfaces
+
+        tiles: number of tiles used by the surfaces
+        unique: number of distinct tiles among them
+        dedup_ratio: tiles per distinct tile
+        saved_bytes: memory that the sharing saves
+
+        """
+        tiles = 0
+        unique = set()
+        for surface in surfaces:
+            tiledict = getattr(surface, 'tiledict', {})
+            tiles += len(tiledict)
+            unique.update(id(t) for t in tiledict.itervalues())
+        ratio = 1.0
+        if unique:
+            ratio = float(tiles) / len(unique)
+        return {
+            'tiles': tiles,
+            'unique': len(unique),
+            'dedup_ratio': ratio,
+            'saved_bytes': (tiles - len(unique)) * TILE_BYTES,
+        }
@@ -9,6 +9,7 @@
 
 import os
 import json
+import struct
 
 # adaptive file-format reader/writer inspired by Blender's SDNA system
 # the format works like this:
@@ -16,6 +17,14 @@ import json
 # * arrays contain repeated objects
 # an XDNA signature is equivalent to an empty xsheet with datatypes
 # instead of data
+#
+# the compact variant stores the same document as a JSON header followed
+# by binary runs of identical frames, see XDNA.runs_serialize()
+
+RLE_MAGIC = 'XDNA-RLE'
+RLE_VERSION = 1
+# layer idx (-1 for none), description index, is_key, run length
+RLE_RUN = struct.Struct('<iIBI')
 
 class XDNA(object):
 
@@ -59,6 +68,69 @@ class XDNA(object):
         """
         return json.loads(data)
 
+    def is_rle(self, data):
+        """
+        Whether data is in the compact run-length format
+
+        """
+        return data[:len(RLE_MAGIC)] == RLE_MAGIC
+
+    def runs_serialize(self, header, runs):
+        """
+        Compact format: header dict, then (idx, description, is_key, length)
+        runs of identical frames. Descriptions are stored once, in a table.
+
+        """
+        descriptions = []
+        description_ids = {}
+        packed = []
+        for idx, description, is_key, length in runs:
+            n = description_ids.get(description)
+            if n is None:
+                n = description_ids[description] = len(descriptions)
+                descriptions.append(description)
+            if idx is None:
+                idx = -1
+            packed.append(RLE_RUN.pack(idx, n, is_key, length))
+        header = dict(header, descriptions=descriptions)
+        header_data = json.dumps(header, sort_keys=True)
+        return ''.join([RLE_MAGIC, struct.pack('<HI', RLE_VERSION,
+                                               len(header_data)),
+                        header_data] + packed)
+
+    def runs_deserialize(self, data):
+        """
+        Inverse of runs_serialize(), returns (header, runs)
+
+        Raises ValueError if the runs are truncated or don't add up to the
+        number of frames of the header.
+
+        """
+        if not self.is_rle(data):
+            raise ValueError('Not a compact xsheet')
+        offset = len(RLE_MAGIC)
+        version, header_len = struct.unpack_from('<HI', data, offset)
+        if version > RLE_VERSION:
+            raise ValueError('Unsupported compact xsheet version %d' % version)
+        offset += struct.calcsize('<HI')
+        header = json.loads(data[offset:offset+header_len])
+        offset += header_len
+        descriptions = header.pop('descriptions')
+        if (len(data) - offset) % RLE_RUN.size:
+            raise ValueError('Truncated compact xsheet')
+        runs = []
+        frames = 0
+        for i in xrange(offset, len(data), RLE_RUN.size):
+            idx, n, is_key, length = RLE_RUN.unpack_from(data, i)
+            if idx < 0:
+                idx = None
+            runs.append((idx, descriptions[n], bool(is_key), length))
+            frames += length
+        if frames != header['frames']:
+            raise ValueError('Compact xsheet has %d frames in its runs, '
+                             '%d in its header' % (frames, header['frames']))
+        return header, runs
+
     def signatures_diff(self, d1, d2, ctx='', path=[], difflog={'added': [], 'removed': [], 'changed_value': [], 'changed_type': []}):
         """
         Calculates, in high-level terms, the difference betweent two XDNA signatures
@@ -0,0 +1,156 @@
+# test the clock driven animation player
+import sys
+import unittest
+
+sys.path.insert(0, '..')
+
+from lib.aniplayer import *
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeFrames(list):
+
+    def __init__(self, count):
+        list.__init__(self, range(count))
+        self.idx = 0
+
+    def select(self, idx):
+        self.idx = idx
+
+
+class FakeAnimation(object):
+
+    def __init__(self, count):
+        self.frames = FakeFrames(count)
+        self.shown = []
+
+    def player_goto(self, idx, use_lightbox=False):
+        self.frames.idx = idx
+        self.shown.append(idx)
+
+    def update_opacities(self):
+        pass
+
+
+class TestPlaybackClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pc = PlaybackClock(10, 5, start_idx=2, clock=self.clock)
+
+    def test_target_frame_loops(self):
+        self.assertEqual(self.pc.target_frame(100.0), 2)
+        self.assertEqual(self.pc.target_frame(100.25), 4)
+        self.assertEqual(self.pc.target_frame(100.35), 0)
+        self.assertEqual(self.pc.target_frame(101.0), 2)
+
+    def test_delay_to_next(self):
+        self.assertAlmostEqual(self.pc.delay_to_next(100.0), 0.1)
+        self.assertAlmostEqual(self.pc.delay_to_next(100.03), 0.07)
+
+    def test_restart(self):
+        self.pc.restart(20, 4, now=103.0)
+        self.assertEqual(self.pc.target_frame(103.0), 4)
+        self.assertEqual(self.pc.target_frame(103.06), 0)
+
+
+class TestPlayer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ani = FakeAnimation(24)
+        self.player = Player(self.ani, clock=self.clock)
+        self.player.start(24)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        return self.player.tick()
+
+    def test_keeps_time_with_slow_frames(self):
+        # ticks arrive late, the timeline doesn't shift
+        for i in range(10):
+            self.advance(1.5 / 24)
+        self.assertEqual(self.ani.frames.idx, 15)
+        self.assertEqual(self.player.stats()['dropped'], 5)
+
+    def test_no_drops_on_time(self):
+        for i in range(30):
+            self.advance(1.0 / 24)
+        stats = self.player.stats()
+        self.assertEqual(stats['dropped'], 0)
+        self.assertEqual(stats['shown'], 31)
+        self.assertAlmostEqual(stats['fps'], 24, places=3)
+        self.assertEqual(self.ani.frames.idx, 30 % 24)
+
+    def test_early_tick_keeps_frame(self):
+        self.advance(0.01)
+        self.assertEqual(self.ani.shown, [0])
+
+    def test_latency(self):
+        self.advance(1.0 / 24)
+        self.clock.now += 0.02
+        self.player.frame_rendered(1)
+        self.assertAlmostEqual(self.player.stats()['latency'], 0.02)
+        # frames already reported are ignored
+        self.player.frame_rendered(1)
+        self.assertEqual(len(self.player._latencies), 1)
+
+
+class TestScrubber(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ani = FakeAnimation(24)
+        self.ani.frames.idx = 3
+        self.scrubber = Scrubber(self.ani, clock=self.clock, interval=0.1)
+
+    def move(self, idx, seconds=0.02):
+        self.clock.now += seconds
+        return self.scrubber.move(idx)
+
+    def test_slow_moves_are_not_scrubbed(self):
+        self.assertFalse(self.move(4, 0.5))
+        self.assertFalse(self.move(5, 0.5))
+        self.assertFalse(self.scrubber.active)
+
+    def test_shows_only_latest_frame(self):
+        self.move(4, 0.5)
+        for idx in range(5, 10):
+            self.assertTrue(self.move(idx))
+        self.scrubber.show()
+        self.assertEqual(self.ani.shown, [9])
+        stats = self.scrubber.stats()
+        self.assertEqual(stats['shown'], 1)
+        self.assertEqual(stats['skipped'], 4)
+
+    def test_finish_when_resting(self):
+        self.move(4, 0.5)
+        self.move(5)
+        self.scrubber.show()
+        self.move(6)
+        self.assertFalse(self.scrubber.resting())
+        self.clock.now += 0.11
+        self.assertTrue(self.scrubber.resting())
+        # the selection is restored, the returned frame is selected for real
+        self.assertEqual(self.scrubber.finish(), 6)
+        self.assertEqual(self.ani.frames.idx, 3)
+        self.assertFalse(self.scrubber.active)
+
+    def test_latency(self):
+        self.move(4, 0.5)
+        self.move(5)
+        self.scrubber.show()
+        self.clock.now += 0.03
+        self.scrubber.frame_rendered(5)
+        self.assertAlmostEqual(self.scrubber.stats()['latency'], 0.03)
+
+if __name__ == '__main__':
+    unittest.main()
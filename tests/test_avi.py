@@ -0,0 +1,96 @@
+# test the AVI container writer
+import sys
+import struct
+import unittest
+from StringIO import StringIO
+
+import numpy
+
+sys.path.insert(0, '..')
+
+from lib.avi import *
+
+
+def read_chunks(data, start, end):
+    """Return the (fourcc, offset, size) of the chunks in data[start:end]"""
+    chunks = []
+    pos = start
+    while pos < end:
+        fourcc, size = struct.unpack('<4sI', data[pos:pos+8])
+        chunks.append((fourcc, pos, size))
+        pos += 8 + size + size % 2
+    return chunks
+
+
+class TestAVIWriter(unittest.TestCase):
+
+    def write(self, frames, codec='DIB ', width=5, height=3, fps=12):
+        f = StringIO()
+        writer = AVIWriter(f, width, height, fps, codec=codec)
+        for data in frames:
+            writer.write_frame(data)
+        writer.close()
+        return f.getvalue()
+
+    def test_riff_structure(self):
+        data = self.write(['abc', 'defg', 'h'], codec='MJPG')
+        self.assertEqual(data[:4], 'RIFF')
+        self.assertEqual(data[8:12], 'AVI ')
+        riff_size, = struct.unpack('<I', data[4:8])
+        self.assertEqual(riff_size, len(data) - 8)
+        chunks = read_chunks(data, 12, len(data))
+        self.assertEqual([c[0] for c in chunks], ['LIST', 'LIST', 'idx1'])
+        self.assertEqual(data[20:24], 'hdrl')
+        movi = chunks[1]
+        self.assertEqual(data[movi[1]+8:movi[1]+12], 'movi')
+        frames = read_chunks(data, movi[1]+12, movi[1]+8+movi[2])
+        self.assertEqual([c[0] for c in frames], ['00dc'] * 3)
+        self.assertEqual([c[2] for c in frames], [3, 4, 1])
+
+    def test_headers_count_frames(self):
+        data = self.write(['x' * 8] * 7)
+        avih = struct.unpack('<14I', data[MAIN_HEADER_OFFSET:
+                                          MAIN_HEADER_OFFSET+56])
+        self.assertEqual(avih[0], 83333)  # usec per frame at 12 fps
+        self.assertEqual(avih[4], 7)
+        self.assertEqual(avih[8:10], (5, 3))
+        strh = struct.unpack('<4s4sIHHIIIIIIII4h',
+                             data[STREAM_HEADER_OFFSET:
+                                  STREAM_HEADER_OFFSET+56])
+        self.assertEqual(strh[:2], ('vids', 'DIB '))
+        self.assertEqual(strh[7] / float(strh[6]), 12)
+        self.assertEqual(strh[9], 7)
+
+    def test_index_points_at_frames(self):
+        frames = ['one', 'three', 'five!']
+        data = self.write(frames)
+        chunks = read_chunks(data, 12, len(data))
+        movi_start = chunks[1][1] + 8
+        idx1 = chunks[2]
+        entries = data[idx1[1]+8:idx1[1]+8+idx1[2]]
+        self.assertEqual(len(entries), 16 * len(frames))
+        for i, frame in enumerate(frames):
+            ckid, flags, offset, size = struct.unpack(
+                '<4sIII', entries[i*16:(i+1)*16])
+            self.assertEqual(ckid, '00db')
+            self.assertEqual(flags, AVIIF_KEYFRAME)
+            self.assertEqual(size, len(frame))
+            pos = movi_start + offset
+            self.assertEqual(data[pos:pos+4], '00db')
+            self.assertEqual(data[pos+8:pos+8+size], frame)
+
+    def test_rgb_to_dib(self):
+        rgb = numpy.zeros((2, 3, 3), 'uint8')
+        rgb[0, 0] = (1, 2, 3)   # top left
+        rgb[1, 2] = (4, 5, 6)   # bottom right
+        dib = rgb_to_dib(rgb)
+        # 3 pixels of 3 bytes padded to 12 bytes per row, bottom row first
+        self.assertEqual(len(dib), 24)
+        self.assertEqual(dib[6:9], '\x06\x05\x04')
+        self.assertEqual(dib[12:15], '\x03\x02\x01')
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, AVIWriter, StringIO(), 1, 1, 1, 'H264')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,13 @@
 #from pylab import * # doesn't work any more, GTK version conflict (--> no plots on error)
 from numpy import *
 from time import time
-import sys, os, gc
+import sys, os, gc, weakref
 
 os.chdir(os.path.dirname(sys.argv[0]))
 sys.path.insert(0, '..')
 
 from lib import mypaintlib, tiledsurface, brush, document, command, helpers
+from lib import tilestore
 
 def tileConversions():
     # fully transparent tile stays fully transparent (without noise)
@@ -297,6 +298,534 @@ def saveFrame():
                     doc.save('test_saveFrame_doc.jpg')
     print 'checked', cnt, 'different rectangles'
 
+def frameDamage():
+    doc = document.Document()
+    ani = doc.ani
+    blob = zeros((20, 20, 4), 'uint8')
+    blob[:, :, 3] = 255
+    for i in range(10):
+        ani.select_without_undo(i)
+        ani.add_cel()
+        doc.layer._surface.load_from_numpy(blob, 10*i, 0)
+
+    redraws = []
+    doc.canvas_observers.append(lambda *rect: redraws.append(rect))
+    dispatches = ani.damage_dispatches
+    ani.select_without_undo(5)
+    # overlapping cels are redrawn together, in one dispatch
+    assert ani.damage_dispatches == dispatches + 1
+    assert len(redraws) == 1, redraws
+
+    del redraws[:]
+    ani.change_visible_frame(5, 6)
+    assert ani.damage_dispatches == dispatches + 2
+    assert len(redraws) == 1, redraws
+
+    # playback starts on the selected frame, after hiding all cels
+    for use_lightbox in (False, True):
+        ani.hide_all_frames()
+        ani.player_goto(ani.frames.idx, use_lightbox)
+        assert ani.frames.cel_at(ani.frames.idx).visible
+
+def lazyCels():
+    N = tiledsurface.N
+    doc = document.Document()
+    ani = doc.ani
+    decoded = []
+    for i in range(3):
+        ani.select_without_undo(i)
+        ani.add_cel()
+        cel = doc.layer
+        cel.deferred_bbox = helpers.Rect(0, 0, N, N)
+        cel.deferred_load = decoded.append
+    # hiding or showing cels redraws them without decoding them
+    redraws = []
+    doc.canvas_observers.append(lambda *rect: redraws.append(rect))
+    ani.hide_all_frames()
+    ani.select_without_undo(1)
+    assert redraws
+    assert not decoded, decoded
+
+def celStore():
+    from lib import celstore, layer
+    N = tiledsurface.N
+    src = tiledsurface.Surface()
+    with src.tile_request(0, 0, readonly=False) as rgba:
+        rgba[:] = 1<<15
+    del rgba
+    src.save_as_png('test_celStore.png', 0, 0, N, N)
+    data = open('test_celStore.png', 'rb').read()
+    store = celstore.CelStore(budget=2*tiledsurface.TILE_BYTES)
+    cels = [layer.Layer() for i in range(3)]
+    for cel in cels:
+        store.add(cel, data, 0, 0)
+    cels[0]._surface
+    cels[1]._surface
+    cels[0]._surface # used again, the most recent one now
+    # over budget: the least recently used cel is dropped
+    cels[2]._surface
+    assert store.evictions == 1
+    assert cels[1].deferred_load is not None
+    assert cels[0].deferred_load is None
+
+def onionSkin():
+    N = tiledsurface.N
+    doc = document.Document()
+    ani = doc.ani
+    blob = zeros((N, N, 4), 'uint8')
+    blob[:N/2, :, 1] = 255
+    blob[:N/2, :, 3] = 255
+    for i in range(3):
+        ani.select_without_undo(i)
+        ani.add_cel()
+        doc.layer._surface.load_from_numpy(blob, 0, 0)
+    ani.select_without_undo(1)
+    cur = ani.frames.cel_at(1)
+    layers = ani.onion_skin.substitute(doc.layers, keep=cur)
+    # the previous cel stays below the current one, the next one above
+    assert len(layers) == len(doc.layers)
+    assert layers.index(cur) == doc.layers.index(cur)
+    prev_run, next_run = [l for l in layers if l not in doc.layers]
+    assert prev_run.cels == (ani.frames.cel_at(0),)
+    assert next_run.cels == (ani.frames.cel_at(2),)
+    # the same pixels as compositing the cels one by one
+    a = zeros((N, N, 4), 'uint16')
+    b = zeros((N, N, 4), 'uint16')
+    doc.blit_tile_into(a, False, 0, 0, layers=layers)
+    doc.blit_tile_into(b, False, 0, 0, layers=doc.layers)
+    assert (abs(a.astype(int) - b) <= 2).all()
+
+    # tinted, previous cels go red and next ones blue
+    ani.set_lightbox_tint(True)
+    for run, channel in ((prev_run, 0), (next_run, 2)):
+        dst = zeros((N, N, 4), 'uint16')
+        run.composite_tile(dst, True, 0, 0)
+        assert dst[0, 0, channel] > 0 and dst[0, 0, 2-channel] == 0
+        assert not dst[N/2:].any()
+
+    # the composite stays under its budget, least recently used first out
+    skin = ani.onion_skin
+    skin.budget = tiledsurface.TILE_BYTES
+    ani.set_lightbox_tint(False)
+    for run in (prev_run, next_run, prev_run):
+        run.composite_tile(zeros((N, N, 4), 'uint16'), True, 0, 0)
+        assert skin.nbytes == tiledsurface.TILE_BYTES
+    assert list(skin._tiles) == [(prev_run.cels, 0, 0, 0)]
+
+def frameCache():
+    N = tiledsurface.N
+    doc = document.Document()
+    ani = doc.ani
+    cache = ani.frame_cache
+    blob = zeros((N, N, 4), 'uint8')
+    blob[:, :, 3] = 255
+    ani.select_without_undo(0)
+    ani.add_cel()
+    doc.layer._surface.load_from_numpy(blob, 0, 0)
+
+    out = tiledsurface.Surface()
+    cache.render_into(out, [(0, 0), (1, 0)], 0, 0)
+    cache.render_into(out, [(0, 1)], 0, 0)
+    assert cache.nbytes == 3 * N*N*4
+    assert cache.nbytes == sum(f.nbytes for f in cache._frames.values())
+    # only the tiles drawn for the last frame are prefetched
+    cache.render_into(out, [(5, 5)], 0, 1)
+    assert cache._view_tiles == set([(5, 5)])
+    # frame 1 holds the cel of frame 0, and shares its tiles
+    assert cache.nbytes == 4 * N*N*4
+    doc.layer._surface.notify_observers(0, 0, N, N)
+    assert cache.nbytes == 3 * N*N*4
+    # a background changed in place drops the frames drawn over it
+    doc.background.notify_observers(0, 0, N, N)
+    assert cache.nbytes == 0
+
+def tileSharing():
+    N = tiledsurface.N
+    blob = zeros((N, 2*N, 4), 'uint8')
+    blob[:] = 255 # opaque white
+    a = tiledsurface.Surface()
+    b = tiledsurface.Surface()
+    a.load_from_numpy(blob, 0, 0)
+    b.load_from_numpy(blob, 0, 0)
+    store = tilestore.TileStore()
+    assert store.share(a) == 1 # both tiles of a are equal
+    assert store.share(b) == 2
+    assert len(store) == 1
+    assert a.tiledict[(0, 0)] is b.tiledict[(1, 0)]
+    assert a.tiledict[(0, 0)].readonly
+    # a tile no other surface uses stays writable
+    c = tiledsurface.Surface()
+    with c.tile_request(0, 0, readonly=False) as rgba:
+        rgba[:] = 1
+    assert store.share(c) == 0
+    assert not c.tiledict[(0, 0)].readonly
+    # compressed tiles are compared without decompressing them
+    d = tiledsurface.Surface()
+    e = tiledsurface.Surface()
+    for s in (d, e):
+        with s.tile_request(0, 0, readonly=False) as rgba:
+            rgba[:] = 2
+        del rgba
+        assert s.tiledict[(0, 0)].compress()
+    assert store.share(d) == 0
+    assert store.share(e) == 1
+    assert e.tiledict[(0, 0)] is d.tiledict[(0, 0)]
+    assert d.tiledict[(0, 0)]._packed is not None
+    stats = store.stats([a, b])
+    assert stats['unique'] == 1 and stats['dedup_ratio'] == 4.0
+    assert stats['saved_bytes'] == 3 * tilestore.TILE_BYTES
+
+    # copy on write
+    with a.tile_request(0, 0, readonly=False) as rgba:
+        rgba[:] = 0
+    assert b.tiledict[(0, 0)].rgba.all()
+    assert not a.tiledict[(0, 0)].rgba.any()
+    assert store.stats([a, b])['unique'] == 2
+
+def uniformTiles():
+    N = tiledsurface.N
+    blob = zeros((N, 2*N, 4), 'uint8')
+    blob[:, :N] = 255 # opaque white
+    blob[:N/2, N:] = 255 # half of the second tile
+    s = tiledsurface.Surface()
+    s.load_from_numpy(blob, 0, 0)
+    white = (1<<15,) * 4
+    assert s.tiledict[(0, 0)].color == white
+    assert s.tiledict[(1, 0)].color is None
+
+    # reading does not allocate, the fast paths give the same pixels
+    with s.tile_request(0, 0, readonly=True) as rgba:
+        assert (rgba == 1<<15).all()
+    dst = zeros((N, N, 4), 'uint16')
+    s.composite_tile(dst, True, 0, 0)
+    assert (dst == 1<<15).all()
+    dst8 = zeros((N, N, 4), 'uint8')
+    s.blit_tile_into(dst8, True, 0, 0)
+    assert (dst8 == 255).all()
+    assert s.tiledict[(0, 0)].color == white
+
+    # writing gets a buffer, erased tiles are compacted again
+    with s.tile_request(0, 0, readonly=False) as rgba:
+        rgba[:] = 0
+    assert s.tiledict[(0, 0)].color is None
+    s.save_snapshot()
+    assert s.tiledict[(0, 0)].color == (0, 0, 0, 0)
+    s.remove_empty_tiles()
+    assert (0, 0) not in s.tiledict
+
+def tilePool():
+    pool = tiledsurface.TilePool(size=4)
+    buf = pool.get()
+    pool.put(buf)
+    assert pool.get() is buf
+    assert pool.stats()['reused'] == 1
+
+    # buffers still in use are not recycled
+    with pool.scratch() as buf:
+        pass
+    assert pool.get() is buf
+    with pool.scratch() as buf:
+        kept = buf
+    assert pool.stats()['pooled'] == 0
+    with pool.scratch() as buf:
+        view = buf[:, :, 3]
+    assert pool.stats()['pooled'] == 0
+    pool.put(kept)
+    assert pool.get() is kept
+    del kept, view
+
+    # dropped tiles give their buffers back, once no snapshot uses them
+    N = tiledsurface.N
+    pool = tiledsurface.tile_pool
+    s = tiledsurface.Surface()
+    for tx in range(3):
+        with s.tile_request(tx, 0, readonly=False) as rgba:
+            rgba[:N/2] = 1<<15
+    del rgba
+    snapshot = s.save_snapshot()
+    pooled = pool.stats()['pooled']
+    s.clear()
+    assert pool.stats()['pooled'] == pooled
+    del snapshot
+    assert pool.stats()['pooled'] == pooled + 3
+    reused = pool.stats()['reused']
+    with s.tile_request(0, 0, readonly=False) as rgba:
+        assert not rgba.any()
+    assert pool.stats()['reused'] == reused + 1
+    del rgba
+
+    # the buffer of a tile dropped by copy-on-write is held back until
+    # end_atomic(), the C++ side may still point to it
+    s.tiledict[(0, 0)].readonly = True
+    pooled = pool.stats()['pooled']
+    s.begin_atomic()
+    with s.tile_request(0, 0, readonly=False) as rgba:
+        pass
+    del rgba
+    assert pool.stats()['pooled'] == pooled - 1
+    s.end_atomic()
+    assert pool.stats()['pooled'] == pooled
+
+    # also when the pool is full
+    s.tiledict[(0, 0)].readonly = True
+    buf = weakref.ref(s.tiledict[(0, 0)]._rgba)
+    size = pool.size
+    pool.size = 0
+    try:
+        s.begin_atomic()
+        with s.tile_request(0, 0, readonly=False) as rgba:
+            pass
+        del rgba
+        assert buf() is not None
+        s.end_atomic()
+        assert buf() is None
+    finally:
+        pool.size = size
+
+def tileCompression():
+    N = tiledsurface.N
+    compressor = tiledsurface.tile_compressor
+    s = tiledsurface.Surface()
+    for tx in range(4):
+        s.begin_atomic()
+        with s.tile_request(tx, 0, readonly=False) as rgba:
+            rgba[:N/2] = tx
+        del rgba
+        s.end_atomic()
+    # reading a tile makes it the most recently used one
+    with s.tile_request(0, 0, readonly=True) as rgba:
+        pass
+    del rgba
+    # keeps the two tiles used last
+    compressor.budget = 2 * tiledsurface.TILE_BYTES
+    try:
+        # never while the C++ side may hold tile pointers
+        s.begin_atomic()
+        assert compressor.maybe_compress() == 0
+        s.end_atomic()
+        assert s.tiledict[(1, 0)]._packed is not None
+        assert s.tiledict[(2, 0)]._packed is not None
+        assert s.tiledict[(0, 0)]._packed is None
+        assert s.tiledict[(3, 0)]._packed is None
+    finally:
+        compressor.budget = None
+    misses = compressor.misses
+    with s.tile_request(1, 0, readonly=True) as rgba:
+        assert (rgba[:N/2] == 1).all() and not rgba[N/2:].any()
+    with s.tile_request(2, 0, readonly=True) as rgba:
+        assert (rgba[:N/2] == 2).all() and not rgba[N/2:].any()
+    del rgba
+    assert compressor.misses == misses + 2
+
+    # empty tiles are found without decompressing them
+    compressor.budget = 0
+    try:
+        compressor.maybe_compress()
+    finally:
+        compressor.budget = None
+    assert all(t._packed is not None for t in s.tiledict.values())
+    s.remove_empty_tiles()
+    assert sorted(s.tiledict) == [(1, 0), (2, 0), (3, 0)]
+    assert compressor.misses == misses + 2
+
+def tileSwap():
+    N = tiledsurface.N
+    compressor = tiledsurface.tile_compressor
+    swap = tiledsurface.TileSwap(max_resident=0, grow=2)
+    s = tiledsurface.Surface()
+    for tx in range(3):
+        with s.tile_request(tx, 0, readonly=False) as rgba:
+            rgba[:N/2] = tx + 1
+    del rgba
+    snapshot = s.save_snapshot()
+    compressor.swap = swap
+    try:
+        compressor.maybe_compress()
+    finally:
+        compressor.swap = None
+    assert all(t._swapped is not None for t in s.tiledict.values())
+    used = swap.used
+
+    # paged out in place: the snapshot shares the tile, which stays
+    # read-only, and writing pages it in as a private copy
+    assert snapshot.tiledict[(1, 0)] is s.tiledict[(1, 0)]
+    with s.tile_request(1, 0, readonly=False) as rgba:
+        assert (rgba[:N/2] == 2).all() and not rgba[N/2:].any()
+        rgba[:] = 0
+    assert snapshot.tiledict[(1, 0)]._swapped is not None
+    with s.tile_request(0, 0, readonly=True) as rgba:
+        assert (rgba[:N/2] == 1).all()
+    assert swap.page_ins == 1
+    del snapshot
+    assert swap.used == used - 2 # paged in or dropped
+
+def mipmapUpdate():
+    N = tiledsurface.N
+    s = tiledsurface.Surface()
+    for tx in range(4):
+        for ty in range(4):
+            with s.tile_request(tx, ty, readonly=False) as rgba:
+                rgba[:N/2] = 1<<15
+    assert s.mipmaps_pending == 4 + 1 + 1 + 1 # 4 levels
+    s.update_mipmaps(max_time=0)
+    assert 0 < s.mipmaps_pending < 7
+    assert not s.update_mipmaps()
+    assert s.mipmaps_pending == 0
+    # the same pixels as rebuilding on demand
+    t = tiledsurface.Surface()
+    t.load_snapshot(s.save_snapshot())
+    for level in range(1, 3):
+        a = s.mipmaps[level].tiledict[(0, 0)].get_pixels()
+        with t.mipmaps[level].tile_request(0, 0, readonly=True) as b:
+            assert (a == b).all()
+
+    # one changed tile is one outdated quadrant per level
+    with s.tile_request(3, 1, readonly=False) as rgba:
+        rgba[:] = 0
+    assert s.mipmaps[1]._dirty_mipmaps == {(1, 0): 1 << 3}
+    assert s.mipmaps[2]._dirty_mipmaps == {(0, 0): 1 << 1}
+    assert not s.update_mipmaps()
+    t.load_snapshot(s.save_snapshot())
+    a = s.mipmaps[1].tiledict[(1, 0)].get_pixels()
+    with t.mipmaps[1].tile_request(1, 0, readonly=True) as b:
+        assert (a == b).all()
+
+    # painting a quarter of a tile only downscales its quadrant again
+    parent = s.mipmaps[1].tiledict[(0, 0)]
+    parent.rgba[:] = 7 # not a downscaled value
+    with s.tile_request(1, 1, readonly=False) as rgba:
+        rgba[:N/2, :N/2] = 1<<14
+    del rgba
+    assert not s.update_mipmaps()
+    assert s.mipmaps[1].tiledict[(0, 0)] is parent
+    assert (parent.rgba[:N/2] == 7).all()
+    assert (parent.rgba[N/2:, :N/2] == 7).all()
+    t.load_snapshot(s.save_snapshot())
+    with t.mipmaps[1].tile_request(0, 0, readonly=True) as b:
+        assert (parent.rgba[N/2:, N/2:] == b[N/2:, N/2:]).all()
+
+def floodFill():
+    N = tiledsurface.N
+    s = tiledsurface.Surface()
+    dst = tiledsurface.Surface()
+    # a wall down the middle of tile column 2, across three tile rows
+    for ty in range(3):
+        with s.tile_request(2, ty, readonly=False) as rgba:
+            rgba[:, N/2, :] = 1<<15
+    s.flood_fill(10, 10, (1.0, 0.0, 0.0), (0, 0, 5*N, 3*N), 0.0, dst)
+    assert sorted(dst.get_tiles()) == sorted((tx, ty) for tx in range(3)
+                                             for ty in range(3))
+    with dst.tile_request(2, 1, readonly=True) as rgba:
+        assert (rgba[:, :N/2, 3] == 1<<15).all()
+        assert (rgba[:, N/2:, 3] == 0).all()
+        assert (rgba[:, 0, :3] == (1<<15, 0, 0)).all()
+    with dst.tile_request(0, 2, readonly=True) as rgba:
+        assert (rgba[:, :, 3] == 1<<15).all()
+
+    # the same on worker threads, however many CPUs there are
+    threads, workers = tiledsurface.WORKER_THREADS, tiledsurface._workers
+    tiledsurface.WORKER_THREADS, tiledsurface._workers = 4, None
+    try:
+        dst4 = tiledsurface.Surface()
+        s.flood_fill(10, 10, (1.0, 0.0, 0.0), (0, 0, 5*N, 3*N), 0.0, dst4)
+        assert tiledsurface._workers is not None
+    finally:
+        tiledsurface.WORKER_THREADS, tiledsurface._workers = threads, workers
+    assert sorted(dst4.get_tiles()) == sorted(dst.get_tiles())
+    for tx, ty in dst.get_tiles():
+        with dst.tile_request(tx, ty, readonly=True) as a:
+            with dst4.tile_request(tx, ty, readonly=True) as b:
+                assert (a == b).all()
+
+def celThumbnails():
+    doc = document.Document()
+    ani = doc.ani
+    ani.add_cel()
+    cel = ani.frames.cel_at(0)
+    blob = zeros((20, 20, 4), 'uint8')
+    blob[:] = 255
+    cel._surface.load_from_numpy(blob, 0, 0)
+
+    thumbnails = ani.thumbnails
+    rendered = []
+    thumbnails.observers.append(rendered.append)
+    assert thumbnails.get(cel) is None
+    assert thumbnails.pending == 1
+    while thumbnails.render_pending():
+        pass
+    assert cel in rendered
+    pixbuf = thumbnails.get(cel)
+    assert pixbuf.get_width() == thumbnails.size
+    assert thumbnails.pending == 0
+
+    # painting outdates the thumbnail, the old one is shown meanwhile
+    cel._surface.load_from_numpy(blob, 30, 30)
+    assert thumbnails.get(cel) is pixbuf
+    assert thumbnails.pending == 1
+
+def xsheetChanges():
+    doc = document.Document()
+    ani = doc.ani
+    rows = list(ani.frames)
+    changed = []
+    def xsheet_changed_cb(change, idx, count):
+        # apply the deltas to a copy, like the x-sheet view does
+        if change == 'inserted':
+            rows[idx:idx] = ani.frames[idx:idx+count]
+        elif change == 'removed':
+            del rows[idx:idx+count]
+        else:
+            changed.append(idx)
+    ani.xsheet_observers.append(xsheet_changed_cb)
+
+    ani.select_without_undo(3)
+    ani.insert_frames(5)
+    assert rows == list(ani.frames)
+    ani.select_without_undo(10)
+    ani.add_cel()
+    assert changed == [10]
+    ani.remove_frames(4)
+    assert rows == list(ani.frames)
+    doc.undo()
+    assert rows == list(ani.frames)
+    doc.undo()
+    doc.undo()
+    assert rows == list(ani.frames)
+
+def frameNavigation():
+    from lib import anicommand
+    doc = document.Document()
+    ani = doc.ani
+    stack = doc.command_stack
+    ani.select_frame(0)
+    ani.add_cel()
+    depth = len(stack.undo_stack)
+    for idx in range(1, 20):
+        ani.select_frame(idx)
+    # one coalesced entry, undone on its own
+    assert len(stack.undo_stack) == depth + 1
+    assert ani.frames.idx == 19
+    doc.undo()
+    assert ani.frames.idx == 0
+    assert ani.frames.cel_at(0) is not None
+    doc.undo()
+    assert ani.frames.cel_at(0) is None
+
+    # navigating between commands does not push them out of the history
+    for idx in range(stack.max_undo_steps + 10):
+        ani.select_frame(idx % 5)
+        ani.toggle_key()
+    assert stack.undo_steps == stack.max_undo_steps
+    toggles = [c for c in stack.undo_stack
+               if isinstance(c, anicommand.ToggleKey)]
+    assert len(toggles) == stack.max_undo_steps
+    assert isinstance(stack.undo_stack[0], anicommand.ToggleKey)
+
+    # navigating after an undo discards the redo history
+    doc.undo()
+    ani.select_frame(3)
+    assert doc.redo() is None
+
 from optparse import OptionParser
 parser = OptionParser('usage: %prog [options]')
 options, tests = parser.parse_args()
@@ -305,6 +834,21 @@ options, tests = parser.parse_args()
 #layerModes()
 directPaint()
 brushPaint()
+frameDamage()
+lazyCels()
+celStore()
+onionSkin()
+frameCache()
+tileSharing()
+uniformTiles()
+tilePool()
+tileCompression()
+tileSwap()
+mipmapUpdate()
+floodFill()
+celThumbnails()
+xsheetChanges()
+frameNavigation()
 
 # FIXME: make these tests pass with MyPaint+GEGL
 #if not os.environ.get('MYPAINT_ENABLE_GEGL', 0):
@@ -204,6 +204,64 @@ def brushengine_paint_hires():
     yield stop_measurement
     #s.save('test_paint_hires.png') # approx. 3000x3000
 
+@nogui_test
+def brushengine_paint_zoomed_out_5x():
+    """Paint, fetching the mipmap tiles a view zoomed out 5x redraws"""
+    from lib import tiledsurface, brush
+    N = tiledsurface.N
+    level = 2 # scale 1/4 to 1/8, the level a 5x zoom out renders from
+    s = tiledsurface.Surface()
+    bi = brush.BrushInfo(open('brushes/charcoal.myb').read())
+    b = brush.Brush(bi)
+
+    events = loadtxt('painting30sec.dat')
+    t_old = events[0][0]
+    yield start_measurement
+    s.begin_atomic()
+    trans_time = 0.0
+    for t, x, y, pressure in events:
+        dtime = t - t_old
+        t_old = t
+        b.stroke_to(s.backend, x*5, y*5, pressure, 0.0, 0.0, dtime)
+
+        trans_time += dtime
+        if trans_time > 0.05:
+            trans_time = 0.0
+            bbox = s.end_atomic()
+            # redraw at a mipmap level, like the canvas would
+            tx, ty = int(x*5) // (N << level), int(y*5) // (N << level)
+            with s.mipmaps[level].tile_request(tx, ty, readonly=True):
+                pass
+            s.begin_atomic()
+
+    s.end_atomic()
+    yield stop_measurement
+
+@nogui_test
+def flood_fill_large_areas():
+    """Flood-fill big enclosed areas of a 4K canvas"""
+    from lib import tiledsurface
+    N = tiledsurface.N
+    w, h = 3840, 2160
+    s = tiledsurface.Surface()
+    dst = tiledsurface.Surface()
+    # walls: a frame around the canvas, split into four rooms
+    tw, th = (w + N - 1) // N, (h + N - 1) // N
+    for tx in range(tw):
+        for ty in range(th):
+            with s.tile_request(tx, ty, readonly=False) as rgba:
+                x0, y0 = tx*N, ty*N
+                for x in (0, w/2, w-1):
+                    if x0 <= x < x0+N:
+                        rgba[:, x-x0, :] = 1<<15
+                for y in (0, h/2, h-1):
+                    if y0 <= y < y0+N:
+                        rgba[y-y0, :, :] = 1<<15
+    yield start_measurement
+    for x, y in ((w/4, h/4), (3*w/4, h/4), (w/4, 3*h/4), (3*w/4, 3*h/4)):
+        s.flood_fill(x, y, (0.0, 0.5, 1.0), (0, 0, w, h), 0.0, dst)
+    yield stop_measurement
+
 @gui_test
 def scroll_nozoom(gui):
     gui.wait_for_idle()
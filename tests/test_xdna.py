@@ -154,5 +154,46 @@ class TestXDNASignatureFunctions(unittest.TestCase):
         self.assertTrue(['xsheet', 'framerate'] in diff['changed_type'])
         self.assertTrue(['xsheet', 'raster_frame_lists', '0', 'raster_frame_list', '0', 'description'] in diff['changed_type'])
 
+class TestXDNARunLength(unittest.TestCase):
+
+    def setUp(self):
+        self.xdna = XDNA()
+        self.header = {'framerate': 24.0, 'frames': 13}
+        self.runs = [
+            (2, u'walk \xe9', True, 1),
+            (None, u'', False, 9),
+            (0, u'', False, 2),
+            (None, u'walk \xe9', False, 1),
+        ]
+
+    def test_roundtrip(self):
+        x = self.xdna
+
+        data = x.runs_serialize(self.header, self.runs)
+        header, runs = x.runs_deserialize(data)
+
+        self.assertEqual(header, self.header)
+        self.assertEqual(runs, self.runs)
+
+    def test_recognized(self):
+        x = self.xdna
+
+        data = x.runs_serialize(self.header, self.runs)
+
+        self.assertTrue(x.is_rle(data))
+        self.assertFalse(x.is_rle(x.data_serialize(x.xdna_signature)))
+        self.assertRaises(ValueError, x.runs_deserialize, '{}')
+
+    def test_frame_count_checked(self):
+        x = self.xdna
+
+        header = dict(self.header, frames=14)
+        data = x.runs_serialize(header, self.runs)
+        self.assertRaises(ValueError, x.runs_deserialize, data)
+        data = x.runs_serialize(self.header, self.runs)
+        self.assertRaises(ValueError, x.runs_deserialize, data[:-1])
+        self.assertRaises(ValueError, x.runs_deserialize,
+                          data[:-RLE_RUN.size])
+
 if __name__ == '__main__':
     unittest.main()